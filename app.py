@@ -1,22 +1,44 @@
 import os
-from flask import Flask, render_template, request, session, redirect, jsonify, send_from_directory, url_for
+from flask import Flask, render_template, request, session, redirect, jsonify, send_from_directory, send_file, url_for
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.security import generate_password_hash, check_password_hash
 import json
-from datetime import datetime, timedelta
-from werkzeug.utils import secure_filename
+from datetime import datetime, timedelta, timezone
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.exceptions import NotFound
+import werkzeug.utils
 import logging
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 import time
 import eventlet
+import eventlet.tpool
+from eventlet.event import Event
+import click
 
 # Дополнительные импорты для бэкапов
 import zipfile
 import shutil
 import tempfile
 import uuid
+import fcntl
+import struct
+import heapq
+import hashlib
+import bisect
+import base64
+import html
+import email.utils
+import math
+import gzip
+import re
+import copy
+import atexit
+import threading
+from contextlib import contextmanager
 from pathlib import Path
+from urllib.parse import quote, unquote
 from werkzeug.datastructures import FileStorage
+from PIL import Image, ImageOps
 
 # Используем eventlet для асинхронности
 eventlet.monkey_patch()
@@ -75,6 +97,37 @@ def allowed_file(filename):
 def allowed_video_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS_VIDEO
 
+# Раздача файлов через nginx: Flask только проверяет доступ и отвечает
+# заголовком X-Accel-Redirect, байты (с Range, докачкой, перемоткой видео)
+# отдает nginx из internal-location. Без nginx файлы отдает сам Flask.
+X_ACCEL_REDIRECT = os.environ.get('X_ACCEL_REDIRECT', '').lower() in ('1', 'true', 'yes')
+X_ACCEL_LOCATIONS = {
+    UPLOAD_FOLDER: '/internal/uploads/',
+    BACKUP_FOLDER: '/internal/backups/'
+}
+
+def send_protected_file(folder, filename, download_name=None, as_attachment=False, max_age=None):
+    """Отдает файл из folder (ключ X_ACCEL_LOCATIONS) после проверки доступа в маршруте"""
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+    if not X_ACCEL_REDIRECT:
+        return send_file(path, download_name=download_name, as_attachment=as_attachment,
+                         conditional=True, max_age=max_age)
+    # Заголовки (тип, Content-Disposition, Cache-Control) считает werkzeug,
+    # файл при этом не открывается; ETag, If-None-Match и Range - забота nginx
+    response = werkzeug.utils.send_file(
+        path, request.environ, download_name=download_name, as_attachment=as_attachment,
+        conditional=False, etag=False, max_age=max_age, use_x_sendfile=True,
+        response_class=app.response_class
+    )
+    # Длину и дату изменения nginx выставит сам по файлу
+    for header in ('X-Sendfile', 'Content-Length', 'Last-Modified'):
+        response.headers.pop(header, None)
+    relative_path = os.path.relpath(path, folder).replace(os.sep, '/')
+    response.headers['X-Accel-Redirect'] = quote(X_ACCEL_LOCATIONS[folder] + relative_path)
+    return response
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -157,43 +210,3621 @@ def cleanup_inactive_rooms():
             logger.error(f"Error in cleanup task: {e}")
             eventlet.sleep(30)
 
-# Запускаем фоновую задачу при старте
-eventlet.spawn(cleanup_inactive_rooms)
+# Запускаем фоновую задачу при старте
+eventlet.spawn(cleanup_inactive_rooms)
+
+# ===== ФОРМАТЫ ФАЙЛОВ КОЛЛЕКЦИЙ =====
+
+# Недельные партиции коллекции называются <коллекция>_<год>w<неделя ISO>
+PARTITION_NAME_RE = re.compile(r'^(.+)_(\d{4})w(\d{2})$')
+
+def collection_family(file):
+    """Базовая коллекция для партиции (homeworks_2026w42 -> homeworks)"""
+    match = PARTITION_NAME_RE.match(file)
+    return match.group(1) if match else file
+
+# Кодек снимка по умолчанию и для отдельных коллекций. Переопределяется
+# окружением: DB_DEFAULT_CODEC=json, DB_CODECS="blog_posts=binary,users=json-pretty".
+# По замерам flask bench-storage компактный json быстрее всех и на запись,
+# и на чтение, поэтому он используется по умолчанию для всех коллекций.
+DB_DEFAULT_CODEC = os.environ.get('DB_DEFAULT_CODEC', 'json')
+COLLECTION_CODECS = {}
+for _item in filter(None, os.environ.get('DB_CODECS', '').split(',')):
+    _name, _, _codec = _item.partition('=')
+    COLLECTION_CODECS[_name.strip()] = _codec.strip()
+
+# Заголовок бинарного формата: дальше идут записи [uint32 BE длина][JSON UTF-8]
+BINARY_CODEC_MAGIC = b'ZDB1'
+
+class CollectionCodec:
+    """Кодирование снимков коллекций.
+
+    json-pretty - исходный формат (indent=2, \\u-экранирование кириллицы);
+    json - компактный JSON в UTF-8; binary - записи с префиксом длины.
+    Формат при чтении определяется по содержимому, поэтому кодек можно
+    менять в любой момент: файл перепишется при следующем уплотнении.
+    """
+    CODECS = ('json-pretty', 'json', 'binary')
+
+    @staticmethod
+    def for_collection(file):
+        codec = COLLECTION_CODECS.get(file) or COLLECTION_CODECS.get(collection_family(file), DB_DEFAULT_CODEC)
+        return codec if codec in CollectionCodec.CODECS else 'json'
+
+    @staticmethod
+    def encode(codec, data):
+        if codec == 'json-pretty':
+            return json.dumps(data, indent=2).encode('utf-8')
+        if codec == 'binary':
+            parts = [BINARY_CODEC_MAGIC]
+            for doc in data:
+                body = json.dumps(doc, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                parts.append(struct.pack('>I', len(body)))
+                parts.append(body)
+            return b''.join(parts)
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def detect(raw):
+        return 'binary' if raw[:len(BINARY_CODEC_MAGIC)] == BINARY_CODEC_MAGIC else 'json'
+
+    @staticmethod
+    def decode(raw):
+        if CollectionCodec.detect(raw) != 'binary':
+            return json.loads(raw) if raw.strip() else []
+        data = []
+        view = memoryview(raw)
+        offset = len(BINARY_CODEC_MAGIC)
+        while offset < len(raw):
+            (length,) = struct.unpack_from('>I', raw, offset)
+            offset += 4
+            if offset + length > len(raw):
+                raise ValueError('Truncated binary collection record')
+            data.append(json.loads(bytes(view[offset:offset + length])))
+            offset += length
+        return data
+
+# ===== ЖУРНАЛИРУЕМОЕ ХРАНИЛИЩЕ КОЛЛЕКЦИЙ =====
+
+# Поле-ключ документа в коллекции (по умолчанию 'id')
+COLLECTION_KEYS = {
+    'users': 'username',
+    'conferences': 'room_name',
+    'sequences': 'name',
+    'partitions': 'name',
+    'homework_submissions': 'key',
+    'file_blobs': 'sha256'
+}
+
+# Вторичные индексы в памяти: для полей-списков индексируется каждый элемент
+COLLECTION_INDEXES = {
+    'users': ['role'],
+    'lessons': ['teacher', 'students'],
+    'homeworks': ['teacher', 'students'],
+    'homework_submissions': ['homework_id', 'student'],
+    'feedbacks': ['lesson_id', 'student_username', 'teacher_username'],
+    'conference_links': ['teacher_username'],
+    'blog_comments': ['post_id'],
+    'blog_posts': ['slug']
+}
+
+# Пороги фонового уплотнения журнала в новый снимок
+JOURNAL_COMPACT_RECORDS = 500
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+
+# Статистика хранилища (своя у каждого воркера gunicorn)
+db_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'tail_reads': 0,
+    'invalidations': 0,
+    'appends': 0,
+    'compactions': 0,
+    'collections': defaultdict(lambda: {'hits': 0, 'misses': 0, 'tail_reads': 0})
+}
+
+# Интервал опроса занятого flock
+FLOCK_POLL_INTERVAL = 0.01
+
+def flock_exclusive(lock_file):
+    """Эксклюзивный flock без блокировки хаба eventlet.
+
+    Блокирующий LOCK_EX останавливает поток ОС целиком, а с ним и все
+    greenlet'ы воркера, пока другой процесс держит блокировку. Поэтому
+    пробуем LOCK_NB и между попытками уступаем управление.
+    """
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            eventlet.sleep(FLOCK_POLL_INTERVAL)
+
+@contextmanager
+def migration_lock(name):
+    """Разовая миграция данных при старте: выполняется одним воркером за раз.
+
+    Отдельный lock-файл, а не блокировка самой коллекции: ее берет
+    GroupCommitWriter, и ожидание лидера под ней привело бы к взаимной
+    блокировке. Файл в DB_FOLDER работает при любом бэкенде.
+    """
+    with JournalStore.locked(f'{name}.migrate'):
+        yield
+
+class JournalStore:
+    """Коллекции в виде снимка <file>.json и журнала изменений <file>.log.
+
+    Каждая мутация дописывает в журнал одну короткую запись
+    ({"op": "put", "doc": ...} или {"op": "del", "key": ...}), поэтому
+    стоимость записи не зависит от размера коллекции. Состояние в памяти
+    воркера = снимок + журнал; чужие записи подхватываются чтением хвоста
+    журнала с последнего прочитанного смещения. Фоновое уплотнение пишет
+    новый снимок во временный файл и подменяет его через rename.
+
+    Записи журнала содержат только абсолютные значения, поэтому повторное
+    применение журнала поверх уже уплотненного снимка дает то же состояние.
+
+    Вместе с документами в памяти поддерживаются вторичные индексы
+    (COLLECTION_INDEXES): они обновляются в _apply, то есть и при своей
+    записи, и при чтении чужих записей из хвоста журнала.
+    """
+    # {file: {'snap_stamp', 'log_ino', 'log_offset', 'log_records',
+    #         'docs', 'indexes', 'indexed'}}
+    _entries = {}
+    # Межпроцессная блокировка: flock на <file>.lock + счетчик вложенности
+    _locks = defaultdict(threading.RLock)
+    _lock_files = {}
+    _lock_depth = defaultdict(int)
+
+    @staticmethod
+    def key_field(file):
+        return COLLECTION_KEYS.get(collection_family(file), 'id')
+
+    @staticmethod
+    def _snapshot_path(file):
+        return f'{DB_FOLDER}/{file}.json'
+
+    @staticmethod
+    def _log_path(file):
+        return f'{DB_FOLDER}/{file}.log'
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    @staticmethod
+    @contextmanager
+    def locked(file):
+        """Эксклюзивная блокировка коллекции между воркерами (реентерабельная)"""
+        lock = JournalStore._locks[file]
+        with lock:
+            if JournalStore._lock_depth[file] == 0:
+                lock_file = open(f'{DB_FOLDER}/{file}.lock', 'a')
+                flock_exclusive(lock_file)
+                JournalStore._lock_files[file] = lock_file
+            JournalStore._lock_depth[file] += 1
+            try:
+                yield
+            finally:
+                JournalStore._lock_depth[file] -= 1
+                if JournalStore._lock_depth[file] == 0:
+                    lock_file = JournalStore._lock_files.pop(file)
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    lock_file.close()
+
+    @staticmethod
+    def _new_entry(file):
+        return {
+            'snap_stamp': None,
+            'log_ino': None,
+            'log_offset': 0,
+            'log_records': 0,
+            'docs': {},
+            # {field: {value: {key: doc}}}
+            'indexes': {field: defaultdict(dict) for field in COLLECTION_INDEXES.get(collection_family(file), [])},
+            # {key: [(field, value), ...]} - значения на момент индексации:
+            # документ мог быть изменен на месте до вызова put
+            'indexed': {}
+        }
+
+    @staticmethod
+    def _unindex(entry, key):
+        for field, value in entry['indexed'].pop(key, ()):
+            bucket = entry['indexes'][field].get(value)
+            if bucket is not None:
+                bucket.pop(key, None)
+                if not bucket:
+                    del entry['indexes'][field][value]
+
+    @staticmethod
+    def _index(entry, key, doc):
+        indexed = []
+        for field, index in entry['indexes'].items():
+            value = doc.get(field)
+            values = value if isinstance(value, list) else [value]
+            for v in values:
+                if v is None or isinstance(v, (dict, list)):
+                    continue
+                index[v][key] = doc
+                indexed.append((field, v))
+        if indexed:
+            entry['indexed'][key] = indexed
+
+    @staticmethod
+    def _set_doc(entry, key, doc):
+        JournalStore._unindex(entry, key)
+        entry['docs'][key] = doc
+        JournalStore._index(entry, key, doc)
+
+    @staticmethod
+    def _apply(file, entry, record):
+        op = record.get('op')
+        if op == 'put':
+            doc = record['doc']
+            JournalStore._set_doc(entry, doc.get(JournalStore.key_field(file)), doc)
+        elif op == 'del':
+            JournalStore._unindex(entry, record['key'])
+            entry['docs'].pop(record['key'], None)
+        elif op == 'batch':
+            for nested in record['records']:
+                JournalStore._apply(file, entry, nested)
+
+    @staticmethod
+    def _fill(file, entry, data):
+        key_field = JournalStore.key_field(file)
+        for i, doc in enumerate(data):
+            key = doc.get(key_field)
+            JournalStore._set_doc(entry, key if key is not None else f'__{i}', doc)
+
+    @staticmethod
+    def _read_log_tail(file, entry):
+        """Применяет к entry записи журнала после entry['log_offset'].
+
+        Возвращает False, если журнал был подменен уплотнением и нужна
+        полная перезагрузка коллекции.
+        """
+        try:
+            f = open(JournalStore._log_path(file), 'rb')
+        except FileNotFoundError:
+            return entry['log_ino'] is None
+        with f:
+            ino = os.fstat(f.fileno()).st_ino
+            if entry['log_ino'] is not None and entry['log_ino'] != ino:
+                return False
+            entry['log_ino'] = ino
+            f.seek(entry['log_offset'])
+            chunk = f.read()
+
+        # Недописанную последнюю строку оставляем до следующего чтения
+        consumed = chunk.rfind(b'\n') + 1
+        for line in chunk[:consumed].splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f'Skipping corrupted journal record in {file}.log')
+                continue
+            JournalStore._apply(file, entry, record)
+            entry['log_records'] += 1
+        entry['log_offset'] += consumed
+        return True
+
+    @staticmethod
+    def _load(file):
+        """Полная загрузка коллекции: снимок + весь журнал"""
+        with JournalStore.locked(file):
+            snap_path = JournalStore._snapshot_path(file)
+            try:
+                with open(snap_path, 'rb') as f:
+                    data = CollectionCodec.decode(f.read())
+            except FileNotFoundError:
+                data = []
+            except (ValueError, struct.error) as e:
+                logger.error(f'Cannot decode snapshot {file}: {e}')
+                data = []
+
+            entry = JournalStore._new_entry(file)
+            entry['snap_stamp'] = JournalStore._stamp(snap_path)
+            JournalStore._fill(file, entry, data)
+            JournalStore._read_log_tail(file, entry)
+            JournalStore._entries[file] = entry
+            return entry
+
+    @staticmethod
+    def _fresh_entry(file):
+        """Возвращает актуальное состояние коллекции в памяти воркера"""
+        entry = JournalStore._entries.get(file)
+        collection_stats = db_cache_stats['collections'][file]
+
+        if entry and entry['snap_stamp'] == JournalStore._stamp(JournalStore._snapshot_path(file)):
+            log_stamp = JournalStore._stamp(JournalStore._log_path(file))
+            log_ino = log_stamp[2] if log_stamp else None
+            if log_ino == entry['log_ino'] or entry['log_ino'] is None:
+                log_size = log_stamp[1] if log_stamp else 0
+                if log_size == entry['log_offset']:
+                    db_cache_stats['hits'] += 1
+                    collection_stats['hits'] += 1
+                    return entry
+                if JournalStore._read_log_tail(file, entry):
+                    db_cache_stats['tail_reads'] += 1
+                    collection_stats['tail_reads'] += 1
+                    return entry
+
+        db_cache_stats['misses'] += 1
+        collection_stats['misses'] += 1
+        if entry:
+            db_cache_stats['invalidations'] += 1
+        return JournalStore._load(file)
+
+    @staticmethod
+    def get(file):
+        # Отдаем копию списка, чтобы фильтрация и сортировка
+        # в вызывающем коде не меняли порядок в памяти
+        return list(JournalStore._fresh_entry(file)['docs'].values())
+
+    @staticmethod
+    def append(file, records, fsync=False):
+        """Дописывает записи в журнал коллекции и применяет их в памяти.
+
+        Несколько записей пишутся одной строкой {"op": "batch"}: строка
+        применяется читателями только целиком, поэтому пакет атомарен.
+        """
+        line = records[0] if len(records) == 1 else {'op': 'batch', 'records': records}
+        payload = (json.dumps(line, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        with JournalStore.locked(file):
+            entry = JournalStore._fresh_entry(file)
+            with open(JournalStore._log_path(file), 'ab') as f:
+                st = os.fstat(f.fileno())
+                if entry['log_ino'] not in (None, st.st_ino):
+                    entry = JournalStore._load(file)
+                # Отрезаем недописанную запись, оставшуюся после сбоя
+                if st.st_size > entry['log_offset']:
+                    f.truncate(entry['log_offset'])
+                f.write(payload)
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+                st = os.fstat(f.fileno())
+
+            JournalStore._apply(file, entry, line)
+            entry['log_ino'] = st.st_ino
+            entry['log_offset'] = st.st_size
+            entry['log_records'] += len(records)
+            db_cache_stats['appends'] += 1
+
+    @staticmethod
+    def _write_snapshot(file, data, codec=None):
+        path = JournalStore._snapshot_path(file)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(CollectionCodec.encode(codec or CollectionCodec.for_collection(file), data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _reset_log(file, entry):
+        """Подменяет журнал пустым файлом (новый inode сигнализирует остальным воркерам)"""
+        path = JournalStore._log_path(file)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        open(tmp_path, 'wb').close()
+        os.replace(tmp_path, path)
+        entry['snap_stamp'] = JournalStore._stamp(JournalStore._snapshot_path(file))
+        entry['log_ino'] = os.stat(path).st_ino
+        entry['log_offset'] = 0
+        entry['log_records'] = 0
+
+    @staticmethod
+    def replace(file, data):
+        """Полная перезапись коллекции (инициализация, восстановление из бэкапа)"""
+        with JournalStore.locked(file):
+            JournalStore._write_snapshot(file, data)
+            entry = JournalStore._new_entry(file)
+            JournalStore._fill(file, entry, data)
+            JournalStore._reset_log(file, entry)
+            JournalStore._entries[file] = entry
+
+    @staticmethod
+    def compact(file, force=False):
+        """Уплотняет журнал в новый снимок, если он перерос пороги"""
+        with JournalStore.locked(file):
+            entry = JournalStore._fresh_entry(file)
+            if entry['log_offset'] == 0:
+                return False
+            if not force and entry['log_records'] < JOURNAL_COMPACT_RECORDS \
+                    and entry['log_offset'] < JOURNAL_COMPACT_BYTES:
+                return False
+            JournalStore._write_snapshot(file, list(entry['docs'].values()))
+            JournalStore._reset_log(file, entry)
+            db_cache_stats['compactions'] += 1
+            logger.info(f'Compacted journal for {file}')
+            return True
+
+    @staticmethod
+    def rewrite(file, codec=None):
+        """Переписывает снимок (вместе с журналом) в заданном или настроенном кодеке"""
+        with JournalStore.locked(file):
+            entry = JournalStore._fresh_entry(file)
+            JournalStore._write_snapshot(file, list(entry['docs'].values()), codec=codec)
+            JournalStore._reset_log(file, entry)
+
+    @staticmethod
+    def find(file, field, value):
+        """Выборка по вторичному индексу; None, если поле не индексируется"""
+        entry = JournalStore._fresh_entry(file)
+        index = entry['indexes'].get(field)
+        if index is None:
+            return None
+        return list(index.get(value, {}).values())
+
+    @staticmethod
+    def invalidate(file=None):
+        if file is None:
+            JournalStore._entries.clear()
+        else:
+            JournalStore._entries.pop(file, None)
+
+    @staticmethod
+    def stats():
+        total = db_cache_stats['hits'] + db_cache_stats['tail_reads'] + db_cache_stats['misses']
+        return {
+            'hits': db_cache_stats['hits'],
+            'misses': db_cache_stats['misses'],
+            'tail_reads': db_cache_stats['tail_reads'],
+            'invalidations': db_cache_stats['invalidations'],
+            'appends': db_cache_stats['appends'],
+            'compactions': db_cache_stats['compactions'],
+            'hit_ratio': round(db_cache_stats['hits'] / total, 4) if total else None,
+            'cached_collections': sorted(JournalStore._entries.keys()),
+            'journal_records': {f: e['log_records'] for f, e in JournalStore._entries.items()},
+            'collections': {k: dict(v) for k, v in db_cache_stats['collections'].items()},
+            'pid': os.getpid()
+        }
+
+# Фоновая задача уплотнения журналов
+def compact_journals():
+    while True:
+        eventlet.sleep(60)
+        for file in list(JournalStore._entries.keys()):
+            try:
+                JournalStore.compact(file)
+            except Exception as e:
+                logger.error(f'Error compacting journal {file}: {e}')
+
+# ===== ГРУППОВАЯ ЗАПИСЬ =====
+
+# Окно, в течение которого мутации коллекции собираются в один пакет
+GROUP_COMMIT_WINDOW = 0.002
+
+class GroupCommitWriter:
+    """Групповая запись мутаций JSON-коллекций.
+
+    Первый пришедший greenlet становится лидером: ждет GROUP_COMMIT_WINDOW,
+    забирает все накопившиеся мутации коллекции и под межпроцессной
+    блокировкой пишет их одной строкой журнала с одним fsync. Остальные
+    ждут результата на Event. Мутации 'update' выполняются над свежим
+    состоянием под блокировкой, поэтому параллельные чтение-изменение-
+    запись из разных воркеров не теряют обновлений.
+
+    Мутации: ('put', doc), ('del', key), ('update', key, fn), где fn
+    получает копию текущего документа (или None) и возвращает новый
+    документ либо None, если менять нечего.
+    """
+    # {file: [(ops, event)]}
+    _queues = defaultdict(list)
+    _leaders = set()
+    _stats = {'commits': 0, 'mutations': 0}
+
+    @staticmethod
+    def submit(file, ops):
+        """Ставит мутации в очередь и ждет фиксации; возвращает список результатов"""
+        event = Event()
+        GroupCommitWriter._queues[file].append((ops, event))
+        if file not in GroupCommitWriter._leaders:
+            GroupCommitWriter._leaders.add(file)
+            try:
+                eventlet.sleep(GROUP_COMMIT_WINDOW)
+                while GroupCommitWriter._queues.get(file):
+                    GroupCommitWriter._commit(file, GroupCommitWriter._queues.pop(file))
+            finally:
+                GroupCommitWriter._leaders.discard(file)
+        results = event.wait()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    @staticmethod
+    def _commit(file, batch):
+        key_field = JournalStore.key_field(file)
+        try:
+            with JournalStore.locked(file):
+                docs = JournalStore._fresh_entry(file)['docs']
+                # Документы, измененные ранее в этом же пакете
+                staged = {}
+                records = []
+                batch_results = []
+                for ops, event in batch:
+                    results = []
+                    for op in ops:
+                        try:
+                            if op[0] == 'put':
+                                doc = op[1]
+                                staged[doc.get(key_field)] = doc
+                                records.append({'op': 'put', 'doc': doc})
+                                results.append(doc)
+                            elif op[0] == 'del':
+                                staged[op[1]] = None
+                                records.append({'op': 'del', 'key': op[1]})
+                                results.append(True)
+                            elif op[0] == 'update':
+                                key, fn = op[1], op[2]
+                                current = staged[key] if key in staged else docs.get(key)
+                                doc = fn(copy.deepcopy(current) if current is not None else None)
+                                if doc is not None:
+                                    staged[key] = doc
+                                    records.append({'op': 'put', 'doc': doc})
+                                results.append(doc)
+                        except Exception as e:
+                            results.append(e)
+                    batch_results.append(results)
+
+                if records:
+                    JournalStore.append(file, records, fsync=True)
+                    GroupCommitWriter._stats['commits'] += 1
+                    GroupCommitWriter._stats['mutations'] += len(records)
+        except Exception as e:
+            logger.error(f'Group commit failed for {file}: {e}')
+            for ops, event in batch:
+                event.send([e] * len(ops))
+            return
+
+        for (ops, event), results in zip(batch, batch_results):
+            event.send(results)
+
+    @staticmethod
+    def stats():
+        return dict(GroupCommitWriter._stats)
+
+# ===== БЭКЕНДЫ ХРАНИЛИЩА =====
+
+# Все коллекции приложения (для бэкапов и миграции)
+DB_COLLECTIONS = ['users', 'lessons', 'homeworks', 'homework_submissions', 'conferences', 'testimonials',
+                  'feedbacks', 'conference_links', 'blog_posts', 'blog_comments', 'sequences',
+                  'file_blobs', 'file_refs']
+
+# Пространства отдельно хранимых текстов (blob): тела постов блога
+BLOG_CONTENT_NAMESPACE = 'blog_content'
+BLOB_NAMESPACES = [BLOG_CONTENT_NAMESPACE]
+
+# Поля, по которым SQL-бэкенды строят индексы (помимо ключа документа)
+SQL_INDEXED_FIELDS = {
+    'lessons': ['teacher'],
+    'homeworks': ['teacher', 'lesson_id'],
+    'homework_submissions': ['homework_id', 'student'],
+    'feedbacks': ['lesson_id', 'student_username', 'teacher_username'],
+    'conference_links': ['teacher_username'],
+    'blog_posts': ['slug'],
+    'blog_comments': ['post_id']
+}
+
+class StorageBackend:
+    """Интерфейс хранилища документов, которому делегирует класс DB.
+
+    Документ - словарь; ключ документа определяется COLLECTION_KEYS.
+    Чтения (all, get, find, update) возвращают новые словари: изменение
+    результата не меняет хранимый документ ни в одном бэкенде.
+    """
+    name = 'abstract'
+
+    def all(self, collection):
+        raise NotImplementedError
+
+    def get(self, collection, key):
+        key_field = JournalStore.key_field(collection)
+        return next((d for d in self.all(collection) if d.get(key_field) == key), None)
+
+    def find(self, collection, field, value):
+        """Документы, у которых поле равно value (для полей-списков - содержит value)"""
+        result = []
+        for doc in self.all(collection):
+            v = doc.get(field)
+            if (value in v) if isinstance(v, list) else (v == value):
+                result.append(doc)
+        return result
+
+    def put(self, collection, doc):
+        raise NotImplementedError
+
+    def delete(self, collection, key):
+        raise NotImplementedError
+
+    def replace(self, collection, docs):
+        raise NotImplementedError
+
+    def update(self, collection, key, fn):
+        """Атомарное чтение-изменение-запись документа.
+
+        fn получает копию текущего документа (None, если его нет) и
+        возвращает новый документ или None, если менять нечего.
+        Возвращает записанный документ или None.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _incrementer(fields):
+        def apply(doc):
+            if doc is None:
+                return None
+            for field, delta in fields.items():
+                doc[field] = max((doc.get(field) or 0) + delta, 0)
+            return doc
+        return apply
+
+    def increment_many(self, collection, deltas):
+        """Атомарно прибавляет счетчики: deltas = {key: {field: delta}}"""
+        for key, fields in deltas.items():
+            self.update(collection, key, StorageBackend._incrementer(fields))
+
+    def reserve_sequence(self, name, size, seed):
+        """Атомарно резервирует size значений последовательности name.
+
+        Возвращает первое значение блока. seed() вызывается один раз, когда
+        последовательности еще нет, и возвращает текущий максимум id.
+        """
+        def advance(doc):
+            start = doc['value'] if doc else seed()
+            return {'name': name, 'value': start + size}
+        return self.update('sequences', name, advance)['value'] - size + 1
+
+    def exists(self, collection):
+        raise NotImplementedError
+
+    def drop(self, collection):
+        """Удаляет коллекцию целиком (архивированные партиции)"""
+        raise NotImplementedError
+
+    # Большие тексты (тела постов и т.п.) хранятся отдельно от документов:
+    # списки и индексы не читают и не переписывают их при каждом изменении
+
+    def get_blob(self, namespace, key):
+        raise NotImplementedError
+
+    def put_blob(self, namespace, key, data):
+        raise NotImplementedError
+
+    def delete_blob(self, namespace, key):
+        raise NotImplementedError
+
+    def list_blobs(self, namespace):
+        raise NotImplementedError
+
+    def compact(self, collection, force=False):
+        return False
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {'backend': self.name}
+
+class JsonBackend(StorageBackend):
+    """JSON-файлы в DB_FOLDER с журналом изменений (см. JournalStore)"""
+    name = 'json'
+
+    # Документы JournalStore - общий кэш воркера: наружу отдаются копии,
+    # как и у SQL-бэкендов
+
+    def all(self, collection):
+        return [dict(doc) for doc in JournalStore.get(collection)]
+
+    def get(self, collection, key):
+        doc = JournalStore._fresh_entry(collection)['docs'].get(key)
+        return dict(doc) if doc is not None else None
+
+    def find(self, collection, field, value):
+        result = JournalStore.find(collection, field, value)
+        if result is None:
+            return super().find(collection, field, value)
+        return [dict(doc) for doc in result]
+
+    def put(self, collection, doc):
+        GroupCommitWriter.submit(collection, [('put', dict(doc))])
+
+    def delete(self, collection, key):
+        GroupCommitWriter.submit(collection, [('del', key)])
+
+    def update(self, collection, key, fn):
+        doc = GroupCommitWriter.submit(collection, [('update', key, fn)])[0]
+        return dict(doc) if isinstance(doc, dict) else doc
+
+    def replace(self, collection, docs):
+        JournalStore.replace(collection, docs)
+
+    def increment_many(self, collection, deltas):
+        # Все дельты одним пакетом: одна запись журнала и один fsync
+        GroupCommitWriter.submit(collection, [
+            ('update', key, StorageBackend._incrementer(fields)) for key, fields in deltas.items()
+        ])
+
+    def exists(self, collection):
+        return os.path.exists(JournalStore._snapshot_path(collection)) or \
+            os.path.exists(JournalStore._log_path(collection))
+
+    def drop(self, collection):
+        with JournalStore.locked(collection):
+            for path in (JournalStore._snapshot_path(collection), JournalStore._log_path(collection),
+                         f'{DB_FOLDER}/{collection}.lock'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            JournalStore.invalidate(collection)
+
+    @staticmethod
+    def _blob_path(namespace, key):
+        name = str(key)
+        if not name or '/' in name or name.startswith('.'):
+            raise ValueError(f'Недопустимый ключ: {key!r}')
+        return os.path.join(DB_FOLDER, namespace, name + '.blob')
+
+    def get_blob(self, namespace, key):
+        try:
+            with open(self._blob_path(namespace, key), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_blob(self, namespace, key, data):
+        path = self._blob_path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def delete_blob(self, namespace, key):
+        try:
+            os.remove(self._blob_path(namespace, key))
+        except FileNotFoundError:
+            pass
+
+    def list_blobs(self, namespace):
+        folder = os.path.join(DB_FOLDER, namespace)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(name[:-len('.blob')] for name in os.listdir(folder) if name.endswith('.blob'))
+
+    def compact(self, collection, force=False):
+        return JournalStore.compact(collection, force=force)
+
+    def stats(self):
+        stats = JournalStore.stats()
+        stats['backend'] = self.name
+        stats['group_commit'] = GroupCommitWriter.stats()
+        return stats
+
+class SqlBackend(StorageBackend):
+    """Документы в SQL-таблицах через peewee.
+
+    Каждая коллекция - отдельная таблица: уникальный ключ документа,
+    JSON-тело и индексируемые колонки из SQL_INDEXED_FIELDS. Значения
+    ключей и индексируемых полей хранятся JSON-кодированными, чтобы
+    различать 1 и '1'.
+    """
+    name = 'sql'
+
+    def __init__(self, database):
+        self.db = database
+        self._models = {}
+        self._blob_model = None
+
+    def _model(self, collection):
+        model = self._models.get(collection)
+        if model is not None:
+            return model
+
+        import peewee
+
+        attrs = {
+            'doc_key': peewee.CharField(max_length=255, unique=True),
+            'data': peewee.TextField(),
+            'Meta': type('Meta', (), {'database': self.db, 'table_name': collection})
+        }
+        for field in SQL_INDEXED_FIELDS.get(collection_family(collection), []):
+            attrs[f'f_{field}'] = peewee.CharField(max_length=255, null=True, index=True)
+
+        model = type(f'Collection_{collection}', (peewee.Model,), attrs)
+        with self._connection():
+            self.db.create_tables([model], safe=True)
+        self._models[collection] = model
+        return model
+
+    @contextmanager
+    def _connection(self):
+        """Соединение на время операции; вложенные вызовы используют уже открытое"""
+        if not self.db.is_closed():
+            yield
+            return
+        self.db.connect()
+        try:
+            yield
+        finally:
+            self.db.close()
+
+    @staticmethod
+    def _encode(value):
+        return json.dumps(value, ensure_ascii=False)
+
+    def _row(self, collection, doc):
+        row = {
+            'doc_key': self._encode(doc.get(JournalStore.key_field(collection))),
+            'data': json.dumps(doc, ensure_ascii=False)
+        }
+        for field in SQL_INDEXED_FIELDS.get(collection_family(collection), []):
+            row[f'f_{field}'] = self._encode(doc.get(field))
+        return row
+
+    def all(self, collection):
+        model = self._model(collection)
+        with self._connection():
+            return [json.loads(r.data) for r in model.select(model.data).order_by(model.id)]
+
+    def get(self, collection, key):
+        model = self._model(collection)
+        with self._connection():
+            row = model.get_or_none(model.doc_key == self._encode(key))
+        return json.loads(row.data) if row else None
+
+    def find(self, collection, field, value):
+        if field == JournalStore.key_field(collection):
+            doc = self.get(collection, value)
+            return [doc] if doc else []
+        if field not in SQL_INDEXED_FIELDS.get(collection_family(collection), []):
+            return super().find(collection, field, value)
+        model = self._model(collection)
+        column = getattr(model, f'f_{field}')
+        with self._connection():
+            return [json.loads(r.data) for r in
+                    model.select(model.data).where(column == self._encode(value)).order_by(model.id)]
+
+    def put(self, collection, doc):
+        model = self._model(collection)
+        row = self._row(collection, doc)
+        with self._connection():
+            with self.db.atomic():
+                updated = model.update(**{k: v for k, v in row.items() if k != 'doc_key'}) \
+                    .where(model.doc_key == row['doc_key']).execute()
+                if not updated:
+                    model.insert(**row).execute()
+
+    def delete(self, collection, key):
+        model = self._model(collection)
+        with self._connection():
+            model.delete().where(model.doc_key == self._encode(key)).execute()
+
+    def replace(self, collection, docs):
+        model = self._model(collection)
+        rows = [self._row(collection, doc) for doc in docs]
+        with self._connection():
+            with self.db.atomic():
+                model.delete().execute()
+                for i in range(0, len(rows), 500):
+                    model.insert_many(rows[i:i + 500]).execute()
+
+    def _write_transaction(self):
+        return self.db.atomic()
+
+    def _select_for_update(self, query):
+        return query
+
+    def update(self, collection, key, fn):
+        model = self._model(collection)
+        with self._connection():
+            with self._write_transaction():
+                query = model.select().where(model.doc_key == self._encode(key))
+                row = self._select_for_update(query).first()
+                doc = fn(json.loads(row.data) if row else None)
+                if doc is None:
+                    return None
+                data = self._row(collection, doc)
+                if row is None:
+                    model.insert(**data).execute()
+                else:
+                    data.pop('doc_key')
+                    model.update(**data).where(model.id == row.id).execute()
+                return doc
+
+    def increment_many(self, collection, deltas):
+        with self._connection():
+            with self._write_transaction():
+                super().increment_many(collection, deltas)
+
+    def exists(self, collection):
+        with self._connection():
+            return self.db.table_exists(collection)
+
+    def drop(self, collection):
+        model = self._model(collection)
+        with self._connection():
+            self.db.drop_tables([model], safe=True)
+        self._models.pop(collection, None)
+
+    def _blobs(self):
+        if self._blob_model is not None:
+            return self._blob_model
+
+        import peewee
+
+        class Blob(peewee.Model):
+            namespace = peewee.CharField(max_length=64)
+            blob_key = peewee.CharField(max_length=255)
+            data = peewee.TextField()
+
+            class Meta:
+                database = self.db
+                table_name = 'blobs'
+                indexes = ((('namespace', 'blob_key'), True),)
+
+        with self._connection():
+            self.db.create_tables([Blob], safe=True)
+        self._blob_model = Blob
+        return Blob
+
+    def get_blob(self, namespace, key):
+        model = self._blobs()
+        with self._connection():
+            row = model.get_or_none((model.namespace == namespace) & (model.blob_key == str(key)))
+        return row.data if row else None
+
+    def put_blob(self, namespace, key, data):
+        model = self._blobs()
+        with self._connection():
+            with self.db.atomic():
+                updated = model.update(data=data).where(
+                    (model.namespace == namespace) & (model.blob_key == str(key))).execute()
+                if not updated:
+                    model.insert(namespace=namespace, blob_key=str(key), data=data).execute()
+
+    def delete_blob(self, namespace, key):
+        model = self._blobs()
+        with self._connection():
+            model.delete().where((model.namespace == namespace) & (model.blob_key == str(key))).execute()
+
+    def list_blobs(self, namespace):
+        model = self._blobs()
+        with self._connection():
+            return [r.blob_key for r in
+                    model.select(model.blob_key).where(model.namespace == namespace).order_by(model.blob_key)]
+
+    def close(self):
+        if not self.db.is_closed():
+            self.db.close()
+
+    def stats(self):
+        return {'backend': self.name, 'collections': sorted(self._models.keys())}
+
+class SqliteBackend(SqlBackend):
+    """SQLite в режиме WAL: читатели не блокируются писателями других воркеров"""
+    name = 'sqlite'
+
+    def __init__(self, path):
+        from peewee import SqliteDatabase
+
+        super().__init__(SqliteDatabase(path, pragmas={
+            'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'busy_timeout': 5000,
+            'cache_size': -16 * 1024
+        }))
+
+    def _write_transaction(self):
+        # IMMEDIATE сразу берет блокировку записи, чтение и запись счетчика не разрываются
+        return self.db.atomic(lock_type='IMMEDIATE')
+
+class PostgresBackend(SqlBackend):
+    """PostgreSQL с пулом соединений, совместимым с eventlet"""
+    name = 'postgres'
+
+    def __init__(self, url, max_connections=20):
+        import psycopg2
+        from psycopg2 import extensions
+        from playhouse.db_url import connect
+
+        # Кооперативное ожидание сокета: запросы не блокируют hub eventlet
+        def eventlet_wait_callback(conn, timeout=-1):
+            from eventlet.hubs import trampoline
+            while True:
+                state = conn.poll()
+                if state == extensions.POLL_OK:
+                    break
+                elif state == extensions.POLL_READ:
+                    trampoline(conn.fileno(), read=True)
+                elif state == extensions.POLL_WRITE:
+                    trampoline(conn.fileno(), write=True)
+                else:
+                    raise psycopg2.OperationalError(f'Bad result from poll: {state!r}')
+
+        extensions.set_wait_callback(eventlet_wait_callback)
+
+        if url.startswith('postgres://'):
+            url = 'postgres+pool://' + url[len('postgres://'):]
+        elif url.startswith('postgresql://'):
+            url = 'postgres+pool://' + url[len('postgresql://'):]
+        # Пул привязывает соединение к greenlet (threading.local пропатчен eventlet)
+        super().__init__(connect(url, max_connections=max_connections, stale_timeout=300))
+
+    def _select_for_update(self, query):
+        return query.for_update()
+
+def create_storage_backend():
+    """Выбирает бэкенд по переменной окружения DB_BACKEND (json|sqlite|postgres)"""
+    backend = os.environ.get('DB_BACKEND', 'json').lower()
+    if backend == 'sqlite':
+        return SqliteBackend(os.environ.get('SQLITE_PATH', f'{DB_FOLDER}/zindaki.sqlite3'))
+    if backend in ('postgres', 'postgresql'):
+        return PostgresBackend(
+            os.environ['DATABASE_URL'],
+            max_connections=int(os.environ.get('DB_POOL_SIZE', 20))
+        )
+    return JsonBackend()
+
+# ===== ОТЛОЖЕННАЯ ЗАПИСЬ СЧЕТЧИКОВ =====
+
+# Сброс накопленных счетчиков: по таймеру или по числу инкрементов
+COUNTER_FLUSH_INTERVAL = 5
+COUNTER_FLUSH_THRESHOLD = 200
+
+class CounterBuffer:
+    """Счетчики (просмотры постов) с отложенной пакетной записью.
+
+    Инкременты копятся в памяти воркера и сбрасываются одним
+    backend.increment_many на коллекцию. Сложение с текущим значением
+    делается при сбросе под блокировкой бэкенда, поэтому дельты всех
+    воркеров суммируются. Чтения накладывают еще не записанные дельты
+    своего воркера через overlay().
+    """
+    # {(collection, key, field): delta}
+    _pending = defaultdict(int)
+    # Дельты, которые сейчас записываются (видны чтениям до конца записи)
+    _flushing = {}
+    _pending_count = 0
+    _flush_lock = threading.Lock()
+    _stats = {'increments': 0, 'flushes': 0, 'flushed_keys': 0}
+
+    @staticmethod
+    def increment(collection, key, field, delta=1):
+        CounterBuffer._pending[(collection, key, field)] += delta
+        CounterBuffer._pending_count += 1
+        CounterBuffer._stats['increments'] += 1
+        if CounterBuffer._pending_count >= COUNTER_FLUSH_THRESHOLD:
+            eventlet.spawn_n(CounterBuffer.flush)
+
+    @staticmethod
+    def pending(collection, key, field):
+        return CounterBuffer._pending.get((collection, key, field), 0) + \
+            CounterBuffer._flushing.get((collection, key, field), 0)
+
+    @staticmethod
+    def overlay(collection, doc, fields=('views', 'comments_count')):
+        """Возвращает документ с учетом незаписанных дельт (копию, если они есть)"""
+        if doc is None or not (CounterBuffer._pending or CounterBuffer._flushing):
+            return doc
+        key = doc.get(JournalStore.key_field(collection))
+        updated = None
+        for field in fields:
+            delta = CounterBuffer.pending(collection, key, field)
+            if delta:
+                if updated is None:
+                    updated = dict(doc)
+                updated[field] = max((updated.get(field) or 0) + delta, 0)
+        return updated if updated is not None else doc
+
+    @staticmethod
+    def flush():
+        if not CounterBuffer._flush_lock.acquire(blocking=False):
+            return
+        try:
+            if not CounterBuffer._pending:
+                return
+            CounterBuffer._flushing = dict(CounterBuffer._pending)
+            CounterBuffer._pending = defaultdict(int)
+            CounterBuffer._pending_count = 0
+
+            grouped = defaultdict(lambda: defaultdict(dict))
+            for (collection, key, field), delta in CounterBuffer._flushing.items():
+                if delta:
+                    grouped[collection][key][field] = delta
+
+            for collection, deltas in grouped.items():
+                try:
+                    DB.backend.increment_many(collection, deltas)
+                    CounterBuffer._stats['flushed_keys'] += len(deltas)
+                    if collection == 'blog_posts':
+                        # Популярные посты в других воркерах (см. BlogAggregates)
+                        ChangeLog.bump_many('blog_views', list(deltas))
+                except Exception as e:
+                    logger.error(f'Error flushing counters for {collection}: {e}')
+                    # Возвращаем дельты в очередь до следующего сброса
+                    for key, fields in deltas.items():
+                        for field, delta in fields.items():
+                            CounterBuffer._pending[(collection, key, field)] += delta
+            CounterBuffer._stats['flushes'] += 1
+        finally:
+            CounterBuffer._flushing = {}
+            CounterBuffer._flush_lock.release()
+
+    @staticmethod
+    def stats():
+        return dict(CounterBuffer._stats, pending_keys=len(CounterBuffer._pending))
+
+# Фоновая задача сброса счетчиков
+def flush_counters():
+    while True:
+        eventlet.sleep(COUNTER_FLUSH_INTERVAL)
+        try:
+            CounterBuffer.flush()
+        except Exception as e:
+            logger.error(f'Error in counter flush task: {e}')
+
+# ===== ПОСЛЕДОВАТЕЛЬНОСТИ ID =====
+
+# Сколько id воркер резервирует за одно обращение к хранилищу
+SEQUENCE_BLOCK_SIZE = 20
+
+class SequenceAllocator:
+    """Выдача id новых документов блоками.
+
+    Счетчики коллекций хранятся в коллекции sequences. Воркер атомарно
+    резервирует блок из SEQUENCE_BLOCK_SIZE значений и раздает их из
+    памяти, поэтому вставка не сканирует коллекцию, а два воркера не
+    получат одинаковый id. Неиспользованный остаток блока при
+    перезапуске пропадает - в id бывают пропуски.
+    """
+    # {collection: [next_id, last_id, pid]}
+    _blocks = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _seed(collection):
+        if collection in PARTITIONED_COLLECTIONS:
+            return lambda: max([d.get('id') or 0 for d in WeekPartitions.all(collection, active_only=False)],
+                               default=0)
+        return lambda: max([d.get('id') or 0 for d in DB._get_db(collection)], default=0)
+
+    @staticmethod
+    def _taken(collection, key):
+        if collection in PARTITIONED_COLLECTIONS:
+            return WeekPartitions.locate(collection, key, active_only=False)[0] is not None
+        return DB.backend.get(collection, key) is not None
+
+    @staticmethod
+    def next_id(collection):
+        with SequenceAllocator._lock:
+            while True:
+                block = SequenceAllocator._blocks.get(collection)
+                # Блок, унаследованный от родителя через fork, не используем
+                if not block or block[0] > block[1] or block[2] != os.getpid():
+                    start = DB.backend.reserve_sequence(
+                        collection, SEQUENCE_BLOCK_SIZE, SequenceAllocator._seed(collection))
+                    block = [start, start + SEQUENCE_BLOCK_SIZE - 1, os.getpid()]
+                    SequenceAllocator._blocks[collection] = block
+                new_id = block[0]
+                block[0] += 1
+                # Защита от id, занятых данными из восстановленного бэкапа
+                if not SequenceAllocator._taken(collection, new_id):
+                    return new_id
+
+# ===== НЕДЕЛЬНЫЕ ПАРТИЦИИ И АРХИВ =====
+
+# Коллекции, разбитые на недельные партиции, и срок жизни документа:
+# партиция, все документы которой старше срока, уходит в архив
+PARTITIONED_COLLECTIONS = {
+    'homeworks': timedelta(weeks=2)
+}
+ARCHIVE_FOLDER = os.path.join(DB_FOLDER, 'archive')
+ARCHIVE_INTERVAL = 3600
+
+class WeekPartitions:
+    """Коллекция, разбитая на партиции по неделе created_at документа.
+
+    Каждая партиция - отдельная коллекция бэкенда (homeworks_2026w42),
+    список живых партиций хранится в коллекции partitions. Чтения
+    затрагивают только партиции, пересекающиеся со сроком жизни.
+    Фоновый архиватор переносит истекшие партиции в сжатые файлы
+    ARCHIVE_FOLDER/<коллекция>/<неделя>.json.gz и удаляет их из бэкенда.
+    """
+
+    @staticmethod
+    def name(collection, moment):
+        year, week, _ = moment.isocalendar()
+        return f'{collection}_{year}w{week:02d}'
+
+    @staticmethod
+    def _register(collection, name):
+        """Заводит партицию в реестре, если ее там еще нет"""
+        if DB.backend.get('partitions', name):
+            return
+        match = PARTITION_NAME_RE.match(name)
+        starts_at = datetime.fromisocalendar(int(match.group(2)), int(match.group(3)), 1)
+        
+        def ensure(doc):
+            if doc is not None:
+                return None
+            return {
+                'name': name,
+                'collection': collection,
+                'starts_at': starts_at.isoformat(),
+                'ends_at': (starts_at + timedelta(weeks=1)).isoformat(),
+                'claimed_by': None,
+                'claimed_at': None
+            }
+        
+        DB.backend.update('partitions', name, ensure)
+
+    @staticmethod
+    def partitions(collection, active_only=True):
+        """Имена живых партиций коллекции, новые первыми"""
+        cutoff = (datetime.now() - PARTITIONED_COLLECTIONS[collection]).isoformat()
+        registry = [p for p in DB.backend.all('partitions') if p.get('collection') == collection]
+        if active_only:
+            registry = [p for p in registry if p['ends_at'] > cutoff]
+        return [p['name'] for p in sorted(registry, key=lambda p: p['starts_at'], reverse=True)]
+
+    @staticmethod
+    def all(collection, active_only=True):
+        docs = []
+        for name in WeekPartitions.partitions(collection, active_only):
+            docs.extend(DB.backend.all(name))
+        return docs
+
+    @staticmethod
+    def find(collection, field, value):
+        docs = []
+        for name in WeekPartitions.partitions(collection):
+            docs.extend(DB.backend.find(name, field, value))
+        return docs
+
+    @staticmethod
+    def locate(collection, key, active_only=True):
+        """Возвращает (партиция, документ) или (None, None)"""
+        for name in WeekPartitions.partitions(collection, active_only):
+            doc = DB.backend.get(name, key)
+            if doc is not None:
+                return name, doc
+        return None, None
+
+    @staticmethod
+    def put(collection, doc):
+        name = WeekPartitions.name(collection, datetime.fromisoformat(doc['created_at']))
+        WeekPartitions._register(collection, name)
+        DB.backend.put(name, doc)
+
+    @staticmethod
+    def _group(collection, docs):
+        groups = defaultdict(list)
+        for doc in docs:
+            groups[WeekPartitions.name(collection, datetime.fromisoformat(doc['created_at']))].append(doc)
+        return groups
+
+    @staticmethod
+    def replace(collection, docs):
+        """Полная замена живых партиций (восстановление из бэкапа)"""
+        groups = WeekPartitions._group(collection, docs)
+        for name in WeekPartitions.partitions(collection, active_only=False):
+            if name not in groups:
+                DB.backend.drop(name)
+                DB.backend.delete('partitions', name)
+        for name, group in groups.items():
+            WeekPartitions._register(collection, name)
+            DB.backend.replace(name, group)
+
+    @staticmethod
+    def migrate_legacy(collection):
+        """Раскладывает документы из неразбитой коллекции по партициям.
+
+        Запускается при импорте в каждом воркере, поэтому идет под
+        migration_lock и переносит документы по одному: документ попадает
+        в партицию, только если его там еще нет (уже перенесенный мог с тех
+        пор измениться), и сразу удаляется из исходной коллекции.
+        Прерванный перенос продолжается со следующего запуска.
+        """
+        with migration_lock(collection):
+            if not DB.backend.exists(collection):
+                return 0
+            docs = DB.backend.all(collection)
+            if not docs:
+                return 0
+            key_field = JournalStore.key_field(collection)
+            for name, group in WeekPartitions._group(collection, docs).items():
+                WeekPartitions._register(collection, name)
+                for doc in group:
+                    key = doc.get(key_field)
+                    DB.backend.update(name, key, lambda current, doc=doc: doc if current is None else None)
+                    DB.backend.delete(collection, key)
+            logger.info(f'Moved {len(docs)} documents of {collection} to weekly partitions')
+            return len(docs)
+
+    @staticmethod
+    def _archive_path(collection, name):
+        return os.path.join(ARCHIVE_FOLDER, collection, name[len(collection) + 1:] + '.json.gz')
+
+    @staticmethod
+    def _read_archive_file(path):
+        try:
+            with gzip.open(path, 'rb') as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def archive_expired(collection):
+        """Переносит истекшие партиции в архив; возвращает число партиций"""
+        cutoff = (datetime.now() - PARTITIONED_COLLECTIONS[collection]).isoformat()
+        token = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        archived = 0
+        for partition in DB.backend.all('partitions'):
+            if partition.get('collection') != collection or partition['ends_at'] > cutoff:
+                continue
+            
+            # Захватываем партицию, чтобы ее не архивировали два воркера сразу
+            def claim(doc):
+                if doc is None:
+                    return None
+                stale = (datetime.now() - timedelta(hours=1)).isoformat()
+                if doc.get('claimed_by') and (doc.get('claimed_at') or '') > stale:
+                    return None
+                doc['claimed_by'] = token
+                doc['claimed_at'] = datetime.now().isoformat()
+                return doc
+            
+            claimed = DB.backend.update('partitions', partition['name'], claim)
+            if not claimed or claimed['claimed_by'] != token:
+                continue
+            
+            name = partition['name']
+            path = WeekPartitions._archive_path(collection, name)
+            key_field = JournalStore.key_field(collection)
+            # Дописываем к уже существующему архиву недели (после восстановления бэкапа)
+            docs = {d.get(key_field): d for d in WeekPartitions._read_archive_file(path)}
+            live = DB.backend.all(name)
+            hooks = PARTITION_ARCHIVE_HOOKS.get(collection)
+            if hooks:
+                live = hooks[0](live)
+            docs.update((d.get(key_field), d) for d in live)
+            
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with gzip.open(tmp_path, 'wb') as f:
+                f.write(json.dumps(list(docs.values()), ensure_ascii=False).encode('utf-8'))
+            with open(tmp_path, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            
+            DB.backend.drop(name)
+            DB.backend.delete('partitions', name)
+            if hooks:
+                hooks[1](live)
+            archived += 1
+            logger.info(f'Archived partition {name}: {len(docs)} documents')
+        return archived
+
+    @staticmethod
+    def read_archive(collection, since=None, until=None):
+        """Документы из архивных недель, пересекающихся с [since, until)"""
+        folder = os.path.join(ARCHIVE_FOLDER, collection)
+        if not os.path.isdir(folder):
+            return []
+        docs = []
+        for filename in sorted(os.listdir(folder), reverse=True):
+            if not filename.endswith('.json.gz'):
+                continue
+            match = PARTITION_NAME_RE.match(f'{collection}_{filename[:-len(".json.gz")]}')
+            if not match:
+                continue
+            starts_at = datetime.fromisocalendar(int(match.group(2)), int(match.group(3)), 1)
+            if until and starts_at >= until:
+                continue
+            if since and starts_at + timedelta(weeks=1) <= since:
+                continue
+            docs.extend(WeekPartitions._read_archive_file(os.path.join(folder, filename)))
+        return docs
+
+# Фоновая архивация истекших партиций
+def archive_partitions():
+    while True:
+        eventlet.sleep(ARCHIVE_INTERVAL)
+        for collection in PARTITIONED_COLLECTIONS:
+            try:
+                WeekPartitions.archive_expired(collection)
+            except Exception as e:
+                logger.error(f'Error archiving partitions of {collection}: {e}')
+
+# ===== ВЕРСИИ ПРОИЗВОДНЫХ ИНДЕКСОВ =====
+
+# Сколько последних изменений помнит счетчик версий: воркер, отставший
+# не больше чем на столько, догружает только измененные документы
+CHANGE_LOG_RECENT = 200
+
+class ChangeLog:
+    """Счетчики изменений для индексов, которые каждый воркер держит в памяти.
+
+    Версия хранится в sequences (документ <name>_version) вместе со
+    списком ключей последних изменений и временем последнего изменения.
+    Ключ None означает "изменилось все" (перестроение, восстановление из
+    бэкапа).
+    """
+
+    @staticmethod
+    def bump(name, key):
+        def advance(doc):
+            value = (doc['value'] if doc else 0) + 1
+            recent = ((doc.get('recent') or []) if doc else []) + [[value, key]]
+            return {'name': f'{name}_version', 'value': value, 'recent': recent[-CHANGE_LOG_RECENT:],
+                    'changed_at': datetime.now().isoformat()}
+        DB.backend.update('sequences', f'{name}_version', advance)
+
+    @staticmethod
+    def bump_many(name, keys):
+        """Одно обращение к хранилищу на пачку ключей (каждый получает свою версию)"""
+        def advance(doc):
+            value = doc['value'] if doc else 0
+            recent = (doc.get('recent') or []) if doc else []
+            for key in keys:
+                value += 1
+                recent.append([value, key])
+            return {'name': f'{name}_version', 'value': value, 'recent': recent[-CHANGE_LOG_RECENT:],
+                    'changed_at': datetime.now().isoformat()}
+        if keys:
+            DB.backend.update('sequences', f'{name}_version', advance)
+
+    @staticmethod
+    def is_version_doc(doc):
+        """Документ версии в sequences (в бэкап не попадает: версии только растут)"""
+        return str(doc.get('name', '')).endswith('_version')
+
+    @staticmethod
+    def version(name):
+        doc = DB.backend.get('sequences', f'{name}_version')
+        return doc['value'] if doc else 0
+
+    @staticmethod
+    def changed_at(name):
+        """Время последнего изменения (одно на все воркеры) или None"""
+        doc = DB.backend.get('sequences', f'{name}_version')
+        return datetime.fromisoformat(doc['changed_at']) if doc and doc.get('changed_at') else None
+
+    @staticmethod
+    def changes(name, since):
+        """Возвращает (версия, ключи изменений после since); None вместо ключей - перечитать все"""
+        doc = DB.backend.get('sequences', f'{name}_version') or {'value': 0, 'recent': []}
+        if since is None:
+            return doc['value'], None
+        if doc['value'] == since:
+            return doc['value'], set()
+        recent = doc.get('recent') or []
+        keys = [key for value, key in recent if value > since]
+        if not recent or recent[0][0] > since + 1 or None in keys:
+            return doc['value'], None
+        return doc['value'], set(keys)
+
+# ===== ПОЛНОТЕКСТОВЫЙ ПОИСК ПО БЛОГУ =====
+
+# Параметры ранжирования BM25 и веса полей поста
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_FIELD_WEIGHTS = {'title': 6, 'tags': 3, 'excerpt': 1, 'content': 1}
+SEARCH_SNIPPET_WORDS = 30
+# Поля поста, изменение которых требует переиндексации
+BLOG_SEARCH_FIELDS = {'title', 'content', 'excerpt', 'tags', 'category', 'is_published', 'published_at'}
+SEARCH_MAX_SNIPPETS = 50
+
+SEARCH_TOKEN_RE = re.compile(r'[0-9a-zа-яё]+')
+SEARCH_HTML_TAG_RE = re.compile(r'<[^>]+>')
+SEARCH_STOP_WORDS = frozenset('''
+    и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне
+    было вот от меня еще нет о из ему теперь когда даже ну ли если уже или ни быть был него до вас
+    нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя
+    их чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого
+    какой совсем ним здесь этом один почти мой тем чтобы нее были куда зачем всех никогда можно при
+    об также это эти эта свой a an the and or of to in on for is are be with as at by it this that
+'''.split())
+
+class BlogSearchIndex:
+    """Инвертированный индекс опубликованных постов блога.
+
+    На каждый пост хранится документ коллекции blog_search с частотами
+    основ слов (русский и английский стеммеры Snowball) - он пишется при
+    сохранении, изменении и удалении поста, поэтому индекс не строится
+    заново при старте воркера. Чужие изменения воркер подгружает по
+    ChangeLog('blog_search').
+    """
+    # Состояние в памяти воркера
+    _version = None
+    _docs = {}
+    _postings = defaultdict(dict)
+    _total_length = 0
+    _stemmers = None
+    _stem_cache = {}
+    _lock = threading.RLock()
+
+    @staticmethod
+    def _stem(word):
+        stem = BlogSearchIndex._stem_cache.get(word)
+        if stem is not None:
+            return stem
+        if BlogSearchIndex._stemmers is None:
+            try:
+                import snowballstemmer
+                BlogSearchIndex._stemmers = {
+                    'ru': snowballstemmer.stemmer('russian'),
+                    'en': snowballstemmer.stemmer('english')
+                }
+            except ImportError:
+                logger.warning('snowballstemmer is not installed, blog search works without stemming')
+                BlogSearchIndex._stemmers = {}
+        stemmer = BlogSearchIndex._stemmers.get('en' if word.isascii() else 'ru')
+        stem = stemmer.stemWord(word) if stemmer else word
+        if len(BlogSearchIndex._stem_cache) < 100000:
+            BlogSearchIndex._stem_cache[word] = stem
+        return stem
+
+    @staticmethod
+    def _words(text):
+        return SEARCH_TOKEN_RE.findall((text or '').lower().replace('ё', 'е'))
+
+    @staticmethod
+    def tokenize(text):
+        """Основы значимых слов текста"""
+        return [BlogSearchIndex._stem(w) for w in BlogSearchIndex._words(text)
+                if w not in SEARCH_STOP_WORDS]
+
+    @staticmethod
+    def plain_text(content):
+        return html.unescape(SEARCH_HTML_TAG_RE.sub(' ', content or ''))
+
+    @staticmethod
+    def _vector(post, content):
+        fields = {
+            'title': post.get('title'),
+            'tags': ' '.join(post.get('tags') or []),
+            'excerpt': post.get('excerpt'),
+            'content': BlogSearchIndex.plain_text(content)
+        }
+        tf = defaultdict(int)
+        length = 0
+        for field, text in fields.items():
+            for stem in BlogSearchIndex.tokenize(text):
+                tf[stem] += SEARCH_FIELD_WEIGHTS[field]
+                length += 1
+        return {
+            'id': post['id'],
+            'tf': dict(tf),
+            'length': length,
+            'category': post.get('category'),
+            'tags': post.get('tags') or [],
+            'published_at': post.get('published_at') or post.get('created_at')
+        }
+
+    # --- Запись ---
+
+    @staticmethod
+    def index_post(post, content):
+        """Обновляет пост в индексе (неопубликованные посты из индекса убираются)"""
+        if not post.get('is_published'):
+            BlogSearchIndex.remove_post(post['id'])
+            return
+        DB.backend.put('blog_search', BlogSearchIndex._vector(post, content))
+        ChangeLog.bump('blog_search', post['id'])
+
+    @staticmethod
+    def remove_post(post_id):
+        if DB.backend.get('blog_search', post_id) is None:
+            return
+        DB.backend.delete('blog_search', post_id)
+        ChangeLog.bump('blog_search', post_id)
+
+    @staticmethod
+    def rebuild():
+        """Полное построение индекса по всем опубликованным постам"""
+        docs = [BlogSearchIndex._vector(p, DB.get_blog_post_content(p))
+                for p in DB._get_db('blog_posts') if p.get('is_published')]
+        DB.backend.replace('blog_search', docs)
+        ChangeLog.bump('blog_search', None)
+        logger.info(f'Blog search index rebuilt: {len(docs)} posts')
+        return len(docs)
+
+    # --- Состояние в памяти ---
+
+    @staticmethod
+    def _unset(post_id):
+        doc = BlogSearchIndex._docs.pop(post_id, None)
+        if doc is None:
+            return
+        BlogSearchIndex._total_length -= doc['length']
+        for stem in doc['tf']:
+            postings = BlogSearchIndex._postings.get(stem)
+            if postings is not None:
+                postings.pop(post_id, None)
+                if not postings:
+                    del BlogSearchIndex._postings[stem]
+
+    @staticmethod
+    def _set(doc):
+        BlogSearchIndex._unset(doc['id'])
+        BlogSearchIndex._docs[doc['id']] = doc
+        BlogSearchIndex._total_length += doc['length']
+        for stem, tf in doc['tf'].items():
+            BlogSearchIndex._postings[stem][doc['id']] = tf
+
+    @staticmethod
+    def _refresh():
+        version, changed = ChangeLog.changes('blog_search', BlogSearchIndex._version)
+        if changed is not None:
+            for post_id in changed:
+                doc = DB.backend.get('blog_search', post_id)
+                if doc is None:
+                    BlogSearchIndex._unset(post_id)
+                else:
+                    BlogSearchIndex._set(doc)
+        else:
+            BlogSearchIndex._docs = {}
+            BlogSearchIndex._postings = defaultdict(dict)
+            BlogSearchIndex._total_length = 0
+            for doc in DB.backend.all('blog_search'):
+                BlogSearchIndex._set(doc)
+        BlogSearchIndex._version = version
+
+    # --- Поиск ---
+
+    @staticmethod
+    def _query_terms(query):
+        """Основы слов запроса; последнее слово дополняется как префикс (поиск по мере ввода)"""
+        words = [w for w in BlogSearchIndex._words(query) if w not in SEARCH_STOP_WORDS]
+        terms = {BlogSearchIndex._stem(w) for w in words}
+        prefixes = set()
+        if words and len(words[-1]) >= 3:
+            last = words[-1]
+            prefixes = {stem for stem in BlogSearchIndex._postings
+                        if stem.startswith(last) or stem.startswith(BlogSearchIndex._stem(last))}
+        return terms | prefixes
+
+    @staticmethod
+    def search(query, category=None, tag=None):
+        """Ранжированный поиск.
+
+        Возвращает ([(post_id, score)], facets, terms); фасеты считаются по
+        всем найденным постам до фильтрации по категории и тегу.
+        """
+        with BlogSearchIndex._lock:
+            BlogSearchIndex._refresh()
+            terms = BlogSearchIndex._query_terms(query)
+            total = len(BlogSearchIndex._docs)
+            if not terms or not total:
+                return [], {'categories': {}, 'tags': {}}, terms
+            avg_length = BlogSearchIndex._total_length / total or 1
+
+            scores = defaultdict(float)
+            for term in terms:
+                postings = BlogSearchIndex._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for post_id, tf in postings.items():
+                    length = BlogSearchIndex._docs[post_id]['length']
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[post_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+            facets = {'categories': defaultdict(int), 'tags': defaultdict(int)}
+            results = []
+            for post_id, score in scores.items():
+                doc = BlogSearchIndex._docs[post_id]
+                facets['categories'][doc.get('category') or 'Общее'] += 1
+                for t in doc.get('tags') or []:
+                    facets['tags'][t] += 1
+                if category and doc.get('category') != category:
+                    continue
+                if tag and tag not in (doc.get('tags') or []):
+                    continue
+                results.append((post_id, score, doc.get('published_at') or ''))
+
+        results.sort(key=lambda r: (r[1], r[2]), reverse=True)
+        facets = {name: dict(sorted(counts.items(), key=lambda kv: -kv[1])) for name, counts in facets.items()}
+        return [(post_id, round(score, 4)) for post_id, score, _ in results], facets, terms
+
+    @staticmethod
+    def snippet(content, terms):
+        """Фрагмент текста вокруг первого совпадения; совпадения обернуты в <mark>"""
+        text = BlogSearchIndex.plain_text(content)
+        matches = list(re.finditer(r'[0-9A-Za-zА-Яа-яЁё]+', text))
+        if not matches:
+            return ''
+
+        def hit(m):
+            word = m.group(0).lower().replace('ё', 'е')
+            stem = BlogSearchIndex._stem(word)
+            return stem in terms or any(stem.startswith(t) for t in terms)
+
+        first = next((i for i, m in enumerate(matches) if hit(m)), None)
+        if first is None:
+            return ''
+        start = max(first - SEARCH_SNIPPET_WORDS // 3, 0)
+        window = matches[start:start + SEARCH_SNIPPET_WORDS]
+        parts = []
+        position = window[0].start()
+        for m in window:
+            parts.append(html.escape(text[position:m.start()]))
+            word = html.escape(m.group(0))
+            parts.append(f'<mark>{word}</mark>' if hit(m) else word)
+            position = m.end()
+        snippet = ' '.join(''.join(parts).split())
+        if start > 0:
+            snippet = '…' + snippet
+        if start + SEARCH_SNIPPET_WORDS < len(matches):
+            snippet += '…'
+        return snippet
+
+    @staticmethod
+    def stats():
+        return {
+            'version': BlogSearchIndex._version,
+            'posts': len(BlogSearchIndex._docs),
+            'terms': len(BlogSearchIndex._postings)
+        }
+
+# ===== ПОХОЖИЕ ПОСТЫ =====
+
+# Сколько соседей хранится на пост и веса составляющих сходства
+RELATED_POSTS_LIMIT = 6
+RELATED_WEIGHTS = {'tags': 0.4, 'category': 0.2, 'text': 0.4}
+# Поля поста, от которых зависит сходство
+RELATED_FIELDS = {'title', 'excerpt', 'tags', 'category', 'is_published'}
+
+class RelatedPosts:
+    """Похожие посты: теги (Жаккар), категория и TF-IDF заголовка и анонса (косинус).
+
+    Для каждого опубликованного поста в коллекции blog_related хранятся
+    его признаки и top-N соседей. После сохранения поста в фоне
+    пересчитываются его соседи и списки тех постов, в которые он входит
+    или теперь должен войти; страница поста только читает готовый список.
+    IDF при точечных обновлениях берется по текущему корпусу, полный
+    пересчет - flask rebuild-related.
+    """
+
+    @staticmethod
+    def _features(post):
+        terms = defaultdict(int)
+        for stem in BlogSearchIndex.tokenize(post.get('title')) + BlogSearchIndex.tokenize(post.get('excerpt')):
+            terms[stem] += 1
+        return {
+            'id': post['id'],
+            'terms': dict(terms),
+            'tags': post.get('tags') or [],
+            'category': post.get('category'),
+            'related': []
+        }
+
+    @staticmethod
+    def _vectors(docs):
+        """TF-IDF векторы и их нормы для всех документов"""
+        df = defaultdict(int)
+        for doc in docs.values():
+            for term in doc['terms']:
+                df[term] += 1
+        total = len(docs)
+        vectors = {}
+        for post_id, doc in docs.items():
+            vector = {t: tf * (math.log((1 + total) / (1 + df[t])) + 1) for t, tf in doc['terms'].items()}
+            vectors[post_id] = (vector, math.sqrt(sum(w * w for w in vector.values())) or 1)
+        return vectors
+
+    @staticmethod
+    def _score(a, b, vectors):
+        tags_a, tags_b = set(a['tags']), set(b['tags'])
+        union = tags_a | tags_b
+        tags = len(tags_a & tags_b) / len(union) if union else 0
+        category = 1 if a['category'] and a['category'] == b['category'] else 0
+        (va, na), (vb, nb) = vectors[a['id']], vectors[b['id']]
+        if len(va) > len(vb):
+            va, vb = vb, va
+        text = sum(w * vb.get(t, 0) for t, w in va.items()) / (na * nb)
+        return round(RELATED_WEIGHTS['tags'] * tags + RELATED_WEIGHTS['category'] * category +
+                     RELATED_WEIGHTS['text'] * text, 4)
+
+    @staticmethod
+    def _neighbours(doc, docs, vectors):
+        scored = ((RelatedPosts._score(doc, other, vectors), other_id)
+                  for other_id, other in docs.items() if other_id != doc['id'])
+        return [[post_id, score] for score, post_id in
+                heapq.nlargest(RELATED_POSTS_LIMIT, (s for s in scored if s[0] > 0))]
+
+    @staticmethod
+    def _set_related(post_id, related):
+        def apply(doc):
+            if doc is None:
+                return None
+            doc['related'] = related
+            return doc
+        DB.backend.update('blog_related', post_id, apply)
+        # Похожие посты есть в выгруженной странице поста
+        StaticBlogExport.schedule([post_id])
+
+    @staticmethod
+    def update_post(post_id):
+        """Пересчет после сохранения, изменения или удаления поста"""
+        post = DB.backend.get('blog_posts', post_id)
+        docs = {d['id']: d for d in DB.backend.all('blog_related')}
+        # Посты, в списках которых этот пост был: их списки пересчитываются целиком
+        affected = [d for d in docs.values() if d['id'] != post_id and
+                    any(r[0] == post_id for r in d.get('related') or [])]
+
+        if post is None or not post.get('is_published'):
+            if docs.pop(post_id, None) is not None:
+                DB.backend.delete('blog_related', post_id)
+            vectors = RelatedPosts._vectors(docs)
+            for doc in affected:
+                RelatedPosts._set_related(doc['id'], RelatedPosts._neighbours(doc, docs, vectors))
+        else:
+            doc = RelatedPosts._features(post)
+            docs[post_id] = doc
+            vectors = RelatedPosts._vectors(docs)
+            doc['related'] = RelatedPosts._neighbours(doc, docs, vectors)
+            DB.backend.put('blog_related', doc)
+            
+            affected_ids = {d['id'] for d in affected}
+            for other in list(docs.values()):
+                if other['id'] == post_id:
+                    continue
+                if other['id'] in affected_ids:
+                    RelatedPosts._set_related(other['id'], RelatedPosts._neighbours(other, docs, vectors))
+                    continue
+                # Пост входит в список соседа, если он лучше его худшего соседа
+                score = RelatedPosts._score(other, doc, vectors)
+                related = other.get('related') or []
+                if score > 0 and (len(related) < RELATED_POSTS_LIMIT or score > related[-1][1]):
+                    related = sorted(related + [[post_id, score]], key=lambda r: -r[1])[:RELATED_POSTS_LIMIT]
+                    RelatedPosts._set_related(other['id'], related)
+        
+        # Отрисованные страницы показывают похожие посты
+        ChangeLog.bump('blog_pages', post_id)
+
+    @staticmethod
+    def schedule(post_id):
+        """Пересчет вне запроса: сохранение поста его не ждет"""
+        def run():
+            try:
+                RelatedPosts.update_post(post_id)
+            except Exception as e:
+                logger.error(f'Error updating related posts for {post_id}: {e}')
+        eventlet.spawn(run)
+
+    @staticmethod
+    def rebuild():
+        """Полный пересчет соседей всех опубликованных постов"""
+        docs = {p['id']: RelatedPosts._features(p) for p in DB.backend.all('blog_posts') if p.get('is_published')}
+        vectors = RelatedPosts._vectors(docs)
+        for doc in docs.values():
+            doc['related'] = RelatedPosts._neighbours(doc, docs, vectors)
+        DB.backend.replace('blog_related', list(docs.values()))
+        ChangeLog.bump('blog_pages', None)
+        logger.info(f'Related posts rebuilt: {len(docs)} posts')
+        return len(docs)
+
+    @staticmethod
+    def get(post_id, limit=None):
+        """[(id, score)] соседей поста"""
+        doc = DB.backend.get('blog_related', post_id)
+        related = doc.get('related') or [] if doc else []
+        return related[:limit] if limit else related
+
+# ===== УПОРЯДОЧЕННЫЙ СПИСОК ПОСТОВ =====
+
+class BlogOrderIndex:
+    """Посты блога в порядке выдачи: закрепленные, затем по дате публикации.
+
+    Каждый воркер держит в памяти отсортированный список ключей
+    (0 для закрепленных / 1, -время публикации, -id) и обновляет его
+    точечно по ChangeLog('blog_posts'). Страница - бинарный поиск позиции
+    курсора и проход вперед на размер страницы. Курсор - ключ последнего
+    поста страницы, поэтому новые посты не сдвигают следующие страницы.
+    """
+    _version = None
+    _keys = []
+    # {post_id: {'key', 'category', 'tags', 'is_published'}}
+    _entries = {}
+    _lock = threading.RLock()
+
+    @staticmethod
+    def _key(post):
+        moment = post.get('published_at') or post.get('created_at')
+        try:
+            timestamp = datetime.fromisoformat(moment).timestamp() if moment else 0
+        except ValueError:
+            timestamp = 0
+        return (0 if post.get('is_pinned') else 1, -timestamp, -post['id'])
+
+    @staticmethod
+    def _unset(post_id):
+        entry = BlogOrderIndex._entries.pop(post_id, None)
+        if entry is None:
+            return
+        i = bisect.bisect_left(BlogOrderIndex._keys, entry['key'])
+        if i < len(BlogOrderIndex._keys) and BlogOrderIndex._keys[i] == entry['key']:
+            del BlogOrderIndex._keys[i]
+
+    @staticmethod
+    def _set(post):
+        BlogOrderIndex._unset(post['id'])
+        key = BlogOrderIndex._key(post)
+        BlogOrderIndex._entries[post['id']] = {
+            'key': key,
+            'category': post.get('category'),
+            'tags': post.get('tags') or [],
+            'is_published': bool(post.get('is_published'))
+        }
+        bisect.insort(BlogOrderIndex._keys, key)
+
+    @staticmethod
+    def _refresh():
+        version, changed = ChangeLog.changes('blog_posts', BlogOrderIndex._version)
+        if changed is not None:
+            for post_id in changed:
+                post = DB.backend.get('blog_posts', post_id)
+                if post is None:
+                    BlogOrderIndex._unset(post_id)
+                else:
+                    BlogOrderIndex._set(post)
+        else:
+            posts = DB._get_db('blog_posts')
+            BlogOrderIndex._entries = {}
+            BlogOrderIndex._keys = []
+            for post in posts:
+                BlogOrderIndex._set(post)
+        BlogOrderIndex._version = version
+
+    @staticmethod
+    def encode_cursor(key):
+        return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Ключ из курсора; ValueError, если курсор поврежден"""
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (ValueError, TypeError) as e:
+            raise ValueError('Invalid cursor') from e
+        if not isinstance(key, list) or len(key) != 3 or \
+                not all(isinstance(v, (int, float)) for v in key):
+            raise ValueError('Invalid cursor')
+        return tuple(key)
+
+    @staticmethod
+    def page(category=None, tag=None, published_only=False, cursor=None, limit=None):
+        """Возвращает (id постов страницы, курсор следующей страницы или None)"""
+        def matches(entry):
+            return (not published_only or entry['is_published']) and \
+                (not category or entry['category'] == category) and \
+                (not tag or tag in entry['tags'])
+
+        with BlogOrderIndex._lock:
+            BlogOrderIndex._refresh()
+            keys = BlogOrderIndex._keys
+            start = bisect.bisect_right(keys, BlogOrderIndex.decode_cursor(cursor)) if cursor else 0
+            ids = []
+            for i in range(start, len(keys)):
+                post_id = -keys[i][2]
+                if not matches(BlogOrderIndex._entries[post_id]):
+                    continue
+                if limit and len(ids) == limit:
+                    # Есть хотя бы еще один пост - отдаем курсор
+                    last = BlogOrderIndex._entries[ids[-1]]['key']
+                    return ids, BlogOrderIndex.encode_cursor(list(last))
+                ids.append(post_id)
+            return ids, None
+
+    @staticmethod
+    def tag_counts(published_only=True):
+        with BlogOrderIndex._lock:
+            BlogOrderIndex._refresh()
+            counts = defaultdict(int)
+            for entry in BlogOrderIndex._entries.values():
+                if published_only and not entry['is_published']:
+                    continue
+                for t in entry['tags']:
+                    counts[t] += 1
+            return dict(counts)
+
+# ===== ВЕТКИ КОММЕНТАРИЕВ =====
+
+class CommentThreads:
+    """Порядок веток комментариев по постам для постраничной выдачи.
+
+    Каждый воркер держит в памяти для каждого поста отсортированный
+    список id комментариев верхнего уровня и для каждого комментария -
+    список id ответов; обновляются точечно по ChangeLog('blog_comments').
+    Страница - бинарный поиск после курсора и чтение только комментариев
+    страницы. Ответы на удаленный или чужой комментарий - на верхнем уровне.
+    """
+    _version = None
+    # {comment_id: (post_id, parent_id или None для верхнего уровня)}
+    _entries = {}
+    _roots = defaultdict(list)
+    _replies = defaultdict(list)
+    _lock = threading.RLock()
+
+    @staticmethod
+    def _discard(ids, comment_id):
+        i = bisect.bisect_left(ids, comment_id)
+        if i < len(ids) and ids[i] == comment_id:
+            del ids[i]
+
+    @staticmethod
+    def _unset(comment_id):
+        entry = CommentThreads._entries.pop(comment_id, None)
+        if entry is None:
+            return
+        post_id, parent_id = entry
+        if parent_id is None:
+            CommentThreads._discard(CommentThreads._roots[post_id], comment_id)
+        else:
+            CommentThreads._discard(CommentThreads._replies[parent_id], comment_id)
+        # Ответы удаленного комментария поднимаются на верхний уровень
+        for reply_id in CommentThreads._replies.pop(comment_id, []):
+            CommentThreads._entries[reply_id] = (post_id, None)
+            bisect.insort(CommentThreads._roots[post_id], reply_id)
+
+    @staticmethod
+    def _set(comment):
+        comment_id = comment['id']
+        post_id = comment['post_id']
+        if comment_id in CommentThreads._entries:
+            # Повторная запись: ответы остаются при своем родителе
+            replies = CommentThreads._replies.pop(comment_id, [])
+            CommentThreads._unset(comment_id)
+            if replies:
+                CommentThreads._replies[comment_id] = replies
+        parent_id = comment.get('parent_id')
+        parent = CommentThreads._entries.get(parent_id)
+        if parent is None or parent_id == comment_id or parent[0] != post_id:
+            parent_id = None
+            bisect.insort(CommentThreads._roots[post_id], comment_id)
+        else:
+            bisect.insort(CommentThreads._replies[parent_id], comment_id)
+        CommentThreads._entries[comment_id] = (post_id, parent_id)
+
+    @staticmethod
+    def _refresh():
+        version, changed = ChangeLog.changes('blog_comments', CommentThreads._version)
+        if changed is not None:
+            # По возрастанию id: родитель раньше ответа
+            for comment_id in sorted(changed):
+                comment = DB.backend.get('blog_comments', comment_id)
+                if comment is None:
+                    CommentThreads._unset(comment_id)
+                else:
+                    CommentThreads._set(comment)
+        else:
+            comments = sorted(DB._get_db('blog_comments'), key=lambda c: c['id'])
+            CommentThreads._entries = {}
+            CommentThreads._roots = defaultdict(list)
+            CommentThreads._replies = defaultdict(list)
+            for comment in comments:
+                CommentThreads._set(comment)
+        CommentThreads._version = version
+
+    @staticmethod
+    def _tree(comment_id):
+        return comment_id, [CommentThreads._tree(reply_id) for reply_id in CommentThreads._replies.get(comment_id, [])]
+
+    @staticmethod
+    def page(post_id, after=None, limit=None):
+        """([(id, [поддеревья ответов])] веток после after, id для следующей страницы или None)"""
+        with CommentThreads._lock:
+            CommentThreads._refresh()
+            roots = CommentThreads._roots.get(post_id, [])
+            start = bisect.bisect_right(roots, after) if after is not None else 0
+            end = start + limit if limit else len(roots)
+            threads = [CommentThreads._tree(comment_id) for comment_id in roots[start:end]]
+            return threads, (roots[end - 1] if end < len(roots) else None)
+
+# ===== АГРЕГАТЫ БЛОГА =====
+
+# Сколько популярных и последних постов держится в памяти (максимальный limit)
+BLOG_TOP_POSTS = 20
+
+class BlogAggregates:
+    """Категории, популярные и последние посты без прохода по всем постам.
+
+    Каждый воркер держит в памяти число опубликованных постов по
+    категориям, min-кучу из BLOG_TOP_POSTS самых просматриваемых постов и
+    кольцо последних опубликованных. Обновляются точечно по
+    ChangeLog('blog_posts') (запись поста) и ChangeLog('blog_views')
+    (сброс просмотров в CounterBuffer). Если из кучи или кольца уходит
+    пост, они заново набираются по записям в памяти.
+    """
+    _versions = {'blog_posts': None, 'blog_views': None}
+    # {post_id: {'category', 'views', 'moment'}} - только опубликованные
+    _entries = {}
+    _categories = defaultdict(int)
+    # [(views, id)], в корне - наименее просматриваемый из топа
+    _popular = []
+    # [(moment, id)] от новых к старым
+    _recent = deque(maxlen=BLOG_TOP_POSTS)
+    _lock = threading.RLock()
+
+    @staticmethod
+    def _fill_popular():
+        entries = BlogAggregates._entries
+        BlogAggregates._popular = heapq.nlargest(BLOG_TOP_POSTS, ((e['views'], i) for i, e in entries.items()))
+        heapq.heapify(BlogAggregates._popular)
+
+    @staticmethod
+    def _fill_recent():
+        entries = BlogAggregates._entries
+        BlogAggregates._recent = deque(heapq.nlargest(BLOG_TOP_POSTS, ((e['moment'], i) for i, e in entries.items())),
+                                       maxlen=BLOG_TOP_POSTS)
+
+    @staticmethod
+    def _unset(post_id):
+        entry = BlogAggregates._entries.pop(post_id, None)
+        if entry is None:
+            return
+        BlogAggregates._categories[entry['category']] -= 1
+        if not BlogAggregates._categories[entry['category']]:
+            del BlogAggregates._categories[entry['category']]
+        if (entry['views'], post_id) in BlogAggregates._popular:
+            BlogAggregates._fill_popular()
+        if (entry['moment'], post_id) in BlogAggregates._recent:
+            BlogAggregates._fill_recent()
+
+    @staticmethod
+    def _entry(post):
+        return {
+            'category': post.get('category', 'Без категории'),
+            'views': post.get('views', 0),
+            'moment': post.get('published_at') or post.get('created_at') or ''
+        }
+
+    @staticmethod
+    def _set(post):
+        post_id = post['id']
+        old = BlogAggregates._entries.get(post_id)
+        entry = BlogAggregates._entry(post)
+        if old == entry:
+            return
+        if old is not None and (old['category'] != entry['category'] or old['moment'] != entry['moment']):
+            # Сменились категория или дата: проще убрать пост и добавить заново
+            BlogAggregates._unset(post_id)
+            old = None
+        BlogAggregates._entries[post_id] = entry
+        if old is None:
+            BlogAggregates._categories[entry['category']] += 1
+
+        popular = BlogAggregates._popular
+        if old is not None and (old['views'], post_id) in popular:
+            if entry['views'] < old['views']:
+                BlogAggregates._fill_popular()
+            else:
+                popular[popular.index((old['views'], post_id))] = (entry['views'], post_id)
+                heapq.heapify(popular)
+        elif len(popular) < BLOG_TOP_POSTS:
+            heapq.heappush(popular, (entry['views'], post_id))
+        elif (entry['views'], post_id) > popular[0]:
+            heapq.heapreplace(popular, (entry['views'], post_id))
+
+        recent = BlogAggregates._recent
+        if old is None:
+            if not recent or (entry['moment'], post_id) > recent[0]:
+                recent.appendleft((entry['moment'], post_id))
+            elif len(recent) < BLOG_TOP_POSTS or (entry['moment'], post_id) > recent[-1]:
+                BlogAggregates._fill_recent()
+
+    @staticmethod
+    def _apply(post_id):
+        post = DB.backend.get('blog_posts', post_id)
+        if post is None or not post.get('is_published'):
+            BlogAggregates._unset(post_id)
+        else:
+            BlogAggregates._set(post)
+
+    @staticmethod
+    def _refresh():
+        versions = BlogAggregates._versions
+        posts_version, posts_changed = ChangeLog.changes('blog_posts', versions['blog_posts'])
+        views_version, views_changed = ChangeLog.changes('blog_views', versions['blog_views'])
+        if posts_changed is None or views_changed is None:
+            BlogAggregates._entries = {}
+            BlogAggregates._categories = defaultdict(int)
+            for post in DB._get_db('blog_posts'):
+                if post.get('is_published'):
+                    entry = BlogAggregates._entry(post)
+                    BlogAggregates._entries[post['id']] = entry
+                    BlogAggregates._categories[entry['category']] += 1
+            BlogAggregates._fill_popular()
+            BlogAggregates._fill_recent()
+        else:
+            for post_id in posts_changed | views_changed:
+                BlogAggregates._apply(post_id)
+        BlogAggregates._versions = {'blog_posts': posts_version, 'blog_views': views_version}
+
+    @staticmethod
+    def categories():
+        with BlogAggregates._lock:
+            BlogAggregates._refresh()
+            return dict(BlogAggregates._categories)
+
+    @staticmethod
+    def popular(limit=5):
+        """id самых просматриваемых постов"""
+        with BlogAggregates._lock:
+            BlogAggregates._refresh()
+            return [post_id for views, post_id in heapq.nlargest(limit, BlogAggregates._popular)]
+
+    @staticmethod
+    def recent(limit=5):
+        """id последних опубликованных постов"""
+        with BlogAggregates._lock:
+            BlogAggregates._refresh()
+            return [post_id for moment, post_id in list(BlogAggregates._recent)[:limit]]
+
+    @staticmethod
+    def rebuild():
+        """Заставляет все воркеры пересчитать агрегаты с нуля"""
+        ChangeLog.bump('blog_views', None)
+        with BlogAggregates._lock:
+            BlogAggregates._refresh()
+            return len(BlogAggregates._entries)
+
+    @staticmethod
+    def stats():
+        with BlogAggregates._lock:
+            return {
+                'posts': len(BlogAggregates._entries),
+                'categories': len(BlogAggregates._categories),
+                'popular': len(BlogAggregates._popular),
+                'recent': len(BlogAggregates._recent)
+            }
+
+# ===== КЭШ ОТРИСОВАННЫХ СТРАНИЦ БЛОГА =====
+
+# Число страниц в кэше воркера (страница поста ~40 КБ)
+PAGE_CACHE_SIZE = 200
+# Счетчики в HTML подставляются при каждой отдаче, а не хранятся в кэше
+PAGE_COUNTER_MARKERS = {'views': '@@views@@', 'comments_count': '@@comments_count@@'}
+# Эндпоинты, которые сами задают Cache-Control (см. add_security_headers)
+CACHEABLE_PAGE_ENDPOINTS = {'blog', 'blog_post', 'blog_feed', 'sitemap'}
+
+class PageCache:
+    """Отрисованный HTML публичных страниц блога.
+
+    Ключ - (страница, роль посетителя); запись действительна, пока не
+    сменились версии ChangeLog('blog_posts') и ChangeLog('blog_pages'),
+    которые поднимают методы записи постов и смена аватара. ETag - хеш
+    HTML без счетчиков, поэтому браузер и nginx могут переспрашивать
+    страницу условным GET и получать 304.
+    """
+    _entries = OrderedDict()
+    _stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+    @staticmethod
+    def role():
+        return session['user']['role'] if 'user' in session else 'guest'
+
+    @staticmethod
+    def version():
+        return (ChangeLog.version('blog_posts'), ChangeLog.version('blog_pages'))
+
+    @staticmethod
+    def get(key):
+        entry = PageCache._entries.get(key)
+        if entry is None or entry['version'] != PageCache.version():
+            PageCache._stats['misses'] += 1
+            return None
+        PageCache._entries.move_to_end(key)
+        PageCache._stats['hits'] += 1
+        return entry
+
+    @staticmethod
+    def put(key, body, last_modified=None):
+        entry = {
+            'version': PageCache.version(),
+            'body': body,
+            'etag': hashlib.sha1(body.encode('utf-8')).hexdigest()[:20],
+            'last_modified': last_modified or datetime.now()
+        }
+        PageCache._entries[key] = entry
+        PageCache._entries.move_to_end(key)
+        while len(PageCache._entries) > PAGE_CACHE_SIZE:
+            PageCache._entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def respond(entry, counters=None, max_age=0):
+        """Ответ из записи кэша: 304 на условный запрос или HTML с подставленными счетчиками"""
+        # Слабый валидатор: счетчики в теле могут отличаться
+        etag = f'W/"{entry["etag"]}"'
+        last_modified = entry['last_modified'].replace(microsecond=0)
+        not_modified = etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]
+        if not not_modified and 'If-None-Match' not in request.headers and request.if_modified_since:
+            not_modified = last_modified.astimezone(timezone.utc) <= request.if_modified_since
+
+        if not_modified:
+            PageCache._stats['not_modified'] += 1
+            response = app.response_class(status=304)
+        else:
+            body = entry['body']
+            for field, value in (counters or {}).items():
+                body = body.replace(PAGE_COUNTER_MARKERS[field], str(value or 0))
+            response = app.response_class(body, mimetype='text/html')
+
+        response.headers['ETag'] = etag
+        response.last_modified = last_modified.astimezone(timezone.utc)
+        # Гостевые страницы одинаковы для всех - их можно хранить и в общем кэше;
+        # no-cache / max-age=0 заставляет переспрашивать, и каждый просмотр доходит до счетчика
+        scope = 'public' if PageCache.role() == 'guest' else 'private'
+        response.headers['Cache-Control'] = f'{scope}, max-age={max_age}, must-revalidate' \
+            if max_age else f'{scope}, no-cache'
+        response.headers['Vary'] = 'Cookie'
+        return response
+
+    @staticmethod
+    def stats():
+        return dict(PageCache._stats, entries=len(PageCache._entries), pid=os.getpid())
+
+# ===== RSS И SITEMAP =====
+
+# Адрес сайта для абсолютных ссылок (не из заголовка Host запроса)
+SITE_URL = os.environ.get('SITE_URL', 'https://zindaki-edu.ru').rstrip('/')
+FEED_POSTS = 20
+FEED_TITLE = 'Блог Zindaki Academy'
+# Публичные страницы сайта помимо постов
+SITEMAP_PAGES = ['/', '/about', '/teachers', '/programs', '/testimonials', '/contact', '/blog']
+# Поля, от которых зависят RSS и sitemap
+FEED_FIELDS = {'title', 'excerpt', 'slug', 'category', 'is_published', 'published_at'}
+
+class BlogFeeds:
+    """Готовые RSS-лента и sitemap.xml.
+
+    Документы собираются один раз после изменения опубликованных постов
+    (ChangeLog('blog_feeds'), его поднимают публикация, правка и снятие с
+    публикации) и хранятся в памяти воркера вместе со сжатой gzip копией.
+    Валидаторы строгие: тело одинаково для всех посетителей.
+    Last-Modified - время последнего изменения ChangeLog('blog_feeds'), а
+    не максимум updated_at постов: после снятия поста с публикации он
+    не должен уменьшаться.
+    """
+    # {имя документа: {'body', 'gzip', 'etag', 'last_modified'}}
+    _documents = {}
+    _version = None
+    _changed_at = None
+    _lock = threading.Lock()
+    _stats = {'builds': 0, 'hits': 0, 'not_modified': 0}
+
+    @staticmethod
+    def _moment(value):
+        try:
+            return datetime.fromisoformat(value) if value else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _entry(body, last_modified):
+        body = body.encode('utf-8')
+        return {
+            'body': body,
+            'gzip': gzip.compress(body, 9),
+            'etag': hashlib.sha1(body).hexdigest()[:20],
+            'last_modified': (last_modified or datetime.now()).replace(microsecond=0)
+        }
+
+    @staticmethod
+    def _build_feed(base):
+        posts = [p for p in (DB.backend.get('blog_posts', post_id) for post_id in BlogAggregates.recent(FEED_POSTS)) if p]
+        items = []
+        for post in posts:
+            link = f'{base}/blog/post/{quote(post["slug"])}'
+            published = BlogFeeds._moment(post.get('published_at') or post.get('created_at')) or datetime.now()
+            items.append(
+                '<item>'
+                f'<title>{html.escape(post.get("title") or "")}</title>'
+                f'<link>{html.escape(link)}</link>'
+                f'<guid isPermaLink="true">{html.escape(link)}</guid>'
+                f'<pubDate>{email.utils.format_datetime(published.astimezone())}</pubDate>'
+                f'<category>{html.escape(post.get("category") or "")}</category>'
+                f'<description>{html.escape(post.get("excerpt") or "")}</description>'
+                '</item>')
+        last_modified = BlogFeeds._changed_at
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"><channel>'
+            f'<title>{html.escape(FEED_TITLE)}</title>'
+            f'<link>{html.escape(base)}/blog</link>'
+            f'<atom:link href="{html.escape(base)}/blog/feed.xml" rel="self" type="application/rss+xml"/>'
+            f'<description>{html.escape(FEED_TITLE)}</description>'
+            '<language>ru</language>'
+            + (f'<lastBuildDate>{email.utils.format_datetime(last_modified.astimezone())}</lastBuildDate>'
+               if last_modified else '')
+            + ''.join(items) + '</channel></rss>\n')
+        return BlogFeeds._entry(body, last_modified)
+
+    @staticmethod
+    def _build_sitemap(base):
+        ids, _ = BlogOrderIndex.page(published_only=True)
+        posts = [p for p in (DB.backend.get('blog_posts', post_id) for post_id in ids) if p]
+        urls = [f'<url><loc>{html.escape(base + path)}</loc></url>' for path in SITEMAP_PAGES]
+        for post in posts:
+            updated = BlogFeeds._moment(post.get('updated_at') or post.get('created_at'))
+            urls.append(f'<url><loc>{html.escape(base + "/blog/post/" + quote(post["slug"]))}</loc>'
+                        + (f'<lastmod>{updated.date().isoformat()}</lastmod>' if updated else '') + '</url>')
+        last_modified = BlogFeeds._changed_at
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                + ''.join(urls) + '</urlset>\n')
+        return BlogFeeds._entry(body, last_modified)
+
+    @staticmethod
+    def get(name):
+        """Готовый документ 'feed' или 'sitemap' (собирается после изменений)"""
+        with BlogFeeds._lock:
+            version = ChangeLog.version('blog_feeds')
+            if version != BlogFeeds._version:
+                BlogFeeds._documents = {}
+                BlogFeeds._version = version
+                BlogFeeds._changed_at = ChangeLog.changed_at('blog_feeds') or datetime.now()
+            entry = BlogFeeds._documents.get(name)
+            if entry is None:
+                build = BlogFeeds._build_feed if name == 'feed' else BlogFeeds._build_sitemap
+                entry = BlogFeeds._documents[name] = build(SITE_URL)
+                BlogFeeds._stats['builds'] += 1
+            else:
+                BlogFeeds._stats['hits'] += 1
+            return entry
+
+    @staticmethod
+    def respond(entry, mimetype):
+        """Ответ с ETag/Last-Modified; сжатая копия - клиентам, принимающим gzip"""
+        compressed = request.accept_encodings['gzip'] > 0
+        etag = f'"{entry["etag"]}-gz"' if compressed else f'"{entry["etag"]}"'
+        last_modified = entry['last_modified'].astimezone(timezone.utc)
+        not_modified = etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]
+        if not not_modified and 'If-None-Match' not in request.headers and request.if_modified_since:
+            not_modified = last_modified <= request.if_modified_since
+
+        if not_modified:
+            BlogFeeds._stats['not_modified'] += 1
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(entry['gzip'] if compressed else entry['body'], mimetype=mimetype)
+            if compressed:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.headers['ETag'] = etag
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'public, max-age=300'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    @staticmethod
+    def changed(post, was_published=False):
+        """Поднимает версию, если пост опубликован сейчас или был опубликован"""
+        if was_published or (post and post.get('is_published')):
+            ChangeLog.bump('blog_feeds', post['id'] if post else None)
+
+    @staticmethod
+    def stats():
+        return dict(BlogFeeds._stats, documents=len(BlogFeeds._documents))
+
+# ===== ХРАНИЛИЩЕ ФАЙЛОВ ПО СОДЕРЖИМОМУ =====
+
+# Файлы лежат в uploads/cas/<2 символа>/<2 символа>/<sha256><.расширение>
+CAS_FOLDER = os.path.join(UPLOAD_FOLDER, 'cas')
+CAS_TMP_FOLDER = os.path.join(CAS_FOLDER, '.tmp')
+
+class ContentStore:
+    """Загруженные файлы, адресуемые по SHA-256 содержимого.
+
+    Одинаковое содержимое хранится на диске один раз. file_blobs
+    (ключ sha256) - физический файл и число ссылок на него, file_refs
+    (ключ id) - логический файл: исходное имя, владелец, вид. Хеш
+    считается при потоковой записи загрузки во временный файл; если такой
+    blob уже есть, временный файл удаляется. Добавление ссылки и удаление
+    blob с последней ссылкой выполняются под общей блокировкой
+    (flock), поэтому одновременная загрузка того же файла не потеряет его.
+    """
+
+    _lock = threading.Lock()
+
+    @staticmethod
+    @contextmanager
+    def _locked():
+        """Блокировка между воркерами; внутри воркера сначала берем зеленую
+        блокировку, затем flock без остановки хаба"""
+        os.makedirs(CAS_FOLDER, exist_ok=True)
+        with ContentStore._lock, open(os.path.join(CAS_FOLDER, '.lock'), 'a') as lock_file:
+            flock_exclusive(lock_file)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _relative_path(sha256, name):
+        ext = name.rsplit('.', 1)[1].lower() if '.' in name else ''
+        filename = f'{sha256}.{ext}' if ext.isalnum() and len(ext) <= 8 else sha256
+        return '/'.join(['cas', sha256[:2], sha256[2:4], filename])
+
+    @staticmethod
+    def path(blob):
+        """Путь к файлу blob на диске"""
+        return os.path.join(UPLOAD_FOLDER, blob['path'])
+
+    @staticmethod
+    def _hash_file(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _link(sha256, size, name, tmp_path=None):
+        """+1 ссылка на blob; файл из tmp_path становится blob, если его еще нет"""
+        relative_path = ContentStore._relative_path(sha256, name)
+
+        def acquire(blob):
+            if blob is None:
+                return {'sha256': sha256, 'size': size, 'path': relative_path, 'refcount': 1,
+                        'created_at': datetime.now().isoformat()}
+            blob['refcount'] = (blob.get('refcount') or 0) + 1
+            return blob
+
+        with ContentStore._locked():
+            blob = DB._update('file_blobs', sha256, acquire)
+            path = ContentStore.path(blob)
+            if os.path.exists(path):
+                if tmp_path:
+                    os.remove(tmp_path)
+            elif tmp_path:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            else:
+                blob = DB._update('file_blobs', sha256, StorageBackend._incrementer({'refcount': -1}))
+                if blob is not None and blob['refcount'] == 0:
+                    DB._delete('file_blobs', sha256)
+                raise FileNotFoundError(f'Blob {sha256} is missing')
+        return blob
+
+    @staticmethod
+    def _add_ref(blob, name, owner, kind):
+        ref = {
+            'id': uuid.uuid4().hex,
+            'sha256': blob['sha256'],
+            'name': name,
+            'size': blob['size'],
+            'owner': owner,
+            'kind': kind,
+            'created_at': datetime.now().isoformat()
+        }
+        DB._put('file_refs', ref)
+        return ContentStore.describe(ref, blob)
+
+    @staticmethod
+    def describe(ref, blob=None):
+        """Описание файла для документов: id ссылки, имя, размер, URL"""
+        blob = blob or DB.backend.get('file_blobs', ref['sha256'])
+        return {
+            'id': ref['id'],
+            'name': ref['name'],
+            'size': ref['size'],
+            'sha256': ref['sha256'],
+            'path': ContentStore.path(blob),
+            'url': f'/files/{ref["id"]}/{quote(ref["name"])}'
+        }
+
+    @staticmethod
+    def public_url(file):
+        """Прямая ссылка на blob (для изображений: отдает nginx, кэшируется навсегда)"""
+        return url_for('uploaded_file', filename=os.path.relpath(file['path'], UPLOAD_FOLDER).replace(os.sep, '/'),
+                       _external=True)
+
+    @staticmethod
+    def put_file(file, owner, kind, name=None):
+        """Сохраняет FileStorage, считая хеш при потоковой записи"""
+        name = secure_filename(name or file.filename) or 'file'
+        os.makedirs(CAS_TMP_FOLDER, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=CAS_TMP_FOLDER)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in iter(lambda: file.stream.read(64 * 1024), b''):
+                    digest.update(block)
+                    f.write(block)
+                    size += len(block)
+            blob = ContentStore._link(digest.hexdigest(), size, name, tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return ContentStore._add_ref(blob, name, owner, kind)
+
+    @staticmethod
+    def put_path(path, name, owner, kind, sha256=None):
+        """Забирает готовый файл (например, собранную загрузку по частям)"""
+        name = secure_filename(name) or 'file'
+        sha256 = sha256 or ContentStore._hash_file(path)
+        try:
+            blob = ContentStore._link(sha256, os.path.getsize(path), name, path)
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return ContentStore._add_ref(blob, name, owner, kind)
+
+    @staticmethod
+    def has_blob(sha256):
+        blob = DB.backend.get('file_blobs', (sha256 or '').lower())
+        return blob is not None and os.path.exists(ContentStore.path(blob))
+
+    @staticmethod
+    def put_existing(sha256, name, owner, kind):
+        """Новая ссылка на уже сохраненное содержимое - без записи на диск"""
+        name = secure_filename(name) or 'file'
+        blob = ContentStore._link(sha256.lower(), None, name)
+        return ContentStore._add_ref(blob, name, owner, kind)
+
+    @staticmethod
+    def get_ref(ref_id):
+        return DB.backend.get('file_refs', ref_id)
+
+    @staticmethod
+    def release(ref_id):
+        """Удаляет ссылку; blob без ссылок удаляется с диска"""
+        ref = DB.backend.get('file_refs', ref_id) if ref_id else None
+        if ref is None:
+            return False
+        DB._delete('file_refs', ref_id)
+        with ContentStore._locked():
+            blob = DB._update('file_blobs', ref['sha256'], StorageBackend._incrementer({'refcount': -1}))
+            if blob is not None and blob['refcount'] == 0:
+                DB._delete('file_blobs', blob['sha256'])
+                path = ContentStore.path(blob)
+                if os.path.exists(path):
+                    os.remove(path)
+                # Уменьшенные копии изображения (см. ImageVariants) общие для всех ссылок
+                folder = os.path.dirname(path)
+                for filename in os.listdir(folder) if os.path.isdir(folder) else []:
+                    if filename.startswith(f'{blob["sha256"]}__'):
+                        os.remove(os.path.join(folder, filename))
+        return True
+
+    @staticmethod
+    def release_files(files, keep=()):
+        """Освобождает ссылки из списка описаний файлов (кроме id из keep)"""
+        for file in files or []:
+            if file.get('id') and file['id'] not in keep:
+                ContentStore.release(file['id'])
+
+# ===== ПРОИЗВОДНЫЕ ИЗОБРАЖЕНИЙ =====
+
+# Ширины вариантов (px) для обложек постов и аватаров; больше оригинала не увеличиваем
+IMAGE_VARIANT_WIDTHS = {
+    'cover': {'thumb': 320, 'card': 640, 'full': 1280},
+    'avatar': {'thumb': 64, 'card': 160, 'full': 400}
+}
+# (расширение, формат Pillow, качество)
+IMAGE_VARIANT_FORMATS = [('webp', 'WEBP', 80), ('jpeg', 'JPEG', 82)]
+# Поле исходного URL и поле вариантов в документе
+IMAGE_VARIANT_FIELDS = {
+    'cover': ('blog_posts', 'cover_image', 'cover_variants'),
+    'avatar': ('users', 'avatar', 'avatar_variants')
+}
+
+class ImageVariants:
+    """Уменьшенные копии загруженных обложек и аватаров.
+
+    Для каждой загрузки в фоне (Pillow - в пуле потоков eventlet.tpool,
+    чтобы не блокировать воркер) пишутся варианты thumb/card/full в WebP
+    и JPEG без EXIF, с учетом поворота из EXIF. URL вариантов
+    сохраняются в документе (cover_variants / avatar_variants), если за
+    это время исходное изображение не сменилось; шаблоны отдают их через
+    srcset.
+    """
+    _stats = {'processed': 0, 'skipped': 0, 'errors': 0}
+
+    @staticmethod
+    def _source_path(url):
+        """Локальный файл загрузки по ее URL (None для внешних ссылок)"""
+        if not url or '/uploads/' not in url:
+            return None
+        filename = url.split('/uploads/', 1)[1].split('?', 1)[0]
+        if not filename or any(part in ('', '.', '..') or secure_filename(part) != part for part in filename.split('/')):
+            return None
+        path = os.path.join(app.config['UPLOAD_FOLDER'], *filename.split('/'))
+        return path if os.path.isfile(path) else None
+
+    @staticmethod
+    def _variant_name(source_path, size, ext):
+        stem = os.path.splitext(os.path.basename(source_path))[0]
+        return f'{stem}__{size}.{ext}'
+
+    @staticmethod
+    def generate(source_path, widths):
+        """Пишет файлы вариантов; возвращает {размер: {'width', 'height', 'webp', 'jpeg'}} с именами файлов"""
+        with Image.open(source_path) as original:
+            image = ImageOps.exif_transpose(original)
+            image.load()
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        # Для JPEG прозрачность заливаем белым
+        if image.mode == 'RGBA':
+            flat = Image.new('RGB', image.size, (255, 255, 255))
+            flat.paste(image, mask=image.getchannel('A'))
+        else:
+            flat = image
+
+        variants = {}
+        for size, width in widths.items():
+            width = min(width, image.width)
+            height = max(1, round(image.height * width / image.width))
+            entry = {'width': width, 'height': height}
+            for ext, fmt, quality in IMAGE_VARIANT_FORMATS:
+                source = image if fmt == 'WEBP' else flat
+                resized = source.resize((width, height), Image.LANCZOS) if width != source.width else source.copy()
+                name = ImageVariants._variant_name(source_path, size, ext)
+                # Сохраняем без exif/icc: метаданные камеры не попадают в варианты
+                resized.save(os.path.join(os.path.dirname(source_path), name), fmt, quality=quality,
+                             **({'optimize': True, 'progressive': True} if fmt == 'JPEG' else {'method': 4}))
+                entry[ext] = name
+            variants[size] = entry
+        return variants
+
+    @staticmethod
+    def process(kind, key, url):
+        """Варианты для одной загрузки; True, если они записаны в документ"""
+        source_path = ImageVariants._source_path(url)
+        if source_path is None:
+            ImageVariants._stats['skipped'] += 1
+            return False
+        files = eventlet.tpool.execute(ImageVariants.generate, source_path, IMAGE_VARIANT_WIDTHS[kind])
+        # Варианты лежат рядом с исходным файлом (для ContentStore - в cas/xx/yy/)
+        base_url = url.rsplit('/', 1)[0] + '/'
+        variants = {size: dict(entry, **{ext: base_url + entry[ext] for ext, _, _ in IMAGE_VARIANT_FORMATS})
+                    for size, entry in files.items()}
+        if DB.set_image_variants(kind, key, url, variants):
+            ImageVariants._stats['processed'] += 1
+            return True
+        # Пока шла обработка, загрузили другое изображение
+        ImageVariants.remove(variants)
+        ImageVariants._stats['skipped'] += 1
+        return False
+
+    @staticmethod
+    def schedule(kind, key, url):
+        """Обработка загрузки вне запроса"""
+        def run():
+            try:
+                ImageVariants.process(kind, key, url)
+            except Exception as e:
+                ImageVariants._stats['errors'] += 1
+                logger.error(f'Error generating {kind} variants for {key}: {e}')
+        eventlet.spawn(run)
+
+    @staticmethod
+    def remove(variants):
+        """Удаляет файлы вариантов (копии файлов из ContentStore удаляются вместе с blob)"""
+        for entry in (variants or {}).values():
+            for ext, _, _ in IMAGE_VARIANT_FORMATS:
+                path = ImageVariants._source_path(entry.get(ext))
+                if path and not os.path.abspath(path).startswith(os.path.abspath(CAS_FOLDER) + os.sep):
+                    os.remove(path)
+
+    @staticmethod
+    def backfill(force=False):
+        """Варианты для уже загруженных обложек и аватаров: {вид: число обработанных}"""
+        done = {}
+        for kind, (collection, source_field, variants_field) in IMAGE_VARIANT_FIELDS.items():
+            done[kind] = 0
+            key_field = JournalStore.key_field(collection)
+            for doc in DB._get_db(collection):
+                if not doc.get(source_field) or (doc.get(variants_field) and not force):
+                    continue
+                try:
+                    if ImageVariants.process(kind, doc[key_field], doc[source_field]):
+                        done[kind] += 1
+                except Exception as e:
+                    ImageVariants._stats['errors'] += 1
+                    logger.error(f'Error generating {kind} variants for {doc[key_field]}: {e}')
+        return done
+
+    @staticmethod
+    def stats():
+        return dict(ImageVariants._stats)
+
+# ===== ВОЗОБНОВЛЯЕМАЯ ЗАГРУЗКА ФАЙЛОВ =====
+
+# Размер части и срок жизни незавершенной загрузки
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+UPLOAD_SESSION_TTL = timedelta(hours=24)
+UPLOAD_CLEANUP_INTERVAL = 3600
+# Недокачанные файлы лежат внутри uploads, чтобы готовый файл переносился os.replace
+INCOMING_FOLDER = os.path.join(UPLOAD_FOLDER, '.incoming')
+ALLOWED_EXTENSIONS_IMAGE = {'jpg', 'jpeg', 'png', 'webp', 'gif'}
+# Назначения загрузок: кто может загружать, допустимые расширения (None - любые) и размер
+UPLOAD_PURPOSES = {
+    'blog_video': {'role': 'teacher', 'extensions': ALLOWED_EXTENSIONS_VIDEO, 'max_size': MAX_VIDEO_SIZE},
+    'blog_cover': {'role': 'teacher', 'extensions': ALLOWED_EXTENSIONS_IMAGE, 'max_size': 20 * 1024 * 1024},
+    'homework_file': {'role': 'student', 'extensions': None, 'max_size': 200 * 1024 * 1024}
+}
+
+class UploadError(Exception):
+    """Ошибка протокола загрузки с HTTP-статусом для ответа"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class ResumableUploads:
+    """Загрузка файлов частями в духе tus: создание -> части в любом порядке -> завершение.
+
+    Сессия загрузки хранится в коллекции upload_sessions, поэтому части
+    могут приходить в разные воркеры параллельно. Файл создается сразу
+    нужного размера, каждая часть пишется по своему смещению (os.pwrite)
+    потоково и засчитывается, только если совпала ее контрольная сумма
+    (заголовок Upload-Checksum: sha256 <base64>). При завершении файл
+    переносится на место через os.replace - части повторно не читаются.
+    Клиент после обрыва узнает принятые части через GET и досылает
+    остальные. Обложки и файлы работ попадают в ContentStore: если
+    клиент прислал sha256 уже сохраненного содержимого, части не нужны
+    вовсе - сессия создается сразу принятой.
+    """
+
+    @staticmethod
+    def _path(upload_id):
+        return os.path.join(INCOMING_FOLDER, f'{upload_id}.upload')
+
+    @staticmethod
+    def _check_target(purpose, target_id):
+        if purpose in ('blog_video', 'blog_cover'):
+            return DB.get_blog_post(target_id) is not None
+        return DB.get_homework(target_id) is not None
+
+    @staticmethod
+    def create(user, purpose, target_id, filename, size, checksum=None):
+        rules = UPLOAD_PURPOSES.get(purpose)
+        if rules is None:
+            raise UploadError('Unknown upload purpose')
+        if user['role'] != rules['role']:
+            raise UploadError('Unauthorized', 403)
+        filename = secure_filename(filename or '')
+        ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+        if not filename or (rules['extensions'] is not None and ext not in rules['extensions']):
+            raise UploadError('Unsupported file type')
+        if not isinstance(size, int) or size < 0:
+            raise UploadError('Invalid size')
+        if size > rules['max_size']:
+            raise UploadError(f'File too large. Max size: {rules["max_size"] // (1024 * 1024)}MB', 413)
+        if not ResumableUploads._check_target(purpose, target_id):
+            raise UploadError('Target not found', 404)
+
+        upload_id = uuid.uuid4().hex
+        chunks = -(-size // UPLOAD_CHUNK_SIZE)
+        checksum = checksum.lower() if checksum else None
+        deduplicated = purpose != 'blog_video' and ContentStore.has_blob(checksum)
+        if not deduplicated:
+            os.makedirs(INCOMING_FOLDER, exist_ok=True)
+            with open(ResumableUploads._path(upload_id), 'wb') as f:
+                # Разреженный файл нужного размера: части пишутся сразу на место
+                f.truncate(size)
+        now = datetime.now().isoformat()
+        upload = {
+            'id': upload_id,
+            'owner': user['username'],
+            'purpose': purpose,
+            'target_id': target_id,
+            'filename': filename,
+            'size': size,
+            'checksum': checksum,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+            'chunks': chunks,
+            'received': list(range(chunks)) if deduplicated else [],
+            'deduplicated': deduplicated,
+            'status': 'open',
+            'created_at': now,
+            'updated_at': now
+        }
+        DB._put('upload_sessions', upload)
+        return upload
+
+    @staticmethod
+    def get(upload_id, user):
+        upload = DB.backend.get('upload_sessions', upload_id)
+        if upload is None or upload['owner'] != user['username']:
+            raise UploadError('Upload not found', 404)
+        return upload
+
+    @staticmethod
+    def write_chunk(upload_id, user, index, stream, length, checksum_header):
+        """Потоково пишет часть по ее смещению; засчитывает при совпадении sha256"""
+        upload = ResumableUploads.get(upload_id, user)
+        if upload['status'] != 'open':
+            raise UploadError('Upload already completed', 409)
+        if not 0 <= index < upload['chunks']:
+            raise UploadError('Invalid chunk index')
+        if upload.get('deduplicated'):
+            raise UploadError('Content already stored, complete the upload', 409)
+        offset = index * upload['chunk_size']
+        expected = min(upload['chunk_size'], upload['size'] - offset)
+        if length != expected:
+            raise UploadError(f'Chunk {index} must be {expected} bytes')
+        algorithm, _, value = (checksum_header or '').partition(' ')
+        if algorithm.lower() != 'sha256' or not value:
+            raise UploadError('Upload-Checksum: sha256 <base64> header is required')
+
+        if index in upload['received']:
+            # Повторная отправка перезапишет принятые байты: пока сумма не
+            # сверена, часть снова считается непринятой
+            def unmark(doc):
+                if doc is None or index not in doc['received']:
+                    return None
+                doc['received'].remove(index)
+                return doc
+            DB._update('upload_sessions', upload_id, unmark)
+
+        digest = hashlib.sha256()
+        fd = os.open(ResumableUploads._path(upload_id), os.O_WRONLY)
+        try:
+            position = offset
+            remaining = length
+            while remaining:
+                block = stream.read(min(remaining, 64 * 1024))
+                if not block:
+                    raise UploadError('Incomplete chunk')
+                digest.update(block)
+                os.pwrite(fd, block, position)
+                position += len(block)
+                remaining -= len(block)
+        finally:
+            os.close(fd)
+        if base64.b64encode(digest.digest()).decode('ascii') != value.strip():
+            # Данные части перезапишет повторная отправка
+            raise UploadError('Checksum mismatch', 460)
+
+        def mark(doc):
+            if doc is None:
+                return None
+            if index not in doc['received']:
+                doc['received'].append(index)
+            doc['updated_at'] = datetime.now().isoformat()
+            return doc
+        return DB._update('upload_sessions', upload_id, mark)
+
+    @staticmethod
+    def complete(upload_id, user):
+        """Переносит собранный файл на место назначения; результат зависит от назначения"""
+        upload = ResumableUploads.get(upload_id, user)
+        if upload['status'] == 'complete':
+            return upload['result']
+        missing = sorted(set(range(upload['chunks'])) - set(upload['received']))
+        if missing:
+            raise UploadError(f'Missing chunks: {missing[:20]}', 409)
+        path = ResumableUploads._path(upload_id)
+        if upload.get('checksum') and not upload.get('deduplicated'):
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            if digest.hexdigest() != upload['checksum'].lower():
+                raise UploadError('Checksum mismatch', 460)
+
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        target_id = upload['target_id']
+        if upload['purpose'] == 'blog_video':
+            video_folder = os.path.join(UPLOAD_FOLDER, 'blog_videos')
+            os.makedirs(video_folder, exist_ok=True)
+            filename = secure_filename(f"video_{target_id}_{timestamp}_{upload['filename']}")
+            os.replace(path, os.path.join(video_folder, filename))
+            video_url = url_for('uploaded_file', filename=f'blog_videos/{filename}', _external=True)
+            DB.update_blog_post(target_id, {'video_url': video_url})
+            result = {'video_url': video_url}
+        else:
+            kind = 'cover' if upload['purpose'] == 'blog_cover' else 'submission'
+            try:
+                if upload.get('deduplicated'):
+                    stored = ContentStore.put_existing(upload['checksum'], upload['filename'], upload['owner'], kind)
+                else:
+                    stored = ContentStore.put_path(path, upload['filename'], upload['owner'], kind,
+                                                   sha256=upload.get('checksum'))
+            except FileNotFoundError:
+                # Содержимое удалили между созданием сессии и завершением
+                DB._delete('upload_sessions', upload_id)
+                raise UploadError('Stored content is gone, restart the upload', 410)
+            if upload['purpose'] == 'blog_cover':
+                cover_url = ContentStore.public_url(stored)
+                DB.update_blog_post(target_id, {'cover_image': cover_url, 'cover_ref': stored['id']})
+                result = {'cover_url': cover_url}
+            else:
+                # Файл попадает в работу при отправке (/api/homework/upload с upload_ids)
+                result = {'upload_id': upload_id, 'file': stored}
+
+        def finish(doc):
+            if doc is None:
+                return None
+            doc['status'] = 'complete'
+            doc['result'] = result
+            doc['updated_at'] = datetime.now().isoformat()
+            return doc
+        if upload['purpose'] == 'homework_file':
+            DB._update('upload_sessions', upload_id, finish)
+        else:
+            DB._delete('upload_sessions', upload_id)
+        return result
+
+    @staticmethod
+    def claim_homework_files(upload_ids, user, homework_id):
+        """Описания файлов завершенных загрузок к заданию; сессии загрузок удаляются"""
+        files = []
+        for upload_id in upload_ids:
+            upload = ResumableUploads.get(upload_id, user)
+            if upload['purpose'] != 'homework_file' or upload['status'] != 'complete' or \
+                    upload['target_id'] != homework_id:
+                raise UploadError(f'Upload {upload_id} is not a completed file of this homework')
+            files.append(upload['result']['file'])
+        for upload_id in upload_ids:
+            DB._delete('upload_sessions', upload_id)
+        return files
+
+    @staticmethod
+    def abort(upload_id, user):
+        upload = ResumableUploads.get(upload_id, user)
+        ResumableUploads._discard(upload)
+
+    @staticmethod
+    def _discard(upload):
+        """Удаляет сессию с ее файлом: недокачанным или так и не отправленным в работу"""
+        if upload['status'] == 'open':
+            if os.path.exists(ResumableUploads._path(upload['id'])):
+                os.remove(ResumableUploads._path(upload['id']))
+        else:
+            ContentStore.release(((upload.get('result') or {}).get('file') or {}).get('id'))
+        DB._delete('upload_sessions', upload['id'])
+
+    @staticmethod
+    def expire():
+        """Удаляет брошенные загрузки старше UPLOAD_SESSION_TTL"""
+        cutoff = (datetime.now() - UPLOAD_SESSION_TTL).isoformat()
+        expired = 0
+        for upload in DB._get_db('upload_sessions'):
+            if upload['updated_at'] < cutoff:
+                ResumableUploads._discard(upload)
+                expired += 1
+        return expired
+
+# Фоновая очистка брошенных загрузок
+def expire_uploads():
+    while True:
+        eventlet.sleep(UPLOAD_CLEANUP_INTERVAL)
+        try:
+            ResumableUploads.expire()
+        except Exception as e:
+            logger.error(f'Error expiring uploads: {e}')
+
+# ===== СБОРКА МУСОРА В UPLOADS =====
+
+# Файл без ссылок сначала уходит в карантин и удаляется через UPLOAD_GC_GRACE;
+# файлы моложе UPLOAD_GC_MIN_AGE не трогаем (документ о них может быть еще не записан)
+UPLOAD_GC_INTERVAL = 6 * 3600
+UPLOAD_GC_GRACE = timedelta(days=7)
+UPLOAD_GC_MIN_AGE = timedelta(hours=1)
+QUARANTINE_FOLDER = os.path.join(UPLOAD_FOLDER, '.quarantine')
+# Коллекции, документы которых ссылаются на загрузки, и поле владельца
+UPLOAD_OWNER_FIELDS = {
+    'users': 'username',
+    'lessons': 'teacher',
+    'homeworks': 'teacher',
+    'homework_submissions': 'student',
+    'testimonials': None,
+    'blog_posts': 'author',
+    'blog_comments': 'author',
+    'upload_sessions': 'owner'
+}
+# Ссылка на загрузку в любом строковом поле: URL, путь или HTML тела поста
+UPLOAD_REFERENCE_RE = re.compile(r'(?:^|/)uploads/([^\s"\'<>?#()]+)')
+# Поля, в которых документы хранят id ссылок ContentStore ('*' - элементы списка)
+UPLOAD_REF_FIELDS = {
+    'users': [('avatar_ref',)],
+    'homeworks': [('files', '*', 'id')],
+    'homework_submissions': [('files', '*', 'id')],
+    'blog_posts': [('cover_ref',)],
+    'upload_sessions': [('result', 'file', 'id')]
+}
+# Виды ссылок, которые хранятся только в полях UPLOAD_REF_FIELDS: ссылки
+# других видов сборщик не освобождает
+UPLOAD_REF_KINDS = {'homework', 'submission', 'cover', 'avatar'}
+
+class UploadGC:
+    """Mark-and-sweep для uploads/ и индекс занятого места.
+
+    Mark: обходятся все документы UPLOAD_OWNER_FIELDS (с телами постов и
+    всеми живыми партициями) и собираются пути загрузок из строковых
+    полей и id ссылок ContentStore из полей UPLOAD_REF_FIELDS. Заодно считается место по
+    пользователям и коллекциям - индекс disk_usage, который читается без
+    обхода диска. Sweep: файлы без ссылок переносятся в QUARANTINE_FOLDER
+    (учет - коллекция upload_quarantine), снова понадобившиеся
+    (например, после восстановления бэкапа) возвращаются на место,
+    пролежавшие дольше UPLOAD_GC_GRACE удаляются. Файлы ContentStore
+    живут, пока есть их blob; ссылки file_refs, на которые больше
+    никто не ссылается (работы из архивных партиций), освобождаются.
+    """
+    _stats = {'runs': 0, 'quarantined': 0, 'restored': 0, 'purged': 0, 'released_refs': 0}
+
+    @staticmethod
+    @contextmanager
+    def _exclusive():
+        """Один проход на все воркеры; занятая блокировка - пропуск"""
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        with open(os.path.join(UPLOAD_FOLDER, '.gc.lock'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _strings(value):
+        if isinstance(value, str):
+            yield value
+        elif isinstance(value, dict):
+            for item in value.values():
+                yield from UploadGC._strings(item)
+        elif isinstance(value, list):
+            for item in value:
+                yield from UploadGC._strings(item)
+
+    @staticmethod
+    def _field_values(value, path):
+        """Значения по пути полей UPLOAD_REF_FIELDS"""
+        if not path:
+            yield value
+        elif path[0] == '*':
+            for item in value if isinstance(value, list) else []:
+                yield from UploadGC._field_values(item, path[1:])
+        elif isinstance(value, dict) and path[0] in value:
+            yield from UploadGC._field_values(value[path[0]], path[1:])
+
+    @staticmethod
+    def _file_size(relative_path, sizes):
+        if relative_path not in sizes:
+            try:
+                sizes[relative_path] = os.path.getsize(os.path.join(UPLOAD_FOLDER, relative_path))
+            except OSError:
+                sizes[relative_path] = None
+        return sizes[relative_path]
+
+    @staticmethod
+    def _mark():
+        """(пути с живыми ссылками, id упомянутых ссылок ContentStore, занятое место)"""
+        referenced = set()
+        ref_ids = set()
+        usage = defaultdict(set)
+        sizes = {}
+        for collection, owner_field in UPLOAD_OWNER_FIELDS.items():
+            for doc in DB.export_collection(collection):
+                for path in UPLOAD_REF_FIELDS.get(collection, []):
+                    ref_ids.update(v for v in UploadGC._field_values(doc, path) if isinstance(v, str))
+                paths = set()
+                for value in UploadGC._strings(doc):
+                    for match in UPLOAD_REFERENCE_RE.finditer(value):
+                        paths.add(unquote(match.group(1)))
+                paths = {p for p in paths if '..' not in p.split('/')}
+                referenced |= paths
+                existing = {p for p in paths if UploadGC._file_size(p, sizes) is not None}
+                usage[f'collection:{collection}'] |= existing
+                if owner_field and doc.get(owner_field):
+                    usage[f'user:{doc[owner_field]}'] |= existing
+            eventlet.sleep(0)
+        totals = {key: (len(paths), sum(sizes[p] for p in paths)) for key, paths in usage.items()}
+        return referenced, ref_ids, totals
+
+    @staticmethod
+    def _is_live(relative_path, referenced, blobs):
+        if relative_path.startswith('cas/'):
+            # Файл blob и его уменьшенные копии (<sha256>__<размер>.<расширение>)
+            sha256 = os.path.basename(relative_path).split('.', 1)[0].split('__', 1)[0]
+            return sha256 in blobs
+        return relative_path in referenced
+
+    @staticmethod
+    def _quarantine(relative_path, size):
+        target = os.path.join(QUARANTINE_FOLDER, relative_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(os.path.join(UPLOAD_FOLDER, relative_path), target)
+        DB._put('upload_quarantine', {
+            'id': uuid.uuid4().hex,
+            'path': relative_path,
+            'size': size,
+            'quarantined_at': datetime.now().isoformat()
+        })
+
+    @staticmethod
+    def collect():
+        """Полный проход сборщика; None, если он уже идет в другом воркере"""
+        with UploadGC._exclusive() as acquired:
+            if not acquired:
+                return None
+            result = {'quarantined': 0, 'restored': 0, 'purged': 0, 'released_refs': 0, 'bytes_freed': 0}
+            referenced, ref_ids, usage = UploadGC._mark()
+
+            # Ссылки ContentStore, которые не упоминает ни один документ
+            cutoff = (datetime.now() - UPLOAD_GC_MIN_AGE).isoformat()
+            for ref in DB._get_db('file_refs'):
+                if ref['kind'] in UPLOAD_REF_KINDS and ref['id'] not in ref_ids and ref['created_at'] < cutoff:
+                    ContentStore.release(ref['id'])
+                    result['released_refs'] += 1
+            blobs = {blob['sha256'] for blob in DB._get_db('file_blobs')}
+
+            # Карантин: вернуть снова нужные, удалить истекшие
+            purge_before = (datetime.now() - UPLOAD_GC_GRACE).isoformat()
+            quarantined_bytes = 0
+            for entry in DB._get_db('upload_quarantine'):
+                source = os.path.join(QUARANTINE_FOLDER, entry['path'])
+                target = os.path.join(UPLOAD_FOLDER, entry['path'])
+                if not os.path.exists(source):
+                    DB._delete('upload_quarantine', entry['id'])
+                elif UploadGC._is_live(entry['path'], referenced, blobs) and not os.path.exists(target):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(source, target)
+                    DB._delete('upload_quarantine', entry['id'])
+                    result['restored'] += 1
+                elif entry['quarantined_at'] < purge_before:
+                    os.remove(source)
+                    DB._delete('upload_quarantine', entry['id'])
+                    result['purged'] += 1
+                    result['bytes_freed'] += entry['size']
+                else:
+                    quarantined_bytes += entry['size']
+
+            # Sweep: служебные каталоги (.incoming, .quarantine, cas/.tmp) не обходим,
+            # но брошенные временные файлы ContentStore удаляем
+            min_mtime = time.time() - UPLOAD_GC_MIN_AGE.total_seconds()
+            for name in os.listdir(CAS_TMP_FOLDER) if os.path.isdir(CAS_TMP_FOLDER) else []:
+                path = os.path.join(CAS_TMP_FOLDER, name)
+                if os.path.getmtime(path) < min_mtime:
+                    os.remove(path)
+            total_files = total_bytes = 0
+            for root, dirs, files in os.walk(UPLOAD_FOLDER):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                for name in files:
+                    if name.startswith('.'):
+                        continue
+                    path = os.path.join(root, name)
+                    relative_path = os.path.relpath(path, UPLOAD_FOLDER).replace(os.sep, '/')
+                    stat = os.stat(path)
+                    if UploadGC._is_live(relative_path, referenced, blobs) or stat.st_mtime >= min_mtime:
+                        total_files += 1
+                        total_bytes += stat.st_size
+                        continue
+                    UploadGC._quarantine(relative_path, stat.st_size)
+                    quarantined_bytes += stat.st_size
+                    result['quarantined'] += 1
+                eventlet.sleep(0)
+
+            now = datetime.now().isoformat()
+            docs = [{'id': key, 'files': files, 'bytes': size, 'updated_at': now}
+                    for key, (files, size) in usage.items()]
+            docs.append({'id': 'total', 'files': total_files, 'bytes': total_bytes,
+                         'quarantined_bytes': quarantined_bytes, 'updated_at': now})
+            DB._save_db('disk_usage', docs)
+
+            UploadGC._stats['runs'] += 1
+            for key in ('quarantined', 'restored', 'purged', 'released_refs'):
+                UploadGC._stats[key] += result[key]
+            logger.info(f'Upload GC: {result}')
+            return result
+
+    @staticmethod
+    def usage(username=None):
+        """Индекс занятого места: по пользователю или целиком"""
+        if username is not None:
+            return DB.backend.get('disk_usage', f'user:{username}') or {'id': f'user:{username}', 'files': 0, 'bytes': 0}
+        docs = DB._get_db('disk_usage')
+        result = {'total': None, 'collections': {}, 'users': {}}
+        for doc in docs:
+            kind, _, name = doc['id'].partition(':')
+            if kind == 'total':
+                result['total'] = doc
+            else:
+                result[f'{kind}s'][name] = {'files': doc['files'], 'bytes': doc['bytes']}
+        return result
+
+    @staticmethod
+    def stats():
+        total = DB.backend.get('disk_usage', 'total') or {}
+        return dict(UploadGC._stats, last_run=total.get('updated_at'), bytes=total.get('bytes'),
+                    quarantined_bytes=total.get('quarantined_bytes'))
+
+# Фоновая сборка мусора в uploads (проход делает один воркер)
+def collect_uploads():
+    while True:
+        eventlet.sleep(UPLOAD_GC_INTERVAL)
+        try:
+            # Воркеры просыпаются не одновременно: недавний проход другого воркера не повторяем
+            last_run = (DB.backend.get('disk_usage', 'total') or {}).get('updated_at') or ''
+            if last_run < (datetime.now() - timedelta(seconds=UPLOAD_GC_INTERVAL / 2)).isoformat():
+                UploadGC.collect()
+        except Exception as e:
+            logger.error(f'Error collecting uploads: {e}')
+
+# ===== ПОТОКОВЫЙ ZIP =====
+
+# Уже сжатые форматы кладем в архив как есть: повторное сжатие только тратит CPU
+ZIP_STORED_EXTENSIONS = {
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'mp4', 'webm', 'mov', 'avi', 'mkv', 'ogg',
+    'mp3', 'm4a', 'aac', 'zip', 'rar', '7z', 'gz', 'bz2', 'xz', 'docx', 'xlsx', 'pptx',
+    'odt', 'ods', 'odp', 'pdf'
+}
+ZIP_STREAM_BLOCK = 256 * 1024
+
+class ZipStream:
+    """ZIP, собираемый на лету: байты отдаются клиенту по мере записи.
+
+    zipfile пишет в неперематываемый поток (размеры и CRC - в дескрипторе
+    после данных), поэтому архив не держится ни в памяти, ни во временном
+    файле: в буфере лежит только последний записанный блок.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+    @staticmethod
+    def generate(entries):
+        """Отдает архив блоками; entries - пары (имя в архиве, путь к файлу)"""
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, 'w') as archive:
+            for arcname, path in entries:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                ext = arcname.rsplit('.', 1)[1].lower() if '.' in arcname else ''
+                info.compress_type = zipfile.ZIP_STORED if ext in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                with open(path, 'rb') as source, archive.open(info, 'w') as target:
+                    for block in iter(lambda: source.read(ZIP_STREAM_BLOCK), b''):
+                        target.write(block)
+                        yield from stream._drain()
+                yield from stream._drain()
+        yield from stream._drain()
+
+    @staticmethod
+    def submission_entries(homework_id):
+        """Файлы работ по папкам учеников; пропавшие с диска файлы пропускаются"""
+        entries = []
+        for submission in sorted(DB.get_submissions(homework_id), key=lambda s: s['student']):
+            folder = secure_filename(submission['student']) or 'student'
+            names = set()
+            for file in submission.get('files') or []:
+                path = file.get('path') or os.path.join(UPLOAD_FOLDER, file['name'])
+                if not os.path.isfile(path):
+                    continue
+                name = secure_filename(file['name']) or 'file'
+                stem, dot, ext = name.rpartition('.')
+                counter = 1
+                while name in names:
+                    counter += 1
+                    name = f'{stem}_{counter}.{ext}' if dot else f'{ext}_{counter}'
+                names.add(name)
+                entries.append((f'{folder}/{name}', path))
+        return entries
+
+# ===== СТАТИЧЕСКИЙ ЭКСПОРТ БЛОГА =====
+
+# Каталог готовых страниц блога, который nginx отдает гостям напрямую
+PRERENDER_FOLDER = os.environ.get('PRERENDER_FOLDER', 'prerendered')
+# Шаблоны выгружаемых страниц: при их изменении экспорт пересобирается при запуске
+PRERENDER_TEMPLATES = ['blog.html', 'blog_post.html']
+
+class StaticBlogExport:
+    """Гостевые страницы блога в виде файлов: blog/index.html и blog/post/<slug>.html.
+
+    Рядом с каждой страницей лежит .gz копия для gzip_static. Файлы
+    заменяются атомарно (временный файл + os.replace) после сохранения,
+    правки и удаления поста; у снятых с публикации и удаленных постов
+    файлы убираются, и nginx передает запрос во Flask. Счетчики в файле -
+    на момент выгрузки, страница обновляет их и засчитывает просмотр
+    запросом к /api/blog/posts/<id>/view.
+    """
+    _stats = {'rendered': 0, 'removed': 0, 'errors': 0}
+
+    @staticmethod
+    def _post_folder():
+        return os.path.join(PRERENDER_FOLDER, 'blog', 'post')
+
+    @staticmethod
+    def _post_path(slug):
+        # slug с разделителями пути не выгружается - такой пост отдает Flask
+        if not slug or '/' in slug or '\\' in slug or '\0' in slug or slug.startswith('.'):
+            return None
+        return os.path.join(StaticBlogExport._post_folder(), f'{slug}.html')
+
+    @staticmethod
+    def _write(path, body):
+        """Атомарная замена страницы и ее сжатой копии"""
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        data = body.encode('utf-8')
+        # Сначала .gz: nginx проверяет наличие .html и затем берет сжатую копию
+        for target, payload in ((path + '.gz', gzip.compress(data, 9)), (path, data)):
+            fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(payload)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, target)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    @staticmethod
+    def _remove(path):
+        for target in (path, path + '.gz'):
+            if os.path.exists(target):
+                os.remove(target)
+
+    @staticmethod
+    def _clear(post_id, keep=None):
+        """Убирает выгруженные страницы поста (slug начинается с id), кроме keep"""
+        folder = StaticBlogExport._post_folder()
+        if not os.path.isdir(folder):
+            return
+        prefix = f'{post_id}-'
+        for filename in os.listdir(folder):
+            if filename.startswith(prefix) and filename.endswith('.html') and filename != keep:
+                StaticBlogExport._remove(os.path.join(folder, filename))
+                StaticBlogExport._stats['removed'] += 1
+
+    @staticmethod
+    def render_post(post_id):
+        post = DB.get_blog_post(post_id)
+        path = StaticBlogExport._post_path(post['slug']) if post else None
+        if post is None or not post.get('is_published') or path is None:
+            StaticBlogExport._clear(post_id)
+            return False
+        with app.test_request_context(f'/blog/post/{post["slug"]}', base_url=SITE_URL):
+            body = render_blog_post_html(post, static_export=True)
+        for field, marker in PAGE_COUNTER_MARKERS.items():
+            body = body.replace(marker, str(post.get(field) or 0))
+        StaticBlogExport._write(path, body)
+        StaticBlogExport._clear(post_id, keep=os.path.basename(path))
+        StaticBlogExport._stats['rendered'] += 1
+        return True
+
+    @staticmethod
+    def render_index():
+        # Посты на главную блога подгружает скрипт - страница зависит только от шаблона
+        with app.test_request_context('/blog', base_url=SITE_URL):
+            body = render_template('blog.html', user=None)
+        StaticBlogExport._write(os.path.join(PRERENDER_FOLDER, 'blog', 'index.html'), body)
+        StaticBlogExport._stats['rendered'] += 1
+
+    @staticmethod
+    def schedule(post_ids):
+        """Перевыгрузка страниц постов вне запроса"""
+        def run():
+            for post_id in post_ids:
+                try:
+                    StaticBlogExport.render_post(post_id)
+                except Exception as e:
+                    StaticBlogExport._stats['errors'] += 1
+                    logger.error(f'Error exporting blog post {post_id}: {e}')
+        if post_ids:
+            eventlet.spawn(run)
+
+    @staticmethod
+    def _templates_hash():
+        digest = hashlib.sha1()
+        for name in PRERENDER_TEMPLATES:
+            with open(os.path.join(app.root_path, app.template_folder, name), 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    @staticmethod
+    def export_all():
+        """Полная выгрузка: главная блога и все опубликованные посты, лишние файлы удаляются"""
+        StaticBlogExport.render_index()
+        published = set()
+        for post in DB._get_db('blog_posts'):
+            if post.get('is_published') and StaticBlogExport.render_post(post['id']):
+                published.add(os.path.basename(StaticBlogExport._post_path(post['slug'])))
+        folder = StaticBlogExport._post_folder()
+        for filename in os.listdir(folder) if os.path.isdir(folder) else []:
+            if filename.endswith('.html') and filename not in published:
+                StaticBlogExport._remove(os.path.join(folder, filename))
+                StaticBlogExport._stats['removed'] += 1
+        with open(os.path.join(PRERENDER_FOLDER, 'blog', '.templates'), 'w') as f:
+            f.write(StaticBlogExport._templates_hash())
+        logger.info(f'Static blog export: {len(published)} posts')
+        return len(published)
+
+    @staticmethod
+    def is_current():
+        """Выгрузка есть и сделана текущими шаблонами"""
+        try:
+            with open(os.path.join(PRERENDER_FOLDER, 'blog', '.templates')) as f:
+                return f.read().strip() == StaticBlogExport._templates_hash()
+        except OSError:
+            return False
+
+    @staticmethod
+    def stats():
+        return dict(StaticBlogExport._stats)
+
+# Фоновая выгрузка блога при запуске (если изменились шаблоны)
+def export_static_blog():
+    try:
+        StaticBlogExport.export_all()
+    except Exception as e:
+        logger.error(f'Error in static blog export: {e}')
 
 class DB:
+    backend = create_storage_backend()
+
     @staticmethod
     def _get_db(file):
-        try:
-            with open(f'{DB_FOLDER}/{file}.json', 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return []
+        return DB.backend.all(file)
 
     @staticmethod
     def _save_db(file, data):
-        with open(f'{DB_FOLDER}/{file}.json', 'w') as f:
-            json.dump(data, f, indent=2)
+        DB.backend.replace(file, data)
+
+    @staticmethod
+    def _put(file, doc):
+        DB.backend.put(file, doc)
+
+    @staticmethod
+    def _delete(file, key):
+        DB.backend.delete(file, key)
+
+    @staticmethod
+    def _update(file, key, fn):
+        """Изменение документа без потерянных обновлений (см. StorageBackend.update)"""
+        return DB.backend.update(file, key, fn)
 
     # Пользователи
     @staticmethod
     def get_users(role=None):
-        users = DB._get_db('users')
         if role:
-            return [u for u in users if u['role'] == role]
-        return users
+            return DB.backend.find('users', 'role', role)
+        return DB._get_db('users')
 
     @staticmethod
     def get_user(username):
-        users = DB.get_users()
-        return next((u for u in users if u['username'] == username), None)
+        return DB.backend.get('users', username)
 
     @staticmethod
     def save_user(username, email, password, role='student', is_active=True, phone=''):
-        users = DB.get_users()
-        if any(u['username'] == username for u in users):
+        if DB.get_user(username):
             return False
         
-        users.append({
+        user = {
             'username': username,
             'email': email,
             'password': generate_password_hash(password),
@@ -202,57 +3833,115 @@ class DB:
             'phone': phone,
             'created_at': datetime.now().isoformat(),
             'avatar': f'https://i.pravatar.cc/150?u={username}'
-        })
-        DB._save_db('users', users)
-        return True
+        }
+        # Повторная проверка под блокировкой: имя могли занять в другом воркере
+        return DB._update('users', username, lambda existing: None if existing else user) is not None
 
     @staticmethod
     def update_user(username, data):
-        users = DB.get_users()
-        for i, user in enumerate(users):
-            if user['username'] == username:
-                if 'email' in data:
-                    users[i]['email'] = data['email']
-                if 'phone' in data:
-                    users[i]['phone'] = data['phone']
-                if 'password' in data and data['password']:
-                    users[i]['password'] = generate_password_hash(data['password'])
-                if 'is_active' in data:
-                    users[i]['is_active'] = data['is_active']
-                if 'role' in data:
-                    users[i]['role'] = data['role']
-                if 'avatar' in data:
-                    users[i]['avatar'] = data['avatar']
-                DB._save_db('users', users)
-                return True
-        return False
+        if 'password' in data and data['password']:
+            # Хэш считаем до блокировки коллекции - это дорогая операция
+            password_hash = generate_password_hash(data['password'])
+        
+        def apply(user):
+            if user is None:
+                return None
+            if 'email' in data:
+                user['email'] = data['email']
+            if 'phone' in data:
+                user['phone'] = data['phone']
+            if 'password' in data and data['password']:
+                user['password'] = password_hash
+            if 'is_active' in data:
+                user['is_active'] = data['is_active']
+            if 'role' in data:
+                user['role'] = data['role']
+            if 'avatar' in data and data['avatar'] != user.get('avatar'):
+                user['avatar'] = data['avatar']
+                avatar_changed.append(True)
+                if user.get('avatar_variants'):
+                    stale_variants[:] = [user.pop('avatar_variants')]
+                # Файл прежнего аватара в ContentStore больше не нужен
+                if user.get('avatar_ref') and user['avatar_ref'] != data.get('avatar_ref'):
+                    released_refs[:] = [user['avatar_ref']]
+                user['avatar_ref'] = data.get('avatar_ref')
+            elif data.get('avatar_ref') and data['avatar_ref'] != user.get('avatar_ref'):
+                # Тот же файл загружен повторно - лишняя ссылка не нужна
+                released_refs[:] = [data['avatar_ref']]
+            return user
+        
+        stale_variants = []
+        released_refs = []
+        avatar_changed = []
+        if DB._update('users', username, apply) is None:
+            return False
+        for variants in stale_variants:
+            ImageVariants.remove(variants)
+        for ref_id in released_refs:
+            ContentStore.release(ref_id)
+        if avatar_changed:
+            if data['avatar']:
+                ImageVariants.schedule('avatar', username, data['avatar'])
+            # Аватар автора есть в отрисованных страницах постов
+            ChangeLog.bump('blog_pages', username)
+            StaticBlogExport.schedule([p['id'] for p in DB._get_db('blog_posts') if p.get('author') == username])
+        return True
+
+    @staticmethod
+    def set_image_variants(kind, key, source_url, variants):
+        """Записывает варианты изображения, если у документа все еще то же исходное (см. ImageVariants)"""
+        collection, source_field, variants_field = IMAGE_VARIANT_FIELDS[kind]
+        stale_variants = []
+        
+        def apply(doc):
+            if doc is None or doc.get(source_field) != source_url:
+                return None
+            if doc.get(variants_field):
+                stale_variants.append(doc[variants_field])
+            doc[variants_field] = variants
+            return doc
+        
+        if DB._update(collection, key, apply) is None:
+            return False
+        for stale in stale_variants:
+            # Повторная обработка (backfill --force) пишет те же имена файлов
+            ImageVariants.remove({size: entry for size, entry in stale.items() if entry != variants.get(size)})
+        if kind == 'cover':
+            ChangeLog.bump('blog_posts', key)
+            StaticBlogExport.schedule([key])
+        else:
+            ChangeLog.bump('blog_pages', key)
+            StaticBlogExport.schedule([p['id'] for p in DB._get_db('blog_posts') if p.get('author') == key])
+        return True
 
     @staticmethod
     def delete_user(username):
-        users = DB.get_users()
-        users = [u for u in users if u['username'] != username]
-        DB._save_db('users', users)
+        user = DB.get_user(username)
+        DB._delete('users', username)
+        if user and user.get('avatar_ref'):
+            ContentStore.release(user['avatar_ref'])
         return True
 
     # Уроки
     @staticmethod
     def get_lessons(teacher=None):
-        lessons = DB._get_db('lessons')
         if teacher:
-            return [l for l in lessons if l['teacher'] == teacher]
-        return lessons
+            return DB.backend.find('lessons', 'teacher', teacher)
+        return DB._get_db('lessons')
+
+    @staticmethod
+    def get_student_lessons(student_username):
+        return DB.backend.find('lessons', 'students', student_username)
 
     @staticmethod
     def get_lesson(lesson_id):
-        lessons = DB.get_lessons()
-        return next((l for l in lessons if l['id'] == lesson_id), None)
+        return DB.backend.get('lessons', lesson_id)
 
     @staticmethod
     def save_lesson(title, description, teacher, schedule, duration=60, subject=None, students=None):
         if students is None:
             students = []
-        lessons = DB.get_lessons()
-        lesson_id = max([l['id'] for l in lessons], default=0) + 1
+        lesson_id = SequenceAllocator.next_id('lessons')
         
         lesson_data = {
             'id': lesson_id,
@@ -266,31 +3955,47 @@ class DB:
             'created_at': datetime.now().isoformat()
         }
         
-        lessons.append(lesson_data)
-        DB._save_db('lessons', lessons)
+        DB._put('lessons', lesson_data)
         return lesson_data
 
     @staticmethod
     def delete_lesson(lesson_id):
-        lessons = DB.get_lessons()
-        lessons = [l for l in lessons if l['id'] != lesson_id]
-        DB._save_db('lessons', lessons)
+        DB._delete('lessons', lesson_id)
         return True
 
-    # Домашние задания
+    # Домашние задания (недельные партиции, задания старше 2 недель уходят в архив)
+    @staticmethod
+    def _homework_cutoff():
+        return (datetime.now() - PARTITIONED_COLLECTIONS['homeworks']).isoformat()
+
+    @staticmethod
+    def _homework_active(hw, cutoff):
+        # ISO-строки одного формата сравниваются как даты
+        return hw['created_at'] >= cutoff
+
     @staticmethod
     def get_homeworks():
-        homeworks = DB._get_db('homeworks')
-        # Автоматическое удаление заданий старше 2 недель
-        now = datetime.now()
-        homeworks = [hw for hw in homeworks if 
-                    (now - datetime.fromisoformat(hw['created_at'])) < timedelta(weeks=2)]
-        return homeworks
+        cutoff = DB._homework_cutoff()
+        return [hw for hw in WeekPartitions.all('homeworks') if DB._homework_active(hw, cutoff)]
 
     @staticmethod
     def get_homework(homework_id):
-        homeworks = DB.get_homeworks()
-        return next((h for h in homeworks if h['id'] == homework_id), None)
+        homework = WeekPartitions.locate('homeworks', homework_id)[1]
+        if homework and DB._homework_active(homework, DB._homework_cutoff()):
+            return homework
+        return None
+
+    @staticmethod
+    def get_archived_homeworks(teacher_username, since=None, until=None):
+        """Архивные задания учителя за период (читаются из архива по запросу)"""
+        homeworks = [hw for hw in WeekPartitions.read_archive('homeworks', since, until)
+                     if hw.get('teacher') == teacher_username]
+        if since:
+            homeworks = [hw for hw in homeworks if hw['created_at'] >= since.isoformat()]
+        if until:
+            homeworks = [hw for hw in homeworks if hw['created_at'] < until.isoformat()]
+        homeworks.sort(key=lambda hw: hw['created_at'], reverse=True)
+        return homeworks
 
     @staticmethod
     def save_homework(lesson_id, title, description, deadline, teacher, students=None, files=None, subject=None):
@@ -298,8 +4003,7 @@ class DB:
             students = []
         if files is None:
             files = []
-        homeworks = DB.get_homeworks()
-        homework_id = max([h['id'] for h in homeworks], default=0) + 1
+        homework_id = SequenceAllocator.next_id('homeworks')
         
         homework = {
             'id': homework_id,
@@ -312,47 +4016,163 @@ class DB:
             'files': files,
             'subject': subject,
             'created_at': datetime.now().isoformat(),
-            'submissions': {}
+            # Сами работы лежат в homework_submissions, здесь только сводка
+            'submissions_count': 0,
+            'last_submitted_at': None
         }
         
-        homeworks.append(homework)
-        DB._save_db('homeworks', homeworks)
+        WeekPartitions.put('homeworks', homework)
         return homework
 
     @staticmethod
     def submit_homework(homework_id, student_username, comment, files=None):
         if files is None:
             files = []
-        homeworks = DB.get_homeworks()
+        if not DB.get_homework(homework_id):
+            return False
+        partition = WeekPartitions.locate('homeworks', homework_id)[0]
+        submitted_at = datetime.now().isoformat()
+        is_new = []
+        
+        replaced_files = []
+        
+        # Разрешаем отправку всем ученикам (не проверяем принадлежность)
+        def put_submission(doc):
+            is_new.append(doc is None)
+            replaced_files[:] = doc.get('files') or [] if doc else []
+            return {
+                'key': DB._submission_key(homework_id, student_username),
+                'homework_id': homework_id,
+                'student': student_username,
+                'comment': comment,
+                'files': files,
+                'submitted_at': submitted_at,
+                'status': 'submitted'
+            }
+        
+        DB._update('homework_submissions', DB._submission_key(homework_id, student_username), put_submission)
+        # Файлы прошлой отправки больше не нужны
+        ContentStore.release_files(replaced_files, keep={f.get('id') for f in files})
+        
+        # Сводка обновляется приращением: повторная отправка не меняет счетчик
+        def aggregate(hw):
+            if hw is None:
+                return None
+            if is_new[-1]:
+                hw['submissions_count'] = (hw.get('submissions_count') or 0) + 1
+            hw['last_submitted_at'] = max(hw.get('last_submitted_at') or '', submitted_at)
+            return hw
+        
+        return DB._update(partition, homework_id, aggregate) is not None
+
+    @staticmethod
+    def _submission_key(homework_id, student_username):
+        return f'{homework_id}:{student_username}'
+
+    @staticmethod
+    def get_submission(homework_id, student_username):
+        return DB.backend.get('homework_submissions', DB._submission_key(homework_id, student_username))
+
+    @staticmethod
+    def get_submissions(homework_id):
+        return DB.backend.find('homework_submissions', 'homework_id', homework_id)
+
+    @staticmethod
+    def with_submissions(homework, student_username=None):
+        """Копия задания с работами в прежнем виде {ученик: работа}.
+
+        Если указан ученик, подгружается только его работа.
+        """
+        if student_username is not None:
+            submission = DB.get_submission(homework['id'], student_username)
+            submissions = [submission] if submission else []
+        else:
+            submissions = DB.get_submissions(homework['id'])
+        return dict(homework, submissions={s['student']: s for s in submissions})
+
+    @staticmethod
+    def _embed_submissions(homeworks):
+        """Для архива: работы возвращаются внутрь заданий"""
+        return [DB.with_submissions(hw) for hw in homeworks]
+
+    @staticmethod
+    def _purge_submissions(homeworks):
         for hw in homeworks:
-            if hw['id'] == homework_id:
-                # Разрешаем отправку всем ученикам (не проверяем принадлежность)
-                hw['submissions'][student_username] = {
-                    'comment': comment,
-                    'files': files,
-                    'submitted_at': datetime.now().isoformat(),
-                    'status': 'submitted'
-                }
-                DB._save_db('homeworks', homeworks)
-                return True
-        return False
+            for submission in DB.get_submissions(hw['id']):
+                DB._delete('homework_submissions', submission['key'])
+
+    @staticmethod
+    def split_homework_submissions():
+        """Выносит работы, вложенные в задания, в homework_submissions.
+
+        Запускается при импорте в каждом воркере, поэтому идет под
+        migration_lock. Повторный запуск безопасен: уже перенесенная работа
+        не перезаписывается (ее могли проверить после переноса). Работы
+        заданий, которых больше нет среди живых партиций, удаляются; задание
+        перепроверяется перед удалением, так как его мог только что создать
+        другой воркер.
+        """
+        with migration_lock('homework_submissions'):
+            moved = 0
+            homework_ids = set()
+            for hw in WeekPartitions.all('homeworks', active_only=False):
+                homework_ids.add(hw['id'])
+                if 'submissions' not in hw:
+                    continue
+                for student, submission in (hw['submissions'] or {}).items():
+                    doc = dict(
+                        submission,
+                        key=DB._submission_key(hw['id'], student),
+                        homework_id=hw['id'],
+                        student=student
+                    )
+                    if DB._update('homework_submissions', doc['key'],
+                                  lambda current, doc=doc: doc if current is None else None):
+                        moved += 1
+                
+                def strip(doc):
+                    if doc is None or 'submissions' not in doc:
+                        return None
+                    submissions = doc.pop('submissions') or {}
+                    doc['submissions_count'] = len(submissions)
+                    doc['last_submitted_at'] = max(
+                        (s.get('submitted_at') or '' for s in submissions.values()), default=None) or None
+                    return doc
+                
+                DB._update(WeekPartitions.locate('homeworks', hw['id'], active_only=False)[0], hw['id'], strip)
+            
+            for submission in DB._get_db('homework_submissions'):
+                if submission['homework_id'] in homework_ids:
+                    continue
+                if WeekPartitions.locate('homeworks', submission['homework_id'], active_only=False)[0] is None:
+                    DB._delete('homework_submissions', submission['key'])
+            
+            if moved:
+                logger.info(f'Moved {moved} homework submissions to homework_submissions')
+            return moved
 
     @staticmethod
     def delete_homework(homework_id):
-        homeworks = DB.get_homeworks()
-        homeworks = [hw for hw in homeworks if hw['id'] != homework_id]
-        DB._save_db('homeworks', homeworks)
+        partition, homework = WeekPartitions.locate('homeworks', homework_id)
+        if partition:
+            DB._delete(partition, homework_id)
+            ContentStore.release_files(homework.get('files'))
+        for submission in DB.get_submissions(homework_id):
+            DB._delete('homework_submissions', submission['key'])
+            ContentStore.release_files(submission.get('files'))
         return True
 
     @staticmethod
     def get_student_homeworks(student_username):
-        homeworks = DB.get_homeworks()
-        return [hw for hw in homeworks if student_username in hw['students']]
+        cutoff = DB._homework_cutoff()
+        return [hw for hw in WeekPartitions.find('homeworks', 'students', student_username)
+                if DB._homework_active(hw, cutoff)]
 
     @staticmethod
     def get_teacher_homeworks(teacher_username):
-        homeworks = DB.get_homeworks()
-        return [hw for hw in homeworks if hw['teacher'] == teacher_username]
+        cutoff = DB._homework_cutoff()
+        return [hw for hw in WeekPartitions.find('homeworks', 'teacher', teacher_username)
+                if DB._homework_active(hw, cutoff)]
 
     # Отзывы
     @staticmethod
@@ -366,66 +4186,59 @@ class DB:
 
     @staticmethod
     def get_conference(room_name):
-        conferences = DB.get_conferences()
-        return next((c for c in conferences if c['room_name'] == room_name), None)
+        return DB.backend.get('conferences', room_name)
 
     @staticmethod
     def save_conference(room_name, host_username, is_active=True):
-        conferences = DB.get_conferences()
-        conference = next((c for c in conferences if c['room_name'] == room_name), None)
-        
-        if conference:
-            conference['is_active'] = is_active
-            conference['updated_at'] = datetime.now().isoformat()
-        else:
-            conference = {
-                'room_name': room_name,
-                'host': host_username,
-                'participants': [],
-                'is_active': is_active,
-                'created_at': datetime.now().isoformat(),
-                'updated_at': datetime.now().isoformat()
-            }
-            conferences.append(conference)
+        def apply(conference):
+            if conference:
+                conference['is_active'] = is_active
+                conference['updated_at'] = datetime.now().isoformat()
+            else:
+                conference = {
+                    'room_name': room_name,
+                    'host': host_username,
+                    'participants': [],
+                    'is_active': is_active,
+                    'created_at': datetime.now().isoformat(),
+                    'updated_at': datetime.now().isoformat()
+                }
+            return conference
         
-        DB._save_db('conferences', conferences)
-        return conference
+        return DB._update('conferences', room_name, apply)
 
     @staticmethod
     def add_participant(room_name, username):
-        conferences = DB.get_conferences()
-        conference = next((c for c in conferences if c['room_name'] == room_name), None)
+        def apply(conference):
+            if conference and username not in conference['participants']:
+                conference['participants'].append(username)
+                conference['updated_at'] = datetime.now().isoformat()
+                return conference
+            return None
         
-        if conference and username not in conference['participants']:
-            conference['participants'].append(username)
-            conference['updated_at'] = datetime.now().isoformat()
-            DB._save_db('conferences', conferences)
-            return True
-        return False
+        return DB._update('conferences', room_name, apply) is not None
 
     @staticmethod
     def remove_participant(room_name, username):
-        conferences = DB.get_conferences()
-        conference = next((c for c in conferences if c['room_name'] == room_name), None)
+        def apply(conference):
+            if conference and username in conference['participants']:
+                conference['participants'].remove(username)
+                conference['updated_at'] = datetime.now().isoformat()
+                return conference
+            return None
         
-        if conference and username in conference['participants']:
-            conference['participants'].remove(username)
-            conference['updated_at'] = datetime.now().isoformat()
-            DB._save_db('conferences', conferences)
-            return True
-        return False
+        return DB._update('conferences', room_name, apply) is not None
 
     @staticmethod
     def end_conference(room_name):
-        conferences = DB.get_conferences()
-        conference = next((c for c in conferences if c['room_name'] == room_name), None)
+        def apply(conference):
+            if conference:
+                conference['is_active'] = False
+                conference['updated_at'] = datetime.now().isoformat()
+                return conference
+            return None
         
-        if conference:
-            conference['is_active'] = False
-            conference['updated_at'] = datetime.now().isoformat()
-            DB._save_db('conferences', conferences)
-            return True
-        return False
+        return DB._update('conferences', room_name, apply) is not None
 
     @staticmethod
     def get_active_conference(host_username=None):
@@ -445,8 +4258,15 @@ class DB:
     # Обратная связь (комментарии учителя)
     @staticmethod
     def get_feedbacks(lesson_id=None, student_username=None, teacher_username=None):
-        feedbacks = DB._get_db('feedbacks')
-        result = feedbacks
+        # Первую выборку делаем по индексируемому полю
+        if lesson_id:
+            result = DB.backend.find('feedbacks', 'lesson_id', lesson_id)
+        elif student_username:
+            result = DB.backend.find('feedbacks', 'student_username', student_username)
+        elif teacher_username:
+            result = DB.backend.find('feedbacks', 'teacher_username', teacher_username)
+        else:
+            result = DB._get_db('feedbacks')
         
         if lesson_id:
             result = [f for f in result if f['lesson_id'] == lesson_id]
@@ -457,10 +4277,13 @@ class DB:
             
         return result
 
+    @staticmethod
+    def get_feedback(feedback_id):
+        return DB.backend.get('feedbacks', feedback_id)
+
     @staticmethod
     def save_feedback(lesson_id, student_username, teacher_username, comment, rating=None):
-        feedbacks = DB._get_db('feedbacks')
-        feedback_id = max([f['id'] for f in feedbacks], default=0) + 1
+        feedback_id = SequenceAllocator.next_id('feedbacks')
         
         feedback = {
             'id': feedback_id,
@@ -472,31 +4295,28 @@ class DB:
             'created_at': datetime.now().isoformat()
         }
         
-        feedbacks.append(feedback)
-        DB._save_db('feedbacks', feedbacks)
+        DB._put('feedbacks', feedback)
         return feedback
 
     @staticmethod
     def delete_feedback(feedback_id):
-        feedbacks = DB._get_db('feedbacks')
-        feedbacks = [f for f in feedbacks if f['id'] != feedback_id]
-        DB._save_db('feedbacks', feedbacks)
+        DB._delete('feedbacks', feedback_id)
         return True
 
     # Альтернативные конференции
     @staticmethod
-    def get_conference_links():
+    def get_conference_links(teacher_username=None):
+        if teacher_username:
+            return DB.backend.find('conference_links', 'teacher_username', teacher_username)
         return DB._get_db('conference_links')
 
     @staticmethod
     def get_conference_link(link_id):
-        links = DB.get_conference_links()
-        return next((l for l in links if l['id'] == link_id), None)
+        return DB.backend.get('conference_links', link_id)
 
     @staticmethod
     def save_conference_link(teacher_username, platform, link, is_active=True):
-        links = DB.get_conference_links()
-        link_id = max([l['id'] for l in links], default=0) + 1
+        link_id = SequenceAllocator.next_id('conference_links')
         
         conference_link = {
             'id': link_id,
@@ -507,15 +4327,12 @@ class DB:
             'created_at': datetime.now().isoformat()
         }
         
-        links.append(conference_link)
-        DB._save_db('conference_links', links)
+        DB._put('conference_links', conference_link)
         return conference_link
 
     @staticmethod
     def delete_conference_link(link_id):
-        links = DB.get_conference_links()
-        links = [l for l in links if l['id'] != link_id]
-        DB._save_db('conference_links', links)
+        DB._delete('conference_links', link_id)
         return True
 
     # === МЕТОДЫ ДЛЯ БЛОГА ===
@@ -523,46 +4340,151 @@ class DB:
     @staticmethod
     def get_blog_posts(category=None, limit=None, search=None, tag=None):
         """Получение постов блога с фильтрацией"""
-        posts = DB._get_db('blog_posts')
-        
-        # Фильтрация по категории
-        if category:
-            posts = [p for p in posts if p.get('category') == category]
-        
-        # Фильтрация по тегу
-        if tag:
-            posts = [p for p in posts if tag in p.get('tags', [])]
-        
-        # Поиск
+        # Поиск по инвертированному индексу: порядок - по релевантности
         if search:
-            search_lower = search.lower()
-            posts = [p for p in posts if 
-                    search_lower in p.get('title', '').lower() or 
-                    search_lower in p.get('content', '').lower() or
-                    search_lower in p.get('excerpt', '').lower()]
-        
-        # ПРАВИЛЬНАЯ СОРТИРОВКА: сначала закрепленные, затем по дате (новые сначала)
-        posts.sort(key=lambda x: (
-            0 if x.get('is_pinned', False) else 1,  # 0 для закрепленных (выше), 1 для остальных
-        ))
-        
-        # Дополнительная сортировка внутри групп по дате
-        posts.sort(key=lambda x: (
-            0 if x.get('is_pinned', False) else 1,
-            x.get('published_at', '') or x.get('created_at', '')
-        ), reverse=True)
-        
-        # Ограничение количества
-        if limit:
-            posts = posts[:limit]
+            posts = [CounterBuffer.overlay('blog_posts', p) for p in DB._get_db('blog_posts')]
+            if category:
+                posts = [p for p in posts if p.get('category') == category]
+            if tag:
+                posts = [p for p in posts if tag in p.get('tags', [])]
+            ranked = {post_id: i for i, (post_id, _) in enumerate(BlogSearchIndex.search(search)[0])}
+            posts = sorted((p for p in posts if p['id'] in ranked), key=lambda p: ranked[p['id']])
+            return posts[:limit] if limit else posts
         
+        return DB.get_blog_page(category=category, tag=tag, limit=limit)[0]
+
+    @staticmethod
+    def get_blog_page(category=None, tag=None, published_only=False, cursor=None, limit=None):
+        """Страница постов в порядке выдачи (закрепленные, затем новые).
+
+        Возвращает (посты, курсор следующей страницы или None).
+        """
+        ids, next_cursor = BlogOrderIndex.page(category=category, tag=tag, published_only=published_only,
+                                               cursor=cursor, limit=limit)
+        if limit:
+            posts = [DB.get_blog_post(post_id) for post_id in ids]
+        else:
+            # Без лимита выгоднее одно чтение коллекции, чем запрос на каждый пост
+            by_id = {p['id']: p for p in DB._get_db('blog_posts')}
+            posts = [CounterBuffer.overlay('blog_posts', by_id.get(post_id)) for post_id in ids]
+        return [p for p in posts if p], next_cursor
+
+    @staticmethod
+    def get_related_posts(post_id, limit=3):
+        """Похожие опубликованные посты из готового списка соседей"""
+        posts = []
+        for related_id, score in RelatedPosts.get(post_id):
+            post = DB.get_blog_post(related_id)
+            if post and post.get('is_published'):
+                posts.append(dict(post, related_score=score))
+                if len(posts) == limit:
+                    break
         return posts
 
     @staticmethod
-    def get_blog_post(post_id):
-        """Получение конкретного поста"""
-        posts = DB.get_blog_posts()
-        return next((p for p in posts if p['id'] == post_id), None)
+    def get_tag_counts(published_only=True):
+        return BlogOrderIndex.tag_counts(published_only)
+
+    @staticmethod
+    def get_blog_post(post_id, with_content=False):
+        """Получение конкретного поста (тело - только по запросу with_content)"""
+        post = CounterBuffer.overlay('blog_posts', DB.backend.get('blog_posts', post_id))
+        if post and with_content:
+            post = DB.with_blog_content(post)
+        return post
+
+    @staticmethod
+    def get_blog_post_content(post):
+        """Тело поста из отдельного хранилища (у старых постов - из самого документа)"""
+        if 'content' in post:
+            return post['content'] or ''
+        return DB.backend.get_blob(BLOG_CONTENT_NAMESPACE, post['id']) or ''
+
+    @staticmethod
+    def with_blog_content(post):
+        """Копия поста с подгруженным телом"""
+        return dict(post, content=DB.get_blog_post_content(post))
+
+    @staticmethod
+    def split_blog_content(prune_orphans=False):
+        """Выносит тела постов из blog_posts в отдельное хранилище.
+
+        Запускается при импорте в каждом воркере, поэтому идет под
+        migration_lock: посты читаются заново уже под блокировкой, и
+        второй воркер не перепишет тело, измененное после переноса.
+        Повторный запуск безопасен: посты без поля content пропускаются.
+
+        prune_orphans=True (восстановление из бэкапа) удаляет тела постов,
+        которых нет в blog_posts. При обычном старте этого не делаем:
+        save_blog_post другого воркера пишет тело раньше документа.
+        """
+        with migration_lock(BLOG_CONTENT_NAMESPACE):
+            moved = 0
+            post_ids = set()
+            for post in DB._get_db('blog_posts'):
+                post_ids.add(str(post['id']))
+                if 'content' not in post:
+                    continue
+                # Сначала тело, потом документ: при сбое посередине данные не теряются
+                DB.backend.put_blob(BLOG_CONTENT_NAMESPACE, post['id'], post['content'] or '')
+                
+                def strip(doc):
+                    if doc is None or 'content' not in doc:
+                        return None
+                    doc.pop('content')
+                    return doc
+                
+                DB._update('blog_posts', post['id'], strip)
+                moved += 1
+            
+            if prune_orphans:
+                for key in DB.backend.list_blobs(BLOG_CONTENT_NAMESPACE):
+                    if key not in post_ids:
+                        DB.backend.delete_blob(BLOG_CONTENT_NAMESPACE, key)
+            
+            if moved:
+                logger.info(f'Moved content of {moved} blog posts to {BLOG_CONTENT_NAMESPACE}')
+            return moved
+
+    @staticmethod
+    def export_collection(collection):
+        """Коллекция для бэкапа: посты выгружаются вместе с телами, как раньше"""
+        docs = DB._get_db(collection)
+        if collection == 'blog_posts':
+            docs = [DB.with_blog_content(p) for p in docs]
+        if collection in PARTITIONED_COLLECTIONS:
+            docs = docs + WeekPartitions.all(collection, active_only=False)
+        if collection == 'sequences':
+            docs = [d for d in docs if not ChangeLog.is_version_doc(d)]
+        return docs
+
+    @staticmethod
+    def import_collection(collection, docs):
+        """Замена коллекции данными из бэкапа (после всех коллекций - finish_import)"""
+        if collection in PARTITIONED_COLLECTIONS:
+            WeekPartitions.replace(collection, docs)
+            docs = []
+        if collection == 'homeworks':
+            # Работы восстанавливаются следующей коллекцией бэкапа; в старых
+            # бэкапах они вложены в задания (см. split_homework_submissions)
+            DB._save_db('homework_submissions', [])
+        if collection == 'sequences':
+            # Версии ChangeLog остаются живыми: откат счетчика к значению из
+            # бэкапа воркеры приняли бы за отсутствие изменений
+            docs = [d for d in docs if not ChangeLog.is_version_doc(d)] + \
+                [d for d in DB._get_db('sequences') if ChangeLog.is_version_doc(d)]
+        DB._save_db(collection, docs)
+
+    @staticmethod
+    def finish_import():
+        """Сброс индексов воркеров после восстановления коллекций блога.
+
+        Вызывается один раз, когда импортированы все коллекции: отметки
+        "изменилось все" пишутся в sequences, и их нельзя ставить до того,
+        как восстановлена сама sequences.
+        """
+        for name in ('blog_posts', 'blog_views', 'blog_comments', 'blog_feeds', 'blog_pages'):
+            ChangeLog.bump(name, None)
 
     @staticmethod
     def save_blog_post(title, content, author, category='Общее', 
@@ -570,20 +4492,17 @@ class DB:
                        is_published=True, video_url=None, 
                        tags=None, meta_description=None, is_pinned=False):
         """Создание/обновление поста блога"""
-        posts = DB.get_blog_posts()
-        
         if excerpt is None:
             excerpt = content[:150] + '...' if len(content) > 150 else content
         
         if tags is None:
             tags = []
         
-        post_id = max([p['id'] for p in posts], default=0) + 1
+        post_id = SequenceAllocator.next_id('blog_posts')
         
         post = {
             'id': post_id,
             'title': title,
-            'content': content,
             'excerpt': excerpt,
             'author': author,
             'category': category,
@@ -602,85 +4521,172 @@ class DB:
             'updated_at': datetime.now().isoformat()
         }
         
-        posts.append(post)
-        DB._save_db('blog_posts', posts)
-        return post
+        # Тело хранится отдельно от метаданных поста
+        DB.backend.put_blob(BLOG_CONTENT_NAMESPACE, post_id, content)
+        DB._put('blog_posts', post)
+        ChangeLog.bump('blog_posts', post_id)
+        BlogFeeds.changed(post)
+        BlogSearchIndex.index_post(post, content)
+        RelatedPosts.schedule(post_id)
+        StaticBlogExport.schedule([post_id])
+        if cover_image:
+            ImageVariants.schedule('cover', post_id, cover_image)
+        return dict(post, content=content)
 
     @staticmethod
     def update_blog_post(post_id, data):
         """Обновление поста блога"""
-        posts = DB.get_blog_posts()
-        for i, post in enumerate(posts):
-            if post['id'] == post_id:
-                for key, value in data.items():
-                    if key in post:
-                        posts[i][key] = value
-                posts[i]['updated_at'] = datetime.now().isoformat()
-                
-                # Генерируем slug если изменился заголовок
-                if 'title' in data:
-                    posts[i]['slug'] = f"{post_id}-{data['title'].lower().replace(' ', '-').replace('/', '-')[:50]}"
-                
-                DB._save_db('blog_posts', posts)
-                return True
-        return False
+        data = dict(data)
+        content = data.pop('content', None)
+        if content is not None:
+            if not DB.backend.get('blog_posts', post_id):
+                return False
+            DB.backend.put_blob(BLOG_CONTENT_NAMESPACE, post_id, content)
+        
+        was_published = []
+        stale_variants = []
+        released_refs = []
+        cover_changed = []
+        
+        def apply(post):
+            if post is None:
+                return None
+            was_published[:] = [bool(post.get('is_published'))]
+            if 'cover_image' in data and data['cover_image'] != post.get('cover_image'):
+                cover_changed.append(True)
+                if post.get('cover_variants'):
+                    # Варианты старой обложки (новые запишет ImageVariants)
+                    stale_variants[:] = [post.pop('cover_variants')]
+                # Файл прежней обложки в ContentStore больше не нужен
+                if post.get('cover_ref') and post['cover_ref'] != data.get('cover_ref'):
+                    released_refs[:] = [post['cover_ref']]
+                post['cover_ref'] = data.get('cover_ref')
+            elif data.get('cover_ref') and data['cover_ref'] != post.get('cover_ref'):
+                # Тот же файл загружен повторно - лишняя ссылка не нужна
+                released_refs[:] = [data['cover_ref']]
+            for key, value in data.items():
+                if key in post and key != 'cover_ref':
+                    post[key] = value
+            post.pop('content', None)
+            post['updated_at'] = datetime.now().isoformat()
+            
+            # Генерируем slug если изменился заголовок
+            if 'title' in data:
+                post['slug'] = f"{post_id}-{data['title'].lower().replace(' ', '-').replace('/', '-')[:50]}"
+            return post
+        
+        post = DB._update('blog_posts', post_id, apply)
+        if post is None:
+            return False
+        ChangeLog.bump('blog_posts', post_id)
+        for variants in stale_variants:
+            ImageVariants.remove(variants)
+        for ref_id in released_refs:
+            ContentStore.release(ref_id)
+        if cover_changed and data['cover_image']:
+            ImageVariants.schedule('cover', post_id, data['cover_image'])
+        if FEED_FIELDS & set(data):
+            BlogFeeds.changed(post, was_published=was_published[0])
+        
+        # Поисковый индекс пересчитываем, только если изменилось то, что в нем есть
+        if BLOG_SEARCH_FIELDS & (set(data) | ({'content'} if content is not None else set())):
+            BlogSearchIndex.index_post(post, content if content is not None else DB.get_blog_post_content(post))
+        if RELATED_FIELDS & set(data):
+            RelatedPosts.schedule(post_id)
+        StaticBlogExport.schedule([post_id])
+        return True
 
     @staticmethod
     def delete_blog_post(post_id):
         """Удаление поста блога"""
-        posts = DB.get_blog_posts()
-        posts = [p for p in posts if p['id'] != post_id]
-        DB._save_db('blog_posts', posts)
+        post = DB.backend.get('blog_posts', post_id)
+        DB._delete('blog_posts', post_id)
+        ChangeLog.bump('blog_posts', post_id)
+        BlogFeeds.changed(post)
+        if post and post.get('cover_ref'):
+            ContentStore.release(post['cover_ref'])
+        DB.backend.delete_blob(BLOG_CONTENT_NAMESPACE, post_id)
+        BlogSearchIndex.remove_post(post_id)
+        RelatedPosts.schedule(post_id)
+        StaticBlogExport.schedule([post_id])
         return True
 
+    @staticmethod
+    def search_blog_posts(query, category=None, tag=None, limit=None):
+        """Поиск по индексу: посты по убыванию релевантности, фасеты и сниппеты"""
+        ranked, facets, terms = BlogSearchIndex.search(query, category=category, tag=tag)
+        total = len(ranked)
+        if limit:
+            ranked = ranked[:limit]
+        posts = []
+        for i, (post_id, score) in enumerate(ranked):
+            post = DB.get_blog_post(post_id)
+            if not post:
+                continue
+            # Новый словарь: документ из бэкенда может быть общим кэшем
+            post = dict(post, search_score=score)
+            if i < SEARCH_MAX_SNIPPETS:
+                post['snippet'] = BlogSearchIndex.snippet(DB.get_blog_post_content(post), terms)
+            posts.append(post)
+        return {'posts': posts, 'facets': facets, 'total': total}
+
     @staticmethod
     def increment_views(post_id):
         """Увеличение счетчика просмотров"""
-        posts = DB.get_blog_posts()
-        for i, post in enumerate(posts):
-            if post['id'] == post_id:
-                posts[i]['views'] = posts[i].get('views', 0) + 1
-                DB._save_db('blog_posts', posts)
-                return True
-        return False
+        if not DB.backend.get('blog_posts', post_id):
+            return False
+        # Просмотр пишется в хранилище пакетом (см. CounterBuffer)
+        CounterBuffer.increment('blog_posts', post_id, 'views')
+        return True
 
     @staticmethod
     def get_categories():
-        """Получение всех категорий блога"""
-        posts = DB.get_blog_posts()
-        categories = {}
-        for post in posts:
-            if post.get('is_published'):
-                category = post.get('category', 'Без категории')
-                categories[category] = categories.get(category, 0) + 1
-        return categories
+        """Получение всех категорий блога (число опубликованных постов)"""
+        return BlogAggregates.categories()
 
     @staticmethod
     def get_popular_posts(limit=5):
         """Получение популярных постов"""
-        posts = [p for p in DB.get_blog_posts() if p.get('is_published')]
-        posts.sort(key=lambda x: x.get('views', 0), reverse=True)
-        return posts[:limit]
+        posts = [DB.get_blog_post(post_id) for post_id in BlogAggregates.popular(min(limit, BLOG_TOP_POSTS))]
+        return [p for p in posts if p]
 
     @staticmethod
     def get_recent_posts(limit=5):
-        """Получение последних постов"""
-        return DB.get_blog_posts(limit=limit)
+        """Получение последних опубликованных постов"""
+        posts = [DB.get_blog_post(post_id) for post_id in BlogAggregates.recent(min(limit, BLOG_TOP_POSTS))]
+        return [p for p in posts if p]
 
     # Комментарии для блога
     @staticmethod
     def get_comments(post_id=None):
         """Получение комментариев"""
-        comments = DB._get_db('blog_comments')
         if post_id:
-            return [c for c in comments if c['post_id'] == post_id]
-        return comments
+            return DB.backend.find('blog_comments', 'post_id', post_id)
+        return DB._get_db('blog_comments')
+
+    @staticmethod
+    def get_comment_threads(post_id, after=None, limit=None):
+        """Комментарии поста деревом: (ветки после комментария after, id для следующей страницы или None).
+
+        Ветка - комментарий верхнего уровня с вложенными ответами в 'replies'.
+        Ответы на удаленные комментарии поднимаются на верхний уровень.
+        """
+        tree, next_after = CommentThreads.page(post_id, after, limit)
+        
+        # Читаются только комментарии страницы
+        def build(node):
+            comment_id, replies = node
+            comment = DB.backend.get('blog_comments', comment_id)
+            if comment is None:
+                return None
+            return dict(comment, replies=[r for r in map(build, replies) if r is not None])
+        
+        return [t for t in map(build, tree) if t is not None], next_after
 
     @staticmethod
     def save_comment(post_id, author, content, parent_id=None, author_email=None):
         """Сохранение комментария"""
-        comments = DB.get_comments()
-        comment_id = max([c['id'] for c in comments], default=0) + 1
+        comment_id = SequenceAllocator.next_id('blog_comments')
         
         comment = {
             'id': comment_id,
@@ -693,35 +4699,24 @@ class DB:
             'created_at': datetime.now().isoformat()
         }
         
-        # Обновляем счетчик комментариев в посте
-        posts = DB.get_blog_posts()
-        for i, post in enumerate(posts):
-            if post['id'] == post_id:
-                posts[i]['comments_count'] = posts[i].get('comments_count', 0) + 1
-                DB._save_db('blog_posts', posts)
-                break
+        # Счетчик комментариев в посте пишется пакетом (см. CounterBuffer)
+        CounterBuffer.increment('blog_posts', post_id, 'comments_count')
         
-        comments.append(comment)
-        DB._save_db('blog_comments', comments)
+        DB._put('blog_comments', comment)
+        ChangeLog.bump('blog_comments', comment_id)
         return comment
 
     @staticmethod
     def delete_comment(comment_id):
         """Удаление комментария"""
-        comments = DB.get_comments()
-        comment = next((c for c in comments if c['id'] == comment_id), None)
+        comment = DB.backend.get('blog_comments', comment_id)
         
         if comment:
             # Уменьшаем счетчик комментариев в посте
-            posts = DB.get_blog_posts()
-            for i, post in enumerate(posts):
-                if post['id'] == comment['post_id']:
-                    posts[i]['comments_count'] = max(posts[i].get('comments_count', 0) - 1, 0)
-                    DB._save_db('blog_posts', posts)
-                    break
+            CounterBuffer.increment('blog_posts', comment['post_id'], 'comments_count', -1)
             
-            comments = [c for c in comments if c['id'] != comment_id]
-            DB._save_db('blog_comments', comments)
+            DB._delete('blog_comments', comment_id)
+            ChangeLog.bump('blog_comments', comment_id)
             return True
         return False
 
@@ -739,17 +4734,22 @@ class DB:
             
             # Создаем временную директорию
             with tempfile.TemporaryDirectory() as temp_dir:
-                # Копируем все JSON файлы базы данных
-                for db_file in ['users', 'lessons', 'homeworks', 'conferences', 
-                              'testimonials', 'feedbacks', 'conference_links', 'blog_posts', 'blog_comments']:
-                    source = f'{DB_FOLDER}/{db_file}.json'
-                    if os.path.exists(source):
-                        shutil.copy2(source, os.path.join(temp_dir, f'{db_file}.json'))
+                # Выгружаем все коллекции базы данных в JSON (независимо от бэкенда)
+                for db_file in DB_COLLECTIONS:
+                    if DB.backend.exists(db_file):
+                        with open(os.path.join(temp_dir, f'{db_file}.json'), 'w') as f:
+                            json.dump(DB.export_collection(db_file), f, indent=2)
                 
                 # Копируем папку uploads (пользовательские файлы)
                 uploads_backup_dir = os.path.join(temp_dir, 'uploads')
                 if os.path.exists(UPLOAD_FOLDER):
-                    shutil.copytree(UPLOAD_FOLDER, uploads_backup_dir, dirs_exist_ok=True)
+                    # Без служебных каталогов: недокачанные части, карантин сборщика
+                    shutil.copytree(UPLOAD_FOLDER, uploads_backup_dir, dirs_exist_ok=True,
+                                    ignore=shutil.ignore_patterns('.*'))
+                
+                # Архив истекших партиций
+                if os.path.exists(ARCHIVE_FOLDER):
+                    shutil.copytree(ARCHIVE_FOLDER, os.path.join(temp_dir, 'archive'), dirs_exist_ok=True)
                 
                 # Создаем файл с метаинформацией
                 meta_info = {
@@ -788,11 +4788,11 @@ class DB:
             backup_path = os.path.join(BACKUP_FOLDER, backup_filename)
             
             with tempfile.TemporaryDirectory() as temp_dir:
-                # Копируем только файлы блога
+                # Выгружаем только коллекции блога
                 for db_file in ['blog_posts', 'blog_comments']:
-                    source = f'{DB_FOLDER}/{db_file}.json'
-                    if os.path.exists(source):
-                        shutil.copy2(source, os.path.join(temp_dir, f'{db_file}.json'))
+                    if DB.backend.exists(db_file):
+                        with open(os.path.join(temp_dir, f'{db_file}.json'), 'w') as f:
+                            json.dump(DB.export_collection(db_file), f, indent=2)
                 
                 # Создаем файл с метаинформацией
                 meta_info = {
@@ -864,13 +4864,22 @@ class DB:
                         logger.info(f'Restoring backup from: {meta_info.get("created_at")}')
                 
                 # Восстанавливаем JSON файлы базы данных
-                for db_file in ['users', 'lessons', 'homeworks', 'conferences', 
-                              'testimonials', 'feedbacks', 'conference_links', 'blog_posts', 'blog_comments']:
+                for db_file in DB_COLLECTIONS:
                     backup_file = os.path.join(temp_dir, f'{db_file}.json')
                     if os.path.exists(backup_file):
-                        shutil.copy2(backup_file, f'{DB_FOLDER}/{db_file}.json')
+                        # Снимок из бэкапа целиком заменяет коллекцию
+                        with open(backup_file, 'r') as f:
+                            DB.import_collection(db_file, json.load(f))
                         logger.info(f'Restored {db_file}.json')
                 
+                DB.finish_import()
+                # В бэкапе посты лежат вместе с телами
+                DB.split_blog_content(prune_orphans=True)
+                DB.split_homework_submissions()
+                BlogSearchIndex.rebuild()
+                RelatedPosts.rebuild()
+                StaticBlogExport.export_all()
+                
                 # Восстанавливаем загруженные файлы
                 uploads_backup_dir = os.path.join(temp_dir, 'uploads')
                 if os.path.exists(uploads_backup_dir):
@@ -889,6 +4898,13 @@ class DB:
                     
                     logger.info('Restored uploads folder')
                 
+                # Архивные недели из бэкапа добавляются к текущему архиву:
+                # недели, заархивированные после создания бэкапа, не пропадают
+                archive_backup_dir = os.path.join(temp_dir, 'archive')
+                if os.path.exists(archive_backup_dir):
+                    shutil.copytree(archive_backup_dir, ARCHIVE_FOLDER, dirs_exist_ok=True)
+                    logger.info('Restored archive folder')
+                
                 return True
                 
         except Exception as e:
@@ -920,9 +4936,16 @@ class DB:
                 for db_file in ['blog_posts', 'blog_comments']:
                     backup_file = os.path.join(temp_dir, f'{db_file}.json')
                     if os.path.exists(backup_file):
-                        shutil.copy2(backup_file, f'{DB_FOLDER}/{db_file}.json')
+                        # Снимок из бэкапа целиком заменяет коллекцию
+                        with open(backup_file, 'r') as f:
+                            DB.import_collection(db_file, json.load(f))
                         logger.info(f'Restored {db_file}.json')
                 
+                DB.finish_import()
+                DB.split_blog_content(prune_orphans=True)
+                BlogSearchIndex.rebuild()
+                RelatedPosts.rebuild()
+                StaticBlogExport.export_all()
                 return True
                 
         except Exception as e:
@@ -973,8 +4996,13 @@ class DB:
             logger.error(f'Error saving blog video: {e}')
             return None
 
+# Связанные данные при архивации партиции: (дополнить документы архива, удалить хвосты)
+PARTITION_ARCHIVE_HOOKS = {
+    'homeworks': (DB._embed_submissions, DB._purge_submissions)
+}
+
 # Инициализация базы данных
-if not os.path.exists(f'{DB_FOLDER}/users.json'):
+if not DB.backend.exists('users'):
     initial_users = [
         {
             'username': 'admin',
@@ -1024,7 +5052,8 @@ if not os.path.exists(f'{DB_FOLDER}/users.json'):
             'files': [],
             'subject': 'Английский язык',
             'created_at': datetime.now().isoformat(),
-            'submissions': {}
+            'submissions_count': 0,
+            'last_submitted_at': None
         }
     ]
     
@@ -1053,10 +5082,10 @@ if not os.path.exists(f'{DB_FOLDER}/users.json'):
     DB._save_db('testimonials', initial_testimonials)
 
 # Инициализация новых таблиц
-if not os.path.exists(f'{DB_FOLDER}/feedbacks.json'):
+if not DB.backend.exists('feedbacks'):
     DB._save_db('feedbacks', [])
     
-if not os.path.exists(f'{DB_FOLDER}/conference_links.json'):
+if not DB.backend.exists('conference_links'):
     initial_links = [
         {
             'id': 1,
@@ -1086,12 +5115,48 @@ if not os.path.exists(f'{DB_FOLDER}/conference_links.json'):
     DB._save_db('conference_links', initial_links)
 
 # Инициализация таблиц для блога
-if not os.path.exists(f'{DB_FOLDER}/blog_posts.json'):
+if not DB.backend.exists('blog_posts'):
     DB._save_db('blog_posts', [])
     
-if not os.path.exists(f'{DB_FOLDER}/blog_comments.json'):
+if not DB.backend.exists('blog_comments'):
     DB._save_db('blog_comments', [])
 
+# Тела постов хранятся отдельно от blog_posts
+DB.split_blog_content()
+
+# Поисковый индекс блога хранится вместе с данными; строим его только один раз
+if not DB.backend.exists('blog_search'):
+    BlogSearchIndex.rebuild()
+if not DB.backend.exists('blog_related'):
+    RelatedPosts.rebuild()
+if not StaticBlogExport.is_current():
+    # Страницы рендерятся после регистрации всех роутов
+    eventlet.spawn(export_static_blog)
+
+# Домашние задания хранятся в недельных партициях, работы учеников - отдельно
+if not DB.backend.exists('homework_submissions'):
+    DB._save_db('homework_submissions', [])
+for _collection in PARTITIONED_COLLECTIONS:
+    WeekPartitions.migrate_legacy(_collection)
+DB.split_homework_submissions()
+
+# Запускаем фоновое уплотнение журналов (только для JSON-бэкенда)
+if isinstance(DB.backend, JsonBackend):
+    eventlet.spawn(compact_journals)
+
+# Запускаем перенос истекших партиций в архив
+eventlet.spawn(archive_partitions)
+
+# Запускаем очистку брошенных загрузок по частям
+eventlet.spawn(expire_uploads)
+
+# Запускаем сборку мусора в uploads и пересчет занятого места
+eventlet.spawn(collect_uploads)
+
+# Запускаем сброс отложенных счетчиков; остаток пишем при остановке воркера
+eventlet.spawn(flush_counters)
+atexit.register(CounterBuffer.flush)
+
 # Middleware для обработки безопасности
 @app.after_request
 def add_security_headers(response):
@@ -1114,6 +5179,9 @@ def add_security_headers(response):
     # Заголовки кэширования
     if request.path.startswith('/static/'):
         response.headers['Cache-Control'] = 'public, max-age=3600'
+    elif request.endpoint in CACHEABLE_PAGE_ENDPOINTS and response.status_code in (200, 304):
+        # Страницы из PageCache сами задали Cache-Control, ETag и Last-Modified
+        pass
     else:
         response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         response.headers['Pragma'] = 'no-cache'
@@ -1499,12 +5567,25 @@ def api_blog_posts():
     limit = request.args.get('limit', type=int)
     search = request.args.get('search')
     popular = request.args.get('popular', type=bool)
+    recent = request.args.get('recent', type=bool)
     tag = request.args.get('tag')
     
     if popular:
         posts = DB.get_popular_posts(limit or 5)
+    elif recent:
+        posts = DB.get_recent_posts(limit or 5)
+    elif search:
+        # В поисковом индексе только опубликованные посты
+        return jsonify(DB.search_blog_posts(search, category=category, tag=tag, limit=limit))
     else:
-        posts = DB.get_blog_posts(category=category, limit=limit, search=search, tag=tag)
+        # Черновики видят только учителя; фильтр применяется до лимита страницы
+        try:
+            posts, next_cursor = DB.get_blog_page(
+                category=category, tag=tag, cursor=request.args.get('cursor') or None, limit=limit,
+                published_only='user' not in session or session['user']['role'] != 'teacher')
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        return jsonify({'posts': posts, 'next_cursor': next_cursor})
     
     # Фильтруем только опубликованные для обычных пользователей
     if 'user' not in session or session['user']['role'] != 'teacher':
@@ -1515,7 +5596,7 @@ def api_blog_posts():
 @app.route('/api/blog/posts/<int:post_id>', methods=['GET'])
 def api_blog_post(post_id):
     """Получение конкретного поста"""
-    post = DB.get_blog_post(post_id)
+    post = DB.get_blog_post(post_id, with_content=True)
     
     if not post:
         return jsonify({'error': 'Post not found'}), 404
@@ -1630,17 +5711,14 @@ def api_upload_cover(post_id):
         return jsonify({'error': 'No selected file'}), 400
     
     if file:
-        # Создаем уникальное имя файла
-        filename = secure_filename(f"cover_{post_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        # Формируем URL для доступа к файлу
-        cover_url = url_for('uploaded_file', filename=filename, _external=True)
+        # Одинаковые изображения хранятся один раз (ContentStore)
+        stored = ContentStore.put_file(file, session['user']['username'], 'cover')
+        cover_url = ContentStore.public_url(stored)
         
         # Обновляем пост
-        if DB.update_blog_post(post_id, {'cover_image': cover_url}):
+        if DB.update_blog_post(post_id, {'cover_image': cover_url, 'cover_ref': stored['id']}):
             return jsonify({'success': True, 'cover_url': cover_url})
+        ContentStore.release(stored['id'])
     
     return jsonify({'error': 'Failed to upload cover image'}), 500
 
@@ -1666,11 +5744,8 @@ def api_upload_blog_video(post_id):
     if ext not in ALLOWED_EXTENSIONS_VIDEO:
         return jsonify({'error': f'Unsupported video format. Allowed: {", ".join(ALLOWED_EXTENSIONS_VIDEO)}'}), 400
     
-    # Проверяем размер
-    file.seek(0, 2)
-    size = file.tell()
-    file.seek(0)
-    if size > MAX_VIDEO_SIZE:
+    # Проверяем размер по заголовку, не дочитывая файл (большие видео - через /api/uploads)
+    if request.content_length and request.content_length > MAX_VIDEO_SIZE:
         return jsonify({'error': f'Video too large. Max size: {MAX_VIDEO_SIZE // (1024*1024)}MB'}), 400
     
     video_url = DB.save_blog_video(post_id, file)
@@ -1708,6 +5783,35 @@ def api_delete_blog_video(post_id):
     
     return jsonify({'error': 'Video not found'}), 404
 
+@app.route('/api/blog/posts/<int:post_id>/view', methods=['POST'])
+def api_blog_post_view(post_id):
+    """Просмотр со статической страницы поста: засчитывает его и возвращает счетчики"""
+    post = DB.get_blog_post(post_id)
+    if not post or not post.get('is_published'):
+        return jsonify({'error': 'Post not found'}), 404
+    
+    DB.increment_views(post_id)
+    post = DB.get_blog_post(post_id)
+    return jsonify({'views': post.get('views', 0), 'comments_count': post.get('comments_count', 0)})
+
+@app.route('/api/blog/posts/<int:post_id>/related', methods=['GET'])
+def api_blog_related_posts(post_id):
+    """Похожие посты (?limit=, по умолчанию 3)"""
+    post = DB.get_blog_post(post_id)
+    if not post:
+        return jsonify({'error': 'Post not found'}), 404
+    
+    if not post.get('is_published', False) and ('user' not in session or session['user']['role'] != 'teacher'):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    limit = min(request.args.get('limit', 3, type=int), RELATED_POSTS_LIMIT)
+    return jsonify({'posts': DB.get_related_posts(post_id, limit=limit)})
+
+@app.route('/api/blog/tags', methods=['GET'])
+def api_blog_tags():
+    """Теги опубликованных постов с количеством"""
+    return jsonify({'tags': DB.get_tag_counts()})
+
 @app.route('/api/blog/categories', methods=['GET'])
 def api_blog_categories():
     """Получение категорий блога"""
@@ -1716,10 +5820,11 @@ def api_blog_categories():
 
 @app.route('/api/blog/posts/<int:post_id>/comments', methods=['GET', 'POST'])
 def api_blog_comments(post_id):
-    """Управление комментариями"""
+    """Управление комментариями (GET - деревом, по веткам: ?after=<id ветки>&limit=)"""
     if request.method == 'GET':
-        comments = DB.get_comments(post_id)
-        return jsonify({'comments': comments})
+        threads, next_after = DB.get_comment_threads(
+            post_id, after=request.args.get('after', type=int), limit=request.args.get('limit', type=int))
+        return jsonify({'comments': threads, 'next_after': next_after})
     
     elif request.method == 'POST':
         data = request.json
@@ -1733,6 +5838,11 @@ def api_blog_comments(post_id):
         if not post or (not post.get('is_published') and ('user' not in session or session['user']['role'] != 'teacher')):
             return jsonify({'error': 'Post not found or not published'}), 404
         
+        if data.get('parent_id') is not None:
+            parent = DB.backend.get('blog_comments', data['parent_id'])
+            if not parent or parent.get('post_id') != post_id:
+                return jsonify({'error': 'Parent comment not found'}), 400
+        
         comment = DB.save_comment(
             post_id=post_id,
             author=data['author'],
@@ -1760,8 +5870,43 @@ def api_delete_blog_comment(comment_id):
 
 @app.route('/blog')
 def blog():
-    """Главная страница блога"""
-    return render_template('blog.html', user=session.get('user'))
+    """Главная страница блога (посты подгружаются скриптом, страница зависит только от роли)"""
+    key = ('blog', PageCache.role())
+    entry = PageCache.get(key)
+    if entry is None:
+        entry = PageCache.put(key, render_template('blog.html', user=session.get('user')))
+    return PageCache.respond(entry, max_age=60)
+
+@app.route('/blog/feed.xml')
+def blog_feed():
+    """RSS-лента последних опубликованных постов"""
+    return BlogFeeds.respond(BlogFeeds.get('feed'), 'application/rss+xml')
+
+@app.route('/sitemap.xml')
+def sitemap():
+    """Карта сайта для поисковых роботов"""
+    return BlogFeeds.respond(BlogFeeds.get('sitemap'), 'application/xml')
+
+def render_blog_post_html(post, static_export=False):
+    """HTML страницы поста с метками вместо счетчиков (для PageCache и статического экспорта)"""
+    post = DB.with_blog_content(post)
+    
+    # Получаем автора
+    author = DB.get_user(post['author'])
+    author_avatar = author['avatar'] if author else None
+    author_avatar_variants = author.get('avatar_variants') if author else None
+    
+    # Похожие посты - из заранее посчитанных соседей
+    similar_posts = DB.get_related_posts(post['id'], limit=3)
+    
+    # Счетчики меняются чаще страницы - в HTML идут метки, значения подставляются при отдаче
+    return render_template('blog_post.html',
+                           post=dict(post, **PAGE_COUNTER_MARKERS),
+                           author_avatar=author_avatar,
+                           author_avatar_variants=author_avatar_variants,
+                           similar_posts=similar_posts,
+                           user=session.get('user'),
+                           static_export=static_export)
 
 @app.route('/blog/post/<path:slug>')
 def blog_post(slug):
@@ -1774,8 +5919,7 @@ def blog_post(slug):
             post = DB.get_blog_post(post_id)
         else:
             # Если не нашли по ID, ищем по slug
-            posts = DB.get_blog_posts()
-            post = next((p for p in posts if p.get('slug') == slug), None)
+            post = next(iter(DB.backend.find('blog_posts', 'slug', slug)), None)
         
         if not post:
             return render_template('404.html'), 404
@@ -1784,24 +5928,17 @@ def blog_post(slug):
         if not post.get('is_published') and ('user' not in session or session['user']['role'] != 'teacher'):
             return render_template('403.html'), 403
         
-        # Увеличиваем счетчик просмотров
+        # Просмотр засчитывается и при отдаче из кэша, и при ответе 304
         DB.increment_views(post['id'])
+        counters = DB.get_blog_post(post['id']) or post
         
-        # Получаем автора
-        author = DB.get_user(post['author'])
-        author_avatar = author['avatar'] if author else None
-        
-        # Получаем похожие посты
-        similar_posts = [p for p in DB.get_blog_posts() 
-                        if p.get('is_published') and 
-                        p['id'] != post['id'] and 
-                        p.get('category') == post.get('category')][:3]
+        key = ('blog_post', post['id'], PageCache.role())
+        entry = PageCache.get(key)
+        if entry is None:
+            entry = PageCache.put(key, render_blog_post_html(post),
+                                  datetime.fromisoformat(post.get('updated_at') or post['created_at']))
         
-        return render_template('blog_post.html', 
-                             post=post,
-                             author_avatar=author_avatar,
-                             similar_posts=similar_posts,
-                             user=session.get('user'))
+        return PageCache.respond(entry, counters={field: counters.get(field) for field in PAGE_COUNTER_MARKERS})
     
     except Exception as e:
         logger.error(f'Error loading blog post: {e}')
@@ -1821,7 +5958,7 @@ def edit_blog_post(post_id):
     if 'user' not in session or session['user']['role'] != 'teacher':
         return redirect('/blog')
     
-    post = DB.get_blog_post(post_id)
+    post = DB.get_blog_post(post_id, with_content=True)
     if not post:
         return redirect('/blog')
     
@@ -1952,7 +6089,7 @@ def download_backup(filename):
     
     filepath = DB.get_backup_filepath(filename)
     if filepath:
-        return send_from_directory(
+        return send_protected_file(
             BACKUP_FOLDER, 
             filename, 
             as_attachment=True,
@@ -2048,7 +6185,7 @@ def upload_backup_chunk():
                 for i in range(total_chunks):
                     chunk_path = os.path.join(temp_dir, f'{i:05d}')
                     with open(chunk_path, 'rb') as chunk_file:
-                        final_file.write(chunk_file.read())
+                        shutil.copyfileobj(chunk_file, final_file, 1024 * 1024)
             
             # Восстанавливаем из собранного файла
             success = DB.restore_backup(final_path)
@@ -2102,6 +6239,37 @@ def health_check():
         'user_authenticated': 'user' in session
     })
 
+# Статистика кэша коллекций текущего воркера
+@app.route('/api/db/stats')
+def db_stats():
+    if 'user' not in session or session['user']['role'] != 'teacher':
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return jsonify({
+        'status': 'ok',
+        'storage': DB.backend.stats(),
+        'counters': CounterBuffer.stats(),
+        'blog_search': BlogSearchIndex.stats(),
+        'blog_aggregates': BlogAggregates.stats(),
+        'blog_feeds': BlogFeeds.stats(),
+        'static_export': StaticBlogExport.stats(),
+        'image_variants': ImageVariants.stats(),
+        'uploads_gc': UploadGC.stats(),
+        'page_cache': PageCache.stats(),
+        'timestamp': datetime.now().isoformat()
+    })
+
+# Занятое загрузками место (индекс обновляет UploadGC)
+@app.route('/api/storage/usage')
+def api_storage_usage():
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    username = request.args.get('user')
+    if session['user']['role'] != 'teacher':
+        # Ученик видит только свое
+        return jsonify(UploadGC.usage(session['user']['username']))
+    return jsonify(UploadGC.usage(username))
+
 # Robots.txt
 @app.route('/robots.txt')
 def robots():
@@ -2244,18 +6412,16 @@ def api_update_avatar(username):
         return jsonify({'error': 'No selected file'}), 400
     
     if file:
-        filename = secure_filename(f"{username}_{file.filename}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        stored = ContentStore.put_file(file, session['user']['username'], 'avatar')
+        avatar_url = ContentStore.public_url(stored)
         
-        avatar_url = url_for('uploaded_file', filename=filename, _external=True)
-        
-        if DB.update_user(username, {'avatar': avatar_url}):
+        if DB.update_user(username, {'avatar': avatar_url, 'avatar_ref': stored['id']}):
             # Обновляем сессию, если пользователь обновляет свой профиль
             if session['user']['username'] == username:
                 session['user']['avatar'] = avatar_url
             
             return jsonify({'success': True, 'avatar': avatar_url})
+        ContentStore.release(stored['id'])
     
     return jsonify({'error': 'Failed to update avatar'}), 500
 
@@ -2298,7 +6464,7 @@ def api_lessons():
     if session['user']['role'] == 'teacher':
         lessons = DB.get_lessons(teacher=session['user']['username'])
     else:
-        lessons = [l for l in DB.get_lessons() if session['user']['username'] in l.get('students', [])]
+        lessons = DB.get_student_lessons(session['user']['username'])
     
     return jsonify({'lessons': lessons})
 
@@ -2328,19 +6494,6 @@ def api_homework():
         if session['user']['role'] != 'teacher':
             return jsonify({'error': 'Only teachers can assign homework'}), 403
         
-        files = []
-        if 'files' in request.files:
-            for file in request.files.getlist('files'):
-                if file.filename != '':
-                    filename = secure_filename(file.filename)
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(filepath)
-                    files.append({
-                        'name': filename,
-                        'path': filepath,
-                        'size': os.path.getsize(filepath)
-                    })
-        
         lesson_id = request.form.get('lesson_id')
         title = request.form.get('title')
         description = request.form.get('description')
@@ -2351,6 +6504,10 @@ def api_homework():
         if not all([lesson_id, title, description, deadline, students, subject]):
             return jsonify({'error': 'Missing required fields'}), 400
         
+        # Одинаковые файлы хранятся один раз (ContentStore)
+        files = [ContentStore.put_file(file, session['user']['username'], 'homework')
+                 for file in request.files.getlist('files') if file.filename != '']
+        
         homework = DB.save_homework(
             lesson_id=int(lesson_id),
             title=title,
@@ -2364,11 +6521,32 @@ def api_homework():
         
         return jsonify({'success': True, 'homework': homework})
     
+    # Сводка по работам (submissions_count, last_submitted_at) уже в заданиях;
+    # сами работы подгружаются только по запросу ?include=submissions
     if session['user']['role'] == 'teacher':
         homeworks = DB.get_teacher_homeworks(session['user']['username'])
+        if request.args.get('include') == 'submissions':
+            homeworks = [DB.with_submissions(hw) for hw in homeworks]
     else:
-        homeworks = DB.get_student_homeworks(session['user']['username'])
+        homeworks = [DB.with_submissions(hw, session['user']['username'])
+                     for hw in DB.get_student_homeworks(session['user']['username'])]
+    
+    return jsonify({'homeworks': homeworks})
+
+@app.route('/api/homework/archive', methods=['GET'])
+def api_homework_archive():
+    """Архивные задания учителя: ?from=YYYY-MM-DD&to=YYYY-MM-DD"""
+    if 'user' not in session or session['user']['role'] != 'teacher':
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        since = datetime.strptime(request.args['from'], '%Y-%m-%d') if request.args.get('from') else None
+        until = datetime.strptime(request.args['to'], '%Y-%m-%d') + timedelta(days=1) \
+            if request.args.get('to') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid date format, expected YYYY-MM-DD'}), 400
     
+    homeworks = DB.get_archived_homeworks(session['user']['username'], since, until)
     return jsonify({'homeworks': homeworks})
 
 @app.route('/api/homework/<int:homework_id>', methods=['GET'])
@@ -2385,8 +6563,31 @@ def api_get_homework(homework_id):
     if session['user']['role'] == 'teacher' and homework['teacher'] != session['user']['username']:
         return jsonify({'error': 'Access denied'}), 403
     
+    if session['user']['role'] == 'student':
+        homework = DB.with_submissions(homework, session['user']['username'])
+    else:
+        homework = DB.with_submissions(homework)
     return jsonify({'homework': homework})
 
+@app.route('/api/homework/<int:homework_id>/submissions.zip')
+def api_homework_submissions_zip(homework_id):
+    if 'user' not in session or session['user']['role'] != 'teacher':
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    homework = DB.get_homework(homework_id)
+    if not homework:
+        return jsonify({'error': 'Homework not found'}), 404
+    if homework['teacher'] != session['user']['username']:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    # Архив собирается на лету: первые байты уходят сразу, память постоянна
+    response = app.response_class(ZipStream.generate(ZipStream.submission_entries(homework_id)),
+                                  mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename=homework_{homework_id}_submissions.zip'
+    # nginx не должен копить ответ в буфере
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/api/homework/<int:homework_id>', methods=['DELETE'])
 def api_delete_homework(homework_id):
     if 'user' not in session or session['user']['role'] != 'teacher':
@@ -2411,21 +6612,15 @@ def api_submit_homework(homework_id):
     student_username = session['user']['username']
     comment = request.form.get('comment', '')
     
-    files = []
-    if 'files' in request.files:
-        for file in request.files.getlist('files'):
-            if file.filename != '':
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                files.append({
-                    'name': filename,
-                    'path': filepath,
-                    'size': os.path.getsize(filepath)
-                })
+    if not DB.get_homework(homework_id):
+        return jsonify({'error': 'Homework not found or access denied'}), 404
+    
+    files = [ContentStore.put_file(file, student_username, 'submission')
+             for file in request.files.getlist('files') if file.filename != '']
     
     if DB.submit_homework(homework_id, student_username, comment, files):
         return redirect(url_for('dashboard'))
+    ContentStore.release_files(files)
     return jsonify({'error': 'Homework not found or access denied'}), 404
 
 # Новый эндпоинт для загрузки домашнего задания
@@ -2441,27 +6636,93 @@ def api_upload_homework():
     if not homework_id:
         return jsonify({'error': 'Homework ID is required'}), 400
     
-    files = []
-    if 'files' in request.files:
-        for file in request.files.getlist('files'):
-            if file.filename != '':
-                filename = secure_filename(f"{student_username}_{homework_id}_{file.filename}")
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                files.append({
-                    'name': filename,
-                    'path': filepath,
-                    'size': os.path.getsize(filepath)
-                })
+    # Файлы, уже загруженные по частям (/api/uploads)
+    try:
+        files = ResumableUploads.claim_homework_files(request.form.getlist('upload_ids'), session['user'],
+                                                      int(homework_id))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    files += [ContentStore.put_file(file, student_username, 'submission')
+              for file in request.files.getlist('files') if file.filename != '']
     
     if DB.submit_homework(int(homework_id), student_username, comment, files):
         return jsonify({'success': True})
+    ContentStore.release_files(files)
     return jsonify({'error': 'Failed to submit homework'}), 500
 
+# ===== ЗАГРУЗКА ФАЙЛОВ ПО ЧАСТЯМ =====
+
+@app.route('/api/uploads', methods=['POST'])
+def api_create_upload():
+    """Создание загрузки: {purpose, target_id, filename, size, checksum?} -> id и размер части"""
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    data = request.json or {}
+    try:
+        upload = ResumableUploads.create(session['user'], data.get('purpose'), data.get('target_id'),
+                                         data.get('filename'), data.get('size'), data.get('checksum'))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    response = jsonify(upload)
+    response.status_code = 201
+    response.headers['Location'] = url_for('api_upload', upload_id=upload['id'])
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'PATCH', 'DELETE'])
+def api_upload(upload_id):
+    """Состояние загрузки (для продолжения), прием части (?chunk=<номер>) и отмена"""
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        if request.method == 'GET':
+            return jsonify(ResumableUploads.get(upload_id, session['user']))
+        if request.method == 'DELETE':
+            ResumableUploads.abort(upload_id, session['user'])
+            return jsonify({'success': True})
+        
+        index = request.args.get('chunk', type=int)
+        if index is None:
+            return jsonify({'error': 'Chunk index is required'}), 400
+        upload = ResumableUploads.write_chunk(upload_id, session['user'], index, request.stream,
+                                              request.content_length,
+                                              request.headers.get('Upload-Checksum'))
+        return jsonify({'success': True, 'received': len(upload['received']), 'chunks': upload['chunks']})
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def api_complete_upload(upload_id):
+    """Завершение загрузки: файл переносится на место, пост или работа обновляются"""
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        return jsonify(dict(ResumableUploads.complete(upload_id, session['user']), success=True))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+
 # Загрузка файлов
-@app.route('/uploads/<filename>')
+@app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Служебные каталоги (недокачанные части, временные файлы ContentStore) не раздаются
+    if any(part.startswith('.') for part in filename.split('/')):
+        return jsonify({'error': 'File not found'}), 404
+    return send_protected_file(UPLOAD_FOLDER, filename)
+
+@app.route('/files/<ref_id>/<path:name>')
+def stored_file(ref_id, name):
+    """Файл из ContentStore под исходным именем"""
+    ref = ContentStore.get_ref(ref_id)
+    blob = DB.backend.get('file_blobs', ref['sha256']) if ref else None
+    if blob is None or not os.path.exists(ContentStore.path(blob)):
+        return jsonify({'error': 'File not found'}), 404
+    # Файлы заданий и работ - только для вошедших пользователей
+    if ref['kind'] in ('homework', 'submission') and 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    return send_protected_file(UPLOAD_FOLDER, blob['path'], download_name=ref['name'], max_age=3600)
 
 # Личный кабинет
 @app.route('/dashboard')
@@ -2474,17 +6735,17 @@ def dashboard():
         homeworks = DB.get_teacher_homeworks(session['user']['username'])
         students = DB.get_users(role='student')
     else:
-        lessons = [l for l in DB.get_lessons() if session['user']['username'] in l.get('students', [])]
+        lessons = DB.get_student_lessons(session['user']['username'])
         homeworks = DB.get_student_homeworks(session['user']['username'])
         students = []
     
     # Загружаем ссылки на конференции
-    conference_links = DB.get_conference_links()
-    teacher_links = [l for l in conference_links if l['teacher_username'] == session['user']['username'] and l['is_active']]
-    default_links = [l for l in conference_links if l['teacher_username'] == 'admin' and l['is_active']]
+    teacher_links = [l for l in DB.get_conference_links(session['user']['username']) if l['is_active']]
+    default_links = [l for l in DB.get_conference_links('admin') if l['is_active']]
     
+    account = DB.get_user(session['user']['username']) or {}
     return render_template('dashboard.html', 
-                         user=session['user'],
+                         user=dict(session['user'], avatar_variants=account.get('avatar_variants')),
                          lessons=lessons,
                          homeworks=homeworks,
                          students=students,
@@ -2636,8 +6897,7 @@ def api_delete_feedback(feedback_id):
     if 'user' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    feedbacks = DB.get_feedbacks()
-    feedback = next((f for f in feedbacks if f['id'] == feedback_id), None)
+    feedback = DB.get_feedback(feedback_id)
     
     if not feedback:
         return jsonify({'error': 'Feedback not found'}), 404
@@ -2676,10 +6936,10 @@ def api_conference_links():
     # GET запрос
     teacher_username = request.args.get('teacher_username')
     if teacher_username:
-        links = [l for l in DB.get_conference_links() if l['teacher_username'] == teacher_username and l['is_active']]
+        links = [l for l in DB.get_conference_links(teacher_username) if l['is_active']]
     else:
         # По умолчанию показываем ссылки для admin
-        links = [l for l in DB.get_conference_links() if l['teacher_username'] == 'admin' and l['is_active']]
+        links = [l for l in DB.get_conference_links('admin') if l['is_active']]
     
     return jsonify({'links': links})
 
@@ -2688,8 +6948,7 @@ def api_delete_conference_link(link_id):
     if 'user' not in session or session['user']['role'] != 'teacher':
         return jsonify({'error': 'Unauthorized'}), 401
     
-    links = DB.get_conference_links()
-    link = next((l for l in links if l['id'] == link_id), None)
+    link = DB.get_conference_link(link_id)
     
     if not link:
         return jsonify({'error': 'Link not found'}), 404
@@ -2710,6 +6969,133 @@ def api_contact():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# ===== КОМАНДЫ ОБСЛУЖИВАНИЯ (flask <команда>) =====
+
+@app.cli.command('migrate-json')
+@click.option('--backend', 'target', type=click.Choice(['sqlite', 'postgres']),
+              default=None, help='Целевой бэкенд (по умолчанию из DB_BACKEND)')
+def migrate_json(target):
+    """Переносит коллекции из data/*.json (снимок + журнал) в SQL-бэкенд"""
+    if target:
+        os.environ['DB_BACKEND'] = target
+    backend = create_storage_backend()
+    if isinstance(backend, JsonBackend):
+        raise click.UsageError('Set DB_BACKEND=sqlite|postgres or pass --backend')
+    
+    source = JsonBackend()
+    partitions = [p['name'] for p in JournalStore.get('partitions')]
+    for collection in DB_COLLECTIONS + ['partitions'] + partitions:
+        if not source.exists(collection):
+            continue
+        docs = JournalStore.get(collection)
+        backend.replace(collection, docs)
+        click.echo(f'{collection}: {len(docs)} documents -> {backend.name}')
+    for namespace in BLOB_NAMESPACES:
+        keys = source.list_blobs(namespace)
+        for key in keys:
+            backend.put_blob(namespace, key, source.get_blob(namespace, key))
+        click.echo(f'{namespace}: {len(keys)} blobs -> {backend.name}')
+    backend.close()
+
+@app.cli.command('convert-db')
+@click.option('--codec', type=click.Choice(CollectionCodec.CODECS), default=None,
+              help='Кодек (по умолчанию настроенный для коллекции)')
+@click.argument('collections', nargs=-1)
+def convert_db(codec, collections):
+    """Переписывает снимки JSON-коллекций в другом формате (журнал сливается в снимок)"""
+    source = JsonBackend()
+    partitions = [p['name'] for p in JournalStore.get('partitions')]
+    for collection in collections or DB_COLLECTIONS + ['partitions'] + partitions:
+        if not source.exists(collection):
+            continue
+        path = JournalStore._snapshot_path(collection)
+        before = os.path.getsize(path) if os.path.exists(path) else 0
+        JournalStore.rewrite(collection, codec=codec)
+        target = codec or CollectionCodec.for_collection(collection)
+        click.echo(f'{collection}: {before} -> {os.path.getsize(path)} bytes ({target})')
+
+@app.cli.command('archive-partitions')
+def archive_partitions_command():
+    """Немедленно переносит истекшие недельные партиции в архив"""
+    for collection in PARTITIONED_COLLECTIONS:
+        click.echo(f'{collection}: {WeekPartitions.archive_expired(collection)} partitions archived')
+
+@app.cli.command('reindex-blog')
+def reindex_blog():
+    """Перестраивает поисковый индекс блога"""
+    click.echo(f'blog_search: {BlogSearchIndex.rebuild()} posts indexed')
+
+@app.cli.command('rebuild-blog-aggregates')
+def rebuild_blog_aggregates():
+    """Пересчитывает категории, популярные и последние посты во всех воркерах"""
+    click.echo(f'blog_aggregates: {BlogAggregates.rebuild()} published posts')
+
+@app.cli.command('backfill-images')
+@click.option('--force', is_flag=True, help='Пересоздать и уже существующие варианты')
+def backfill_images(force):
+    """Создает уменьшенные копии уже загруженных обложек и аватаров"""
+    for kind, count in ImageVariants.backfill(force=force).items():
+        click.echo(f'{kind}: {count} images processed')
+
+@app.cli.command('gc-uploads')
+def gc_uploads():
+    """Переносит файлы без ссылок в карантин, удаляет истекшие, пересчитывает место"""
+    result = UploadGC.collect()
+    if result is None:
+        click.echo('Upload GC is already running')
+        return
+    for key, value in result.items():
+        click.echo(f'{key}: {value}')
+
+@app.cli.command('export-blog')
+def export_blog():
+    """Выгружает гостевые страницы блога для nginx"""
+    click.echo(f'{PRERENDER_FOLDER}: {StaticBlogExport.export_all()} posts exported')
+
+@app.cli.command('rebuild-related')
+def rebuild_related():
+    """Пересчитывает похожие посты для всех опубликованных постов"""
+    click.echo(f'blog_related: {RelatedPosts.rebuild()} posts')
+
+@app.cli.command('bench-storage')
+@click.option('--posts', default=10000, help='Число постов в наборе')
+@click.option('--users', default=100000, help='Число пользователей в наборе')
+def bench_storage(posts, users):
+    """Сравнивает время сохранения и загрузки снимков в разных кодеках"""
+    paragraph = ('Подготовка к ЕГЭ по английскому языку требует системной работы '
+                 'с грамматикой, лексикой и устной частью экзамена. ') * 12
+    datasets = {
+        f'blog_posts x{posts}': [{
+            'id': i, 'title': f'Статья номер {i}: как сдать экзамен', 'content': paragraph,
+            'excerpt': paragraph[:150], 'author': 'teacher1', 'category': 'Подготовка к ЕГЭ',
+            'tags': ['ЕГЭ', 'английский', 'грамматика'], 'is_published': True, 'views': i * 7,
+            'created_at': datetime.now().isoformat(), 'slug': f'{i}-statya'
+        } for i in range(posts)],
+        f'users x{users}': [{
+            'username': f'user{i}', 'email': f'user{i}@example.com',
+            'password': 'pbkdf2:sha256:600000$' + 'x' * 80, 'role': 'student',
+            'is_active': True, 'phone': '+79990000000', 'created_at': datetime.now().isoformat(),
+            'avatar': f'https://i.pravatar.cc/150?u=user{i}'
+        } for i in range(users)]
+    }
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        click.echo(f'{"dataset":<22}{"codec":<13}{"size, MB":>10}{"save, ms":>10}{"load, ms":>10}')
+        for name, data in datasets.items():
+            for codec in CollectionCodec.CODECS:
+                path = os.path.join(temp_dir, f'{codec}.bin')
+                started = time.perf_counter()
+                with open(path, 'wb') as f:
+                    f.write(CollectionCodec.encode(codec, data))
+                save_ms = (time.perf_counter() - started) * 1000
+                started = time.perf_counter()
+                with open(path, 'rb') as f:
+                    loaded = CollectionCodec.decode(f.read())
+                load_ms = (time.perf_counter() - started) * 1000
+                assert len(loaded) == len(data)
+                size_mb = os.path.getsize(path) / (1024 * 1024)
+                click.echo(f'{name:<22}{codec:<13}{size_mb:>10.2f}{save_ms:>10.0f}{load_ms:>10.0f}')
+
 # Обработчики ошибок
 @app.errorhandler(404)
 def not_found(error):
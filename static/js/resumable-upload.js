@@ -0,0 +1,114 @@
+// Загрузка файлов частями через /api/uploads: части уходят параллельно,
+// у каждой своя контрольная сумма; после обрыва загрузка продолжается
+// с непринятых частей (id загрузки запоминается в localStorage).
+// Для небольших файлов заранее считается sha256 всего файла: если такое
+// содержимое уже есть на сервере, части не отправляются.
+const ResumableUpload = (() => {
+    const PARALLEL_CHUNKS = 3;
+    const MAX_RETRIES = 5;
+    // Больше не читаем в память целиком ради хеша
+    const MAX_HASHED_FILE_SIZE = 64 * 1024 * 1024;
+
+    class FatalUploadError extends Error {}
+
+    async function sha256Base64(buffer) {
+        const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', buffer));
+        let binary = '';
+        digest.forEach(byte => { binary += String.fromCharCode(byte); });
+        return btoa(binary);
+    }
+
+    async function sha256Hex(file) {
+        const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', await file.arrayBuffer()));
+        return Array.from(digest, byte => byte.toString(16).padStart(2, '0')).join('');
+    }
+
+    function storageKey(file, purpose, targetId) {
+        return `upload:${purpose}:${targetId}:${file.name}:${file.size}:${file.lastModified}`;
+    }
+
+    async function readJson(response) {
+        const data = await response.json().catch(() => ({}));
+        if (!response.ok) {
+            throw new FatalUploadError(data.error || `HTTP ${response.status}`);
+        }
+        return data;
+    }
+
+    async function start(file, purpose, targetId) {
+        const key = storageKey(file, purpose, targetId);
+        const savedId = localStorage.getItem(key);
+        if (savedId) {
+            const response = await fetch(`/api/uploads/${savedId}`);
+            if (response.ok) {
+                const upload = await response.json();
+                if (upload.status === 'open') return upload;
+            }
+            localStorage.removeItem(key);
+        }
+        const checksum = purpose !== 'blog_video' && file.size <= MAX_HASHED_FILE_SIZE
+            ? await sha256Hex(file) : null;
+        const upload = await readJson(await fetch('/api/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ purpose, target_id: targetId, filename: file.name, size: file.size, checksum })
+        }));
+        localStorage.setItem(key, upload.id);
+        return upload;
+    }
+
+    async function sendChunk(upload, file, index) {
+        const begin = index * upload.chunk_size;
+        const buffer = await file.slice(begin, Math.min(begin + upload.chunk_size, file.size)).arrayBuffer();
+        const checksum = await sha256Base64(buffer);
+
+        for (let attempt = 0; ; attempt++) {
+            try {
+                const response = await fetch(`/api/uploads/${upload.id}?chunk=${index}`, {
+                    method: 'PATCH',
+                    headers: {
+                        'Content-Type': 'application/offset+octet-stream',
+                        'Upload-Checksum': 'sha256 ' + checksum
+                    },
+                    body: buffer
+                });
+                // 460 - часть повреждена в пути, 5xx - сбой сервера: повторяем
+                if (response.ok) return;
+                if (response.status !== 460 && response.status < 500) await readJson(response);
+            } catch (error) {
+                if (error instanceof FatalUploadError) throw error;
+            }
+            if (attempt >= MAX_RETRIES) {
+                throw new Error(`Не удалось отправить часть ${index + 1}`);
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempt));
+        }
+    }
+
+    // onProgress получает долю принятых частей (0..1)
+    async function upload(file, purpose, targetId, onProgress) {
+        const session = await start(file, purpose, targetId);
+        const received = new Set(session.received);
+        const pending = [];
+        for (let i = 0; i < session.chunks; i++) {
+            if (!received.has(i)) pending.push(i);
+        }
+
+        let done = received.size;
+        if (onProgress) onProgress(session.chunks ? done / session.chunks : 1);
+        const worker = async () => {
+            while (pending.length) {
+                await sendChunk(session, file, pending.shift());
+                done++;
+                if (onProgress) onProgress(done / session.chunks);
+            }
+        };
+        await Promise.all(Array.from({ length: Math.min(PARALLEL_CHUNKS, pending.length) }, worker));
+
+        const result = await readJson(await fetch(`/api/uploads/${session.id}/complete`, { method: 'POST' }));
+        localStorage.removeItem(storageKey(file, purpose, targetId));
+        return result;
+    }
+
+    return { upload };
+})();
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """app.py, импортированный в пустом рабочем каталоге (data/, uploads/ и т.д. - временные)"""
+    os.chdir(tmp_path_factory.mktemp('app'))
+    os.environ.setdefault('DB_BACKEND', 'json')
+    sys.path.insert(0, ROOT)
+    import app as module
+    return module
+
+
+@pytest.fixture
+def login(app_module):
+    """Клиент Flask с пользователем в сессии"""
+    def make(username, role):
+        client = app_module.app.test_client()
+        with client.session_transaction() as session:
+            session['user'] = {'username': username, 'role': role}
+        return client
+    return make
@@ -0,0 +1,18 @@
+def _listed_ids(client):
+    return [p['id'] for p in client.get('/api/blog/posts?limit=100').get_json()['posts']]
+
+
+def test_restore_brings_deleted_post_back_to_listing(app_module):
+    DB = app_module.DB
+    client = app_module.app.test_client()
+    post = DB.save_blog_post('Restored post', '<p>body</p>', 'admin', is_published=True)
+    assert post['id'] in _listed_ids(client)
+
+    backup_path = DB.create_backup()
+    DB.delete_blog_post(post['id'])
+    assert post['id'] not in _listed_ids(client)
+
+    assert DB.restore_backup(backup_path, create_reserve_copy=False)
+
+    assert post['id'] in _listed_ids(client)
+    assert DB.get_blog_post(post['id'], with_content=True)['content'] == '<p>body</p>'
@@ -0,0 +1,32 @@
+from urllib.parse import quote
+
+
+def test_feed_links_are_percent_encoded(app_module):
+    DB = app_module.DB
+    client = app_module.app.test_client()
+    post = DB.save_blog_post('Привет мир', '<p>body</p>', 'admin', is_published=True)
+    encoded = quote(post['slug'])
+
+    feed = client.get('/blog/feed.xml').get_data(as_text=True)
+    sitemap = client.get('/sitemap.xml').get_data(as_text=True)
+
+    assert f'<link>{app_module.SITE_URL}/blog/post/{encoded}</link>' in feed
+    assert f'<guid isPermaLink="true">{app_module.SITE_URL}/blog/post/{encoded}</guid>' in feed
+    assert f'<loc>{app_module.SITE_URL}/blog/post/{encoded}</loc>' in sitemap
+    assert post['slug'] not in feed + sitemap
+
+
+def test_last_modified_does_not_go_back_on_unpublish(app_module):
+    DB = app_module.DB
+    client = app_module.app.test_client()
+    DB.save_blog_post('Old post', '<p>body</p>', 'admin', is_published=True)
+    for post in DB._get_db('blog_posts'):
+        DB._update('blog_posts', post['id'], lambda doc: dict(doc, updated_at='2020-01-01T00:00:00'))
+    new = DB.save_blog_post('New post', '<p>body</p>', 'admin', is_published=True)
+    before = client.get('/sitemap.xml').last_modified
+
+    DB.update_blog_post(new['id'], {'is_published': False})
+    response = client.get('/sitemap.xml')
+
+    assert f'/blog/post/{new["slug"]}' not in response.get_data(as_text=True)
+    assert response.last_modified >= before
@@ -0,0 +1,60 @@
+from datetime import datetime
+
+
+def test_migrate_legacy_keeps_already_moved_documents(app_module):
+    DB, WeekPartitions = app_module.DB, app_module.WeekPartitions
+    created_at = datetime.now().isoformat()
+    partition = WeekPartitions.name('homeworks', datetime.fromisoformat(created_at))
+    # Задание 9001 уже перенесено другим воркером и с тех пор изменено
+    WeekPartitions.put('homeworks', {'id': 9001, 'title': 'edited', 'created_at': created_at})
+    DB.backend.put('homeworks', {'id': 9001, 'title': 'legacy', 'created_at': created_at})
+    DB.backend.put('homeworks', {'id': 9002, 'title': 'legacy', 'created_at': created_at})
+
+    assert WeekPartitions.migrate_legacy('homeworks') == 2
+    assert WeekPartitions.migrate_legacy('homeworks') == 0
+
+    assert DB.backend.all('homeworks') == []
+    assert DB.backend.get(partition, 9001)['title'] == 'edited'
+    assert DB.backend.get(partition, 9002)['title'] == 'legacy'
+
+
+def test_split_homework_submissions_keeps_graded_work(app_module):
+    DB, WeekPartitions = app_module.DB, app_module.WeekPartitions
+    created_at = datetime.now().isoformat()
+    WeekPartitions.put('homeworks', {
+        'id': 9101,
+        'title': 'legacy',
+        'created_at': created_at,
+        'submissions': {
+            'student': {'text': 'answer', 'submitted_at': created_at},
+            'other': {'text': 'answer', 'submitted_at': created_at}
+        }
+    })
+    # Работа 'student' уже перенесена другим воркером и проверена
+    DB._put('homework_submissions', {
+        'key': '9101:student', 'homework_id': 9101, 'student': 'student', 'text': 'answer', 'grade': 5
+    })
+
+    assert DB.split_homework_submissions() == 1
+
+    assert DB.get_submission(9101, 'student')['grade'] == 5
+    assert DB.get_submission(9101, 'other')['text'] == 'answer'
+    homework = WeekPartitions.locate('homeworks', 9101)[1]
+    assert 'submissions' not in homework
+    assert homework['submissions_count'] == 2
+
+
+def test_split_blog_content_prunes_orphans_only_on_restore(app_module):
+    DB, namespace = app_module.DB, app_module.BLOG_CONTENT_NAMESPACE
+    DB._put('blog_posts', {'id': 9201, 'title': 'legacy', 'content': 'body'})
+    # Тело поста, который другой воркер еще только сохраняет
+    DB.backend.put_blob(namespace, 9202, 'new body')
+
+    assert DB.split_blog_content() == 1
+    assert 'content' not in DB.backend.get('blog_posts', 9201)
+    assert DB.backend.get_blob(namespace, 9201) == 'body'
+    assert DB.backend.get_blob(namespace, 9202) == 'new body'
+
+    DB.split_blog_content(prune_orphans=True)
+    assert DB.backend.get_blob(namespace, 9201) == 'body'
+    assert DB.backend.get_blob(namespace, 9202) is None
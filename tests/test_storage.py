@@ -0,0 +1,40 @@
+def test_reads_return_copies(app_module):
+    DB = app_module.DB
+    DB._put('testimonials', {'id': 'copy-check', 'text': 'original'})
+
+    DB.backend.get('testimonials', 'copy-check')['text'] = 'changed'
+    for doc in DB.backend.all('testimonials'):
+        doc['text'] = 'changed'
+    DB.backend.update('testimonials', 'copy-check', lambda doc: doc)['text'] = 'changed'
+
+    assert DB.backend.get('testimonials', 'copy-check')['text'] == 'original'
+
+
+def test_put_does_not_alias_caller_dict(app_module):
+    DB = app_module.DB
+    doc = {'id': 'alias-check', 'text': 'original'}
+    DB._put('testimonials', doc)
+    doc['text'] = 'changed'
+
+    assert DB.backend.get('testimonials', 'alias-check')['text'] == 'original'
+
+
+def test_locked_waits_without_blocking_hub(app_module):
+    eventlet = app_module.eventlet
+    fcntl = app_module.fcntl
+    events = []
+
+    def writer():
+        with app_module.JournalStore.locked('flock-check'):
+            events.append('locked')
+
+    # Другой процесс держит flock: отдельное открытие файла ведет себя так же
+    with open(f'{app_module.DB_FOLDER}/flock-check.lock', 'a') as holder:
+        fcntl.flock(holder, fcntl.LOCK_EX)
+        waiting = eventlet.spawn(writer)
+        eventlet.sleep(0.05)
+        events.append('hub alive')
+        fcntl.flock(holder, fcntl.LOCK_UN)
+    waiting.wait()
+
+    assert events == ['hub alive', 'locked']
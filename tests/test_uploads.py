@@ -0,0 +1,130 @@
+import base64
+import hashlib
+import io
+import os
+
+from PIL import Image
+
+
+def test_content_store_lock_waits_without_blocking_hub(app_module):
+    eventlet = app_module.eventlet
+    fcntl = app_module.fcntl
+    events = []
+
+    def writer():
+        with app_module.ContentStore._locked():
+            events.append('locked')
+
+    os.makedirs(app_module.CAS_FOLDER, exist_ok=True)
+    with open(os.path.join(app_module.CAS_FOLDER, '.lock'), 'a') as holder:
+        fcntl.flock(holder, fcntl.LOCK_EX)
+        waiting = eventlet.spawn(writer)
+        eventlet.sleep(0.05)
+        events.append('hub alive')
+        fcntl.flock(holder, fcntl.LOCK_UN)
+    waiting.wait()
+
+    assert events == ['hub alive', 'locked']
+
+
+def test_resent_chunk_with_bad_checksum_is_discarded(app_module, login, monkeypatch):
+    monkeypatch.setattr(app_module, 'UPLOAD_CHUNK_SIZE', 1000)
+    post = app_module.DB.save_blog_post('Video', '<p>x</p>', 'admin', is_published=True)
+    client = login('admin', 'teacher')
+    data = os.urandom(3000)
+    upload = client.post('/api/uploads', json={
+        'purpose': 'blog_video', 'target_id': post['id'], 'filename': 'clip.mp4', 'size': len(data)
+    }).get_json()
+
+    def send(index, corrupt=False):
+        chunk = data[index * 1000:(index + 1) * 1000]
+        checksum = base64.b64encode(hashlib.sha256(chunk).digest()).decode()
+        body = bytes([chunk[0] ^ 1]) + chunk[1:] if corrupt else chunk
+        return client.patch(f"/api/uploads/{upload['id']}?chunk={index}", data=body,
+                            headers={'Upload-Checksum': f'sha256 {checksum}'}).status_code
+
+    assert [send(0), send(1), send(2)] == [200, 200, 200]
+    # Повторная отправка уже принятого куска с битыми данными
+    assert send(1, corrupt=True) == 460
+    assert client.get(f"/api/uploads/{upload['id']}").get_json()['received'] == [0, 2]
+    assert client.post(f"/api/uploads/{upload['id']}/complete").status_code == 409
+
+    assert send(1) == 200
+    result = client.post(f"/api/uploads/{upload['id']}/complete").get_json()
+    relative_path = result['video_url'].split('/uploads/', 1)[1]
+    with open(os.path.join(app_module.UPLOAD_FOLDER, relative_path), 'rb') as f:
+        assert f.read() == data
+
+
+def _png(color):
+    buf = io.BytesIO()
+    Image.new('RGB', (400, 300), color).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def _wait_for(app_module, fn):
+    """Варианты изображений пишутся в фоне"""
+    for _ in range(100):
+        value = fn()
+        if value:
+            return value
+        app_module.eventlet.sleep(0.05)
+    return fn()
+
+
+def test_cover_variant_urls_point_to_files(app_module, login):
+    DB = app_module.DB
+    client = login('admin', 'teacher')
+    post = DB.save_blog_post('Variants', '<p>x</p>', 'admin', is_published=True)
+    assert client.post(f"/api/blog/posts/{post['id']}/cover",
+                       data={'cover_image': (io.BytesIO(_png('green')), 'cover.png')}).status_code == 200
+
+    variants = _wait_for(app_module, lambda: DB.backend.get('blog_posts', post['id']).get('cover_variants'))
+
+    for url in app_module.UploadGC._strings(variants):
+        if '/uploads/' in url:
+            assert os.path.exists(os.path.join(app_module.UPLOAD_FOLDER, url.split('/uploads/', 1)[1])), url
+
+
+def test_gc_uploads_keeps_live_files(app_module, login):
+    A, DB = app_module, app_module.DB
+    client = login('admin', 'teacher')
+    post = DB.save_blog_post('Cover', '<p>x</p>', 'admin', is_published=True)
+    assert client.post(f"/api/blog/posts/{post['id']}/cover",
+                       data={'cover_image': (io.BytesIO(_png('red')), 'cover.png')}).status_code == 200
+    assert client.post('/api/users/admin/avatar',
+                       data={'avatar': (io.BytesIO(_png('blue')), 'avatar.png')}).status_code == 200
+    with A.app.test_request_context():
+        homework_file = A.ContentStore.put_file(A.FileStorage(io.BytesIO(b'task' * 64), 'task.pdf'), 'admin', 'homework')
+        submission_file = A.ContentStore.put_file(A.FileStorage(io.BytesIO(b'work' * 64), 'work.pdf'), 'student1', 'submission')
+        dead = A.ContentStore.put_file(A.FileStorage(io.BytesIO(b'dead' * 64), 'dead.pdf'), 'student1', 'submission')
+    deadline = (A.datetime.now() + A.timedelta(days=3)).isoformat()
+    homework = DB.save_homework(1, 'GC', 'd', deadline, 'admin', students=['student1'], files=[homework_file])
+    DB.submit_homework(homework['id'], 'student1', 'done', [submission_file])
+    cover_variants = _wait_for(A, lambda: DB.backend.get('blog_posts', post['id']).get('cover_variants'))
+    avatar_variants = _wait_for(A, lambda: DB.get_user('admin').get('avatar_variants'))
+    live = {
+        'cover': DB.backend.get('blog_posts', post['id'])['cover_ref'],
+        'avatar': DB.get_user('admin')['avatar_ref'],
+        'homework': homework_file['id'],
+        'submission': submission_file['id']
+    }
+    # Все ссылки и файлы старше порогов сборщика
+    for ref in DB._get_db('file_refs'):
+        DB._update('file_refs', ref['id'], lambda doc: dict(doc, created_at='2000-01-01'))
+    for root, dirs, files in os.walk(A.UPLOAD_FOLDER):
+        for name in files:
+            os.utime(os.path.join(root, name), (0, 0))
+
+    result = A.app.test_cli_runner().invoke(args=['gc-uploads'])
+    assert result.exit_code == 0, result.output
+
+    refs = {ref['id']: ref for ref in DB._get_db('file_refs')}
+    assert dead['id'] not in refs
+    for kind, ref_id in live.items():
+        assert ref_id in refs, kind
+        blob = DB.backend.get('file_blobs', refs[ref_id]['sha256'])
+        assert os.path.exists(A.ContentStore.path(blob)), kind
+    for url in A.UploadGC._strings([cover_variants, avatar_variants]):
+        if '/uploads/' in url:
+            assert os.path.exists(os.path.join(A.UPLOAD_FOLDER, url.split('/uploads/', 1)[1])), url